@@ -1,22 +1,1013 @@
+import asyncio
+import csv
 import json
 import math
-from flask import Flask, render_template_string, request, jsonify
+import multiprocessing
+import os
+import random
+import sys
+import hashlib
+import hmac
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from flask import Flask, Response, g, render_template_string, request, jsonify
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 import numpy as np
-import matplotlib.pyplot as plt
 import matplotlib
-from matplotlib.patches import Patch, Rectangle, Arc
-from matplotlib.lines import Line2D
-from shapely.geometry import LineString, Point, Polygon
-from scipy.spatial import ConvexHull
+from matplotlib.patches import PathPatch
+from matplotlib.path import Path
+from matplotlib.collections import LineCollection, PathCollection
+from matplotlib.transforms import Affine2D
+from matplotlib.artist import Artist
+from matplotlib.text import Text
+from matplotlib import font_manager
+from matplotlib.colors import is_color_like
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from PIL import Image
+from shapely.geometry import LineString, MultiPoint, Point, Polygon, box, mapping
+from shapely.affinity import affine_transform
+from shapely.ops import unary_union
+import shapely
+from shapely import STRtree
+from scipy.spatial import ConvexHull, cKDTree
 import io
 import base64
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Parquet analytics export is optional
+    pyarrow = None
 
 matplotlib.use('Agg')
 
 app = Flask(__name__)
 if CORS:
     CORS(app)  # Enable CORS for Flutter app
+# Reverse proxies in front of the app (Railway's edge adds one X-Forwarded-For hop). Only that many hops
+# are trusted, so request.remote_addr is the address the proxy saw and clients cannot choose it
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', 1))
+if TRUSTED_PROXY_HOPS > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS, x_proto=TRUSTED_PROXY_HOPS)
+
+# Plan layers in drawing order with their z-order (higher = on top)
+RENDER_LAYERS = [
+    ('dimension', -1),  # Dimensions behind walls
+    ('object', -0.5),  # Furniture symbols under walls and openings
+    ('wall', 0),
+    ('hide_surface', 1),
+    ('window', 10),
+    ('door', 10),  # Same z-order as windows
+    ('label', 30),
+]
+
+DEFAULT_RENDER_OPTIONS = {
+    'wall_line_width': 22.0,  # Default like surfaceWidth in SpriteKit
+    'wall_style': 'polygon',  # 'polygon' (joined thickness outline) or 'stroke' (thick lines + overdraw)
+    'show_dimensions': True,
+    'show_labels': True,
+    'show_objects': True,
+    'door_style': 'swing',  # 'swing' (leaf + arc) or 'line' (perpendicular stroke)
+    'window_style': 'symbol',  # 'symbol' (frame + glazing across the wall) or 'line'
+    'locale': 'default',  # Name of a locale (LOCALES); the default keeps the pre-locale output
+    'style': 'default',  # Name of a style profile (STYLE_PROFILES)
+}
+
+# Walls within this many degrees of the dominant plan orientation are snapped to it (0 disables)
+WALL_SNAP_DEGREES = float(os.environ.get('WALL_SNAP_DEGREES', 5.0))
+
+# Openings without a known parentIdentifier attach to the nearest parallel wall within this distance
+OPENING_ATTACH_DISTANCE = 0.3  # Meters
+OPENING_ATTACH_ANGLE = np.deg2rad(10.0)
+# A shared wall scanned from both rooms: parallel walls this close are one wall, so both copies get the cut
+DUPLICATE_WALL_DISTANCE = 0.05  # Meters
+
+# Deterministic rendering: stable element order, coordinates snapped to a grid and matplotlib defaults
+# pinned, so identical plans give byte-identical images across hosts (cache keys and CDN hashes stay stable)
+DETERMINISTIC_RENDER = os.environ.get('DETERMINISTIC_RENDER', 'True').lower() == 'true'
+COORDINATE_QUANTUM = 1e-3  # Scaled units (1 unit = 5 mm)
+ANGLE_QUANTUM = 1e-9  # Radians
+
+if DETERMINISTIC_RENDER:
+    # Ignore any host matplotlibrc/style; DejaVu Sans ships with matplotlib itself
+    matplotlib.rcdefaults()
+    matplotlib.rcParams['font.family'] = 'DejaVu Sans'
+
+# Canvas for layered rendering - every layer must share the same pixel geometry
+LAYER_CANVAS = {'figsize': (16, 14), 'dpi': 100}
+
+# Output sizes; 'thumbnail' is also what admission control downgrades heavy requests to
+RENDER_TIERS = {
+    'full': LAYER_CANVAS,
+    'thumbnail': {'figsize': (8, 7), 'dpi': 60},
+}
+LAYER_AXES_RECT = (0.07, 0.05, 0.9, 0.89)
+
+
+DEFAULT_ENCODE_OPTIONS = {
+    'image_format': 'png',  # 'png' or 'webp'
+    'color_mode': 'palette',  # 'rgb', 'palette' (indexed PNG) or 'gray'
+    'compression_level': 6,  # zlib level for PNG, mapped to WebP effort
+    'quality': 80,  # WebP quality
+}
+IMAGE_MIME_TYPES = {'png': 'image/png', 'webp': 'image/webp'}
+PALETTE_COLORS = 64
+
+# Tiled output (slippy-map style z/x/y over the square plan extent)
+TILE_SIZE = 256
+MAX_TILE_ZOOM = int(os.environ.get('MAX_TILE_ZOOM', 8))
+
+
+def _as_bool(value):
+    """Interpret JSON booleans and query-string flags ('0', 'false', 'no', 'off')"""
+    if isinstance(value, str):
+        return value.strip().lower() not in ('0', 'false', 'no', 'off', '')
+    return bool(value)
+
+
+def parse_render_options(data):
+    """Normalize render options from request JSON or query args"""
+    options = dict(DEFAULT_RENDER_OPTIONS)
+    if data.get('style') in STYLE_PROFILES:
+        options['style'] = data['style']
+    # The profile's wall width is the default; the request can still override it
+    options['wall_line_width'] = STYLE_PROFILES[options['style']]['wall_line_width']
+    if data.get('wall_line_width') is not None:
+        options['wall_line_width'] = float(data['wall_line_width'])
+    for key in ('show_dimensions', 'show_labels', 'show_objects'):
+        if key in data:
+            options[key] = _as_bool(data[key])
+    if data.get('wall_style') in ('polygon', 'stroke'):
+        options['wall_style'] = data['wall_style']
+    if data.get('door_style') in ('swing', 'line'):
+        options['door_style'] = data['door_style']
+    if data.get('window_style') in ('symbol', 'line'):
+        options['window_style'] = data['window_style']
+    # Old clients send label_language, which maps to locales with the pre-locale output
+    locale = resolve_locale(data.get('locale')) or LEGACY_LABEL_LANGUAGES.get(data.get('label_language'))
+    if locale:
+        options['locale'] = locale
+    return options
+
+
+def canonical_json(data):
+    """Compact, key-sorted UTF-8 JSON used for content hashing and storage"""
+    return json.dumps(data, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def quantize(value, quantum=COORDINATE_QUANTUM):
+    """Snap values to a fixed grid, so last-bit float noise cannot move rendered pixels"""
+    return np.round(np.asarray(value, dtype=float) / quantum) * quantum
+
+
+class BytesLRUCache:
+    """Thread-safe LRU cache bounded by the total size of stored values in bytes"""
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            self._items.move_to_end(key)
+            return item[0]
+    
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[1]
+            self._items[key] = (value, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self.total_bytes -= evicted_size
+    
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.total_bytes = 0
+
+
+_layer_cache = BytesLRUCache(int(os.environ.get('LAYER_CACHE_MAX_BYTES', 256 * 1024 * 1024)))
+_tile_cache = BytesLRUCache(int(os.environ.get('TILE_CACHE_MAX_BYTES', 64 * 1024 * 1024)))
+
+# Largest canvas or sheet a render may allocate (4 bytes per pixel in Agg)
+MAX_CANVAS_PIXELS = int(os.environ.get('MAX_CANVAS_PIXELS', 4096 * 4096))
+CANVAS_POOL_SIZE = int(os.environ.get('CANVAS_POOL_SIZE', 4))  # Idle figures kept per canvas size
+# Idle figures kept across all sizes; tile dpi depends on plan and zoom, so sizes are not a fixed set
+CANVAS_POOL_MAX_IDLE = int(os.environ.get('CANVAS_POOL_MAX_IDLE', 16))
+
+class CanvasTooLarge(ValueError):
+    """Raised before allocating a canvas above MAX_CANVAS_PIXELS"""
+
+def check_canvas_pixels(width, height):
+    if width * height > MAX_CANVAS_PIXELS:
+        raise CanvasTooLarge(f'canvas {int(width)}x{int(height)} exceeds {MAX_CANVAS_PIXELS} pixels')
+
+class CanvasPool:
+    """Agg figures reused per (figsize, dpi); a figure is cleared and returned on every exit path.
+    
+    At most per_size idle figures are kept per size and max_idle in total; the least recently
+    used sizes give up their figures first.
+    """
+    
+    def __init__(self, per_size, max_idle):
+        self.per_size = per_size
+        self.max_idle = max_idle
+        self.created = 0
+        self.reused = 0
+        self.evicted = 0
+        self._idle = OrderedDict()
+        self._idle_count = 0
+        self._lock = threading.Lock()
+    
+    @contextmanager
+    def figure(self, figsize, dpi):
+        check_canvas_pixels(figsize[0] * dpi, figsize[1] * dpi)
+        key = (float(figsize[0]), float(figsize[1]), float(dpi))
+        with self._lock:
+            idle = self._idle.get(key)
+            fig = idle.pop() if idle else None
+            if idle is not None and not idle:
+                del self._idle[key]
+            if fig is None:
+                self.created += 1
+            else:
+                self._idle_count -= 1
+                self.reused += 1
+        if fig is None:
+            # The canvas keeps its Agg renderer, so a reused figure also skips the buffer allocation
+            fig = Figure(figsize=figsize, dpi=dpi)
+            FigureCanvasAgg(fig)
+        try:
+            yield fig
+        finally:
+            sample_render_memory()
+            # Back to a blank figure: artists, face colour and tight_layout margins
+            fig.clear()
+            fig.patch.set_facecolor(matplotlib.rcParams['figure.facecolor'])
+            fig.patch.set_alpha(None)
+            fig.subplots_adjust(**{name: matplotlib.rcParams[f'figure.subplot.{name}']
+                                   for name in ('left', 'right', 'bottom', 'top', 'wspace', 'hspace')})
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                self._idle.move_to_end(key)
+                if len(idle) < self.per_size:
+                    idle.append(fig)
+                    self._idle_count += 1
+                while self._idle_count > self.max_idle:
+                    oldest_key, oldest = next(iter(self._idle.items()))
+                    oldest.pop()
+                    if not oldest:
+                        del self._idle[oldest_key]
+                    self._idle_count -= 1
+                    self.evicted += 1
+    
+    def snapshot(self):
+        with self._lock:
+            return {'created': self.created, 'reused': self.reused, 'evicted': self.evicted,
+                    'idle': self._idle_count, 'sizes': len(self._idle)}
+
+canvas_pool = CanvasPool(CANVAS_POOL_SIZE, CANVAS_POOL_MAX_IDLE)
+
+def rss_bytes():
+    """Current resident set size of this process (None where /proc is unavailable)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def peak_rss_bytes():
+    """Process RSS high-water mark (ru_maxrss is KiB on Linux)"""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# Per-thread scope of the render being measured; canvases sample RSS when released, while buffers are still live
+_memory_scope = threading.local()
+
+def sample_render_memory():
+    state = getattr(_memory_scope, 'state', None)
+    rss = rss_bytes() if state is not None else None
+    if rss is not None:
+        state['peak'] = max(state['peak'], rss)
+
+@contextmanager
+def render_memory(kind):
+    """Track the RSS peak of one render and record it in metrics"""
+    start = rss_bytes()
+    if start is None or getattr(_memory_scope, 'state', None) is not None:
+        # No /proc, or already inside a measured render
+        yield
+        return
+    process_peak = peak_rss_bytes()
+    _memory_scope.state = {'peak': start}
+    try:
+        yield
+    finally:
+        peak = max(_memory_scope.state['peak'], rss_bytes() or start)
+        _memory_scope.state = None
+        record_memory(kind, peak, peak - start, process_peak is not None and (peak_rss_bytes() or 0) > process_peak)
+
+# Text styles for plan annotations (colours and sizes come from the style profile);
+# labels are rasterized once per (text, style, profile, font chain, rotation bucket, dpi)
+LABEL_STYLES = {
+    'dimension': {'fontsize': 10, 'fontweight': 'bold', 'color': '#333',
+                  'bbox': {'boxstyle': 'round,pad=0.2', 'facecolor': 'white', 'alpha': 0.95,
+                           'edgecolor': 'none', 'linewidth': 0}},
+    'area': {'fontsize': 11, 'fontweight': 'normal', 'style': 'italic', 'color': '#666666'},
+    'room': {'fontsize': 14, 'fontweight': 'bold', 'color': '#333'},
+}
+LABEL_ROTATION_STEP = 2.0  # Degrees per rotation bucket
+# Deep tile zooms render at thousands of dpi; above this labels are drawn as native text,
+# since a raster per label would be larger than the tile it lands on
+LABEL_RASTER_MAX_DPI = float(os.environ.get('LABEL_RASTER_MAX_DPI', 300))
+_label_cache = BytesLRUCache(int(os.environ.get('LABEL_CACHE_MAX_BYTES', 16 * 1024 * 1024)))
+
+
+def label_rotation(rotation):
+    return (round(rotation / LABEL_ROTATION_STEP) * LABEL_ROTATION_STEP) % 360
+
+def label_raster(text, style, rotation, dpi, profile=None, fonts=None):
+    """RGBA raster of a centered label, cropped to its visible pixels; cached across plans and renders"""
+    profile = profile or STYLE_PROFILES['default']
+    fonts = fonts or LOCALES[DEFAULT_LOCALE]['fonts']
+    rotation = label_rotation(rotation)
+    # Text is shaped and measured once per key, so locales only cost a cache miss per new string
+    key = (text, style, profile['key'], fonts, rotation, dpi)
+    raster = _label_cache.get(key)
+    if raster is not None:
+        return raster
+    
+    fig = Figure(dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    fig.patch.set_alpha(0)
+    label = fig.text(0.5, 0.5, text, ha='center', va='center', rotation=rotation, fontfamily=list(fonts),
+                     **profile['label_styles'][style])
+    # Size the canvas to the rotated text plus margin for the bbox padding, then draw once
+    extent = label.get_window_extent(canvas.get_renderer())
+    check_canvas_pixels(extent.width + 20, extent.height + 20)
+    fig.set_size_inches((extent.width + 20) / dpi, (extent.height + 20) / dpi)
+    canvas.draw()
+    rgba = np.asarray(canvas.buffer_rgba())
+    rows = np.flatnonzero(rgba[:, :, 3].any(axis=1))
+    cols = np.flatnonzero(rgba[:, :, 3].any(axis=0))
+    raster = rgba[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1].copy() if len(rows) else np.zeros((1, 1, 4), np.uint8)
+    _label_cache.put(key, raster, raster.nbytes)
+    return raster
+
+
+class CachedLabel(Artist):
+    """Text label blitted from the label raster cache instead of being laid out on every render"""
+    
+    def __init__(self, x, y, text, style, rotation=0.0, zorder=0, profile=None, fonts=None):
+        super().__init__()
+        self._xy = (x, y)
+        self._text = text
+        self._style = style
+        self._profile = profile
+        self._fonts = fonts
+        self._rotation = rotation
+        self.set_zorder(zorder)
+    
+    def draw(self, renderer):
+        if not self.get_visible():
+            return
+        raster_dpi = min(renderer.dpi, LABEL_RASTER_MAX_DPI)
+        raster = label_raster(self._text, self._style, self._rotation, raster_dpi, self._profile, self._fonts)
+        x, y = self.axes.transData.transform(self._xy)
+        height, width = raster.shape[:2]
+        # Text scales with dpi, so the capped raster gives the extent at any dpi; tiles query
+        # a margin around themselves, and labels that miss the canvas are skipped
+        half_w, half_h = width * renderer.dpi / raster_dpi / 2, height * renderer.dpi / raster_dpi / 2
+        if x + half_w < 0 or x - half_w > renderer.width or y + half_h < 0 or y - half_h > renderer.height:
+            return
+        if renderer.dpi > raster_dpi:
+            self._draw_text(renderer)
+            return
+        gc = renderer.new_gc()
+        # Agg images are addressed from the bottom-left corner with rows stored top-down
+        renderer.draw_image(gc, round(x - width / 2), round(y - height / 2), raster[::-1])
+        gc.restore()
+    
+    def _draw_text(self, renderer):
+        """Native text with the raster's style, clipped by Agg to the canvas"""
+        profile = self._profile or STYLE_PROFILES['default']
+        text = Text(self._xy[0], self._xy[1], self._text, ha='center', va='center',
+                    rotation=label_rotation(self._rotation), fontfamily=list(self._fonts or LOCALES[DEFAULT_LOCALE]['fonts']),
+                    **profile['label_styles'][self._style])
+        text.set_figure(self.figure)
+        text.set_transform(self.axes.transData)
+        text.draw(renderer)
+
+
+def composite_layers(layers):
+    """Alpha-composite RGBA layers (y, x, rgba) over the opaque base layer, returns RGB of the base extent"""
+    base_y, base_x, base = layers[0]
+    out = base[..., :3].copy()
+    out_h, out_w = out.shape[:2]
+    for y0, x0, rgba in layers[1:]:
+        # Clip the layer to the (cropped) base extent
+        top, left = y0 - base_y, x0 - base_x
+        src_top, src_left = max(0, -top), max(0, -left)
+        bottom = min(out_h, top + rgba.shape[0])
+        right = min(out_w, left + rgba.shape[1])
+        top, left = max(0, top), max(0, left)
+        if bottom <= top or right <= left:
+            continue
+        src = rgba[src_top:src_top + bottom - top, src_left:src_left + right - left]
+        target = out[top:bottom, left:right]
+        alpha = src[..., 3]
+        # Blend only touched pixels - layers are mostly transparent
+        mask = alpha > 0
+        a = alpha[mask].astype(np.float32)[:, None] / 255.0
+        target[mask] = (src[..., :3][mask] * a + target[mask] * (1.0 - a) + 0.5).astype(np.uint8)
+    return out
+
+
+def parse_encode_options(data):
+    """Normalize image encoding options from request JSON or query args"""
+    options = dict(DEFAULT_ENCODE_OPTIONS)
+    if data.get('image_format') in IMAGE_MIME_TYPES:
+        options['image_format'] = data['image_format']
+    if data.get('color_mode') in ('rgb', 'palette', 'gray'):
+        options['color_mode'] = data['color_mode']
+    if data.get('compression_level') is not None:
+        options['compression_level'] = min(9, max(0, int(data['compression_level'])))
+    if data.get('quality') is not None:
+        options['quality'] = min(100, max(1, int(data['quality'])))
+    return options
+
+
+def encode_image(rgb, options=None):
+    """Encode an RGB array as PNG (rgb, palette-indexed or grayscale) or WebP"""
+    options = options or DEFAULT_ENCODE_OPTIONS
+    image = Image.fromarray(rgb)
+    # Plans are drawn in a handful of grey tones, so a small palette or 8-bit grey loses nothing visible
+    if options['color_mode'] == 'gray':
+        image = image.convert('L')
+    elif options['color_mode'] == 'palette' and options['image_format'] == 'png':
+        image = image.quantize(colors=PALETTE_COLORS, method=Image.Quantize.FASTOCTREE)
+    
+    buffer = io.BytesIO()
+    if options['image_format'] == 'webp':
+        # WebP effort 0-6 follows the 0-9 compression level
+        image.save(buffer, format='WEBP', quality=options['quality'],
+                   method=options['compression_level'] * 6 // 9)
+    else:
+        # No pnginfo: PIL writes no time or software chunks, so equal pixels give equal bytes
+        image.save(buffer, format='PNG', compress_level=options['compression_level'])
+    return buffer.getvalue()
+
+
+def polygon_path(geometry):
+    """Matplotlib Path (exteriors and holes) for a shapely Polygon or MultiPolygon"""
+    polygons = getattr(geometry, 'geoms', [geometry])
+    vertices, codes = [], []
+    for polygon in polygons:
+        if polygon.is_empty or polygon.geom_type != 'Polygon':
+            continue
+        for ring in [polygon.exterior] + list(polygon.interiors):
+            coords = np.asarray(ring.coords)
+            vertices.append(coords)
+            codes.append(np.concatenate([[Path.MOVETO], np.full(len(coords) - 2, Path.LINETO), [Path.CLOSEPOLY]]))
+    if not vertices:
+        return Path(np.zeros((0, 2)))
+    return Path(np.concatenate(vertices), np.concatenate(codes).astype(Path.code_type))
+
+
+def _symbol_rect(x0, y0, x1, y1):
+    return Path([(x0, y0), (x1, y0), (x1, y1), (x0, y1), (x0, y0)],
+                [Path.MOVETO, Path.LINETO, Path.LINETO, Path.LINETO, Path.CLOSEPOLY])
+
+def _symbol_ellipse(cx, cy, rx, ry):
+    return Path.unit_circle().transformed(Affine2D().scale(rx, ry).translate(cx, cy))
+
+def _symbol_line(x0, y0, x1, y1):
+    return Path([(x0, y0), (x1, y1)], [Path.MOVETO, Path.LINETO])
+
+def _symbol(*parts):
+    """Compound symbol Path: unit outline plus category details"""
+    return Path.make_compound_path(_symbol_rect(-0.5, -0.5, 0.5, 0.5), *parts)
+
+# Furniture and fixture symbols in a unit square (x = object width, y = object depth),
+# built once and stamped per object with an affine transform
+OBJECT_SYMBOLS = {
+    'bed': _symbol(_symbol_rect(-0.42, 0.28, -0.05, 0.44), _symbol_rect(0.05, 0.28, 0.42, 0.44),
+                   _symbol_line(-0.5, 0.18, 0.5, 0.18)),
+    'sofa': _symbol(_symbol_rect(-0.5, 0.25, 0.5, 0.5), _symbol_rect(-0.5, -0.5, -0.38, 0.25),
+                    _symbol_rect(0.38, -0.5, 0.5, 0.25)),
+    'chair': _symbol(_symbol_rect(-0.5, 0.32, 0.5, 0.5)),
+    'table': _symbol(_symbol_rect(-0.42, -0.42, 0.42, 0.42)),
+    'toilet': _symbol(_symbol_rect(-0.4, 0.3, 0.4, 0.5), _symbol_ellipse(0, -0.1, 0.3, 0.38)),
+    'sink': _symbol(_symbol_ellipse(0, -0.05, 0.35, 0.3)),
+    'bathtub': _symbol(_symbol_rect(-0.42, -0.4, 0.42, 0.4), _symbol_ellipse(0, -0.3, 0.04, 0.04)),
+    'stove': _symbol(*[_symbol_ellipse(x, y, 0.14, 0.14) for x in (-0.22, 0.22) for y in (-0.22, 0.22)]),
+    'oven': _symbol(_symbol_rect(-0.35, -0.3, 0.35, 0.2), _symbol_line(-0.5, 0.35, 0.5, 0.35)),
+    'refrigerator': _symbol(_symbol_line(-0.5, 0.3, 0.5, 0.3), _symbol_line(-0.5, -0.5, 0.5, 0.3)),
+    'dishwasher': _symbol(_symbol_line(-0.5, 0.3, 0.5, 0.3), _symbol_rect(-0.2, 0.36, 0.2, 0.42)),
+    'washerDryer': _symbol(_symbol_ellipse(0, -0.05, 0.3, 0.3)),
+    'storage': _symbol(_symbol_line(-0.5, -0.5, 0.5, 0.5), _symbol_line(-0.5, 0.5, 0.5, -0.5)),
+    'television': _symbol(_symbol_line(-0.5, 0, 0.5, 0)),
+    'fireplace': _symbol(_symbol_rect(-0.3, -0.5, 0.3, 0.1)),
+    'stairs': _symbol(*[_symbol_line(-0.5, y, 0.5, y) for y in np.linspace(-0.375, 0.375, 7)]),
+    'unknown': _symbol(_symbol_line(-0.5, -0.5, 0.5, 0.5)),
+}
+
+# Opening symbols in a unit frame: x runs along the opening from point_a to point_b,
+# y is perpendicular (door width for the swing, wall thickness for the window)
+DOOR_SWING_SYMBOL = Path.make_compound_path(
+    _symbol_line(0, 0, 0, 1),  # Door leaf opened 90 degrees at the point_a hinge
+    Path.arc(0, 90)  # Swing of the latch edge from point_b to the open leaf
+)
+WINDOW_SYMBOL = Path.make_compound_path(
+    _symbol_rect(0, -0.5, 1, 0.5),  # Frame across the wall thickness
+    _symbol_line(0, -0.08, 1, -0.08),  # Double glazing
+    _symbol_line(0, 0.08, 1, 0.08)
+)
+
+
+def instance_paths(symbol, frames, origins):
+    """Copies of a template Path mapped by per-instance 2x2 frames and origins, sharing the template codes"""
+    vertices = np.einsum('kij,nj->kni', frames, symbol.vertices) + origins[:, None, :]
+    return [Path(instance_vertices, symbol.codes) for instance_vertices in vertices]
+# Object categories that are drawn as walls and openings instead of symbols
+STRUCTURAL_CATEGORIES = ('wall', 'door', 'doorway', 'window', 'opening')
+
+
+def figure_crop_box(fig, ax, pad=8):
+    """Pixel box (top, bottom, left, right) of the drawn axes with title and tick labels"""
+    # Uses the layout of the draw that already happened - no second render like bbox_inches='tight'
+    bbox = ax.get_tightbbox(fig.canvas.get_renderer())
+    width, height = fig.canvas.get_width_height()
+    left = max(0, int(math.floor(bbox.x0)) - pad)
+    right = min(width, int(math.ceil(bbox.x1)) + pad)
+    top = max(0, height - int(math.ceil(bbox.y1)) - pad)
+    bottom = min(height, height - int(math.floor(bbox.y0)) + pad)
+    return top, bottom, left, right
+
+# Limits for uploaded plans, checked before any geometry work
+MAX_PLAN_BYTES = int(os.environ.get('MAX_PLAN_BYTES', 16 * 1024 * 1024))
+MAX_PLAN_ELEMENTS = int(os.environ.get('MAX_PLAN_ELEMENTS', 5000))
+MAX_ELEMENT_SIZE_M = 100.0  # Largest plausible wall/door/window dimension
+MAX_COORDINATE_M = 1000.0  # Largest plausible distance from the scan origin
+PLAN_ARRAYS = ('walls', 'doors', 'windows', 'openings', 'objects', 'sections', 'floors')
+
+class PlanValidationError(ValueError):
+    """Rejected Room Plan payload; path points at the offending field, kind is json/structure/numeric/limit"""
+    
+    def __init__(self, path, message, kind='structure'):
+        super().__init__(f'{path}: {message}')
+        self.path = path
+        self.kind = kind
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+def _check_transform(value, path):
+    if not isinstance(value, list) or len(value) != 16:
+        raise PlanValidationError(path, 'must be a list of 16 numbers (column-major 4x4 matrix)')
+    for index, item in enumerate(value):
+        if not _is_number(item):
+            raise PlanValidationError(f'{path}[{index}]', 'must be a finite number', 'numeric')
+    # Translation column; anything this far from the origin is a corrupt scan
+    for index in (12, 13, 14):
+        if abs(value[index]) > MAX_COORDINATE_M:
+            raise PlanValidationError(f'{path}[{index}]', f'coordinate beyond {MAX_COORDINATE_M:g} m', 'limit')
+
+def _check_vector(value, path, limit):
+    if not isinstance(value, list) or len(value) != 3:
+        raise PlanValidationError(path, 'must be a list of 3 numbers')
+    for index, item in enumerate(value):
+        if not _is_number(item):
+            raise PlanValidationError(f'{path}[{index}]', 'must be a finite number', 'numeric')
+        if abs(item) > limit:
+            raise PlanValidationError(f'{path}[{index}]', f'beyond {limit:g} m', 'limit')
+
+def _check_dimensions(value, path):
+    _check_vector(value, path, MAX_ELEMENT_SIZE_M)
+
+def _check_point(value, path):
+    _check_vector(value, path, MAX_COORDINATE_M)
+
+def _check_points(value, path):
+    if not isinstance(value, list):
+        raise PlanValidationError(path, 'must be a list of points')
+    for index, point in enumerate(value):
+        _check_point(point, f'{path}[{index}]')
+
+def _check_string(value, path):
+    if not isinstance(value, str):
+        raise PlanValidationError(path, 'must be a string')
+
+def _check_optional_string(value, path):
+    if value is not None and not isinstance(value, str):
+        raise PlanValidationError(path, 'must be a string or null')
+
+def _check_story(value, path):
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise PlanValidationError(path, 'must be an integer')
+
+def _check_category(value, path):
+    if not isinstance(value, dict):
+        raise PlanValidationError(path, 'must be an object')
+
+# Field checks per element array: (field, required, check)
+_SURFACE_FIELDS = (('transform', True, _check_transform), ('dimensions', False, _check_dimensions),
+                   ('identifier', False, _check_string), ('parentIdentifier', False, _check_optional_string),
+                   ('category', False, _check_category), ('story', False, _check_story),
+                   ('polygonCorners', False, _check_points))
+PLAN_SCHEMA = {
+    'walls': _SURFACE_FIELDS,
+    'doors': _SURFACE_FIELDS,
+    'windows': _SURFACE_FIELDS,
+    'openings': _SURFACE_FIELDS,
+    'objects': _SURFACE_FIELDS,
+    'floors': (('transform', False, _check_transform), ('dimensions', False, _check_dimensions),
+               ('story', False, _check_story), ('polygonCorners', False, _check_points)),
+    'sections': (('center', False, _check_point), ('label', False, _check_string), ('story', False, _check_story)),
+}
+
+def compile_plan_validator(schema):
+    """Build a single-pass validator for a Room Plan document from per-array field checks"""
+    arrays = [(name, [(field, required, check) for field, required, check in fields]) for name, fields in schema.items()]
+    
+    def validate(document):
+        if not isinstance(document, dict):
+            raise PlanValidationError('$', 'document must be a JSON object')
+        total = 0
+        for name, fields in arrays:
+            elements = document.get(name, [])
+            if not isinstance(elements, list):
+                raise PlanValidationError(name, 'must be a list')
+            total += len(elements)
+            if total > MAX_PLAN_ELEMENTS:
+                raise PlanValidationError(name, f'plan has more than {MAX_PLAN_ELEMENTS} elements', 'limit')
+            for index, element in enumerate(elements):
+                if not isinstance(element, dict):
+                    raise PlanValidationError(f'{name}[{index}]', 'must be an object')
+                for field, required, check in fields:
+                    value = element.get(field)
+                    if value is None:
+                        if required:
+                            raise PlanValidationError(f'{name}[{index}].{field}', 'is required')
+                        continue
+                    check(value, f'{name}[{index}].{field}')
+    
+    return validate
+
+validate_plan_document = compile_plan_validator(PLAN_SCHEMA)
+
+def load_plan_document(json_data):
+    """Decode (if needed) and validate a Room Plan document, raises PlanValidationError"""
+    if isinstance(json_data, str):
+        if len(json_data.encode('utf-8')) > MAX_PLAN_BYTES:
+            raise PlanValidationError('$', f'payload larger than {MAX_PLAN_BYTES} bytes', 'limit')
+        try:
+            json_data = json.loads(json_data)
+        except ValueError as e:
+            raise PlanValidationError('$', f'invalid JSON: {e}', 'json')
+    validate_plan_document(json_data)
+    return json_data
+
+
+# Floors keep document order: floors[0] sets the plan rotation
+SORTED_PLAN_ARRAYS = ('walls', 'doors', 'windows', 'openings', 'objects', 'sections')
+
+def stable_plan_order(data):
+    """Copy of a document with element arrays in canonical order, so permuted uploads hash and draw the same"""
+    ordered = dict(data)
+    for name in SORTED_PLAN_ARRAYS:
+        if isinstance(data.get(name), list):
+            ordered[name] = sorted(data[name], key=canonical_json)
+    return ordered
+
+
+# Render style profiles: colours, line widths, offsets and z-orders. Profiles from the JSON file in
+# STYLE_PROFILES_PATH ({"name": {key: value, ...}}) override the default one key at a time; they are
+# validated and compiled once at import, and requests pick one by name with the 'style' option
+DEFAULT_STYLE_PROFILE = {
+    'page_color': 'white',
+    'background_color': '#FAFAFA',  # Plan area; also hides walls under unattached openings
+    'grid_color': 'gray',
+    'title_color': '#333',
+    'axis_label_color': '#555',
+    'wall_color': '#3E3E3E',
+    'wall_line_width': 22.0,  # Used when the request sets no wall_line_width
+    'dimension_color': '#666666',
+    'dimension_line_width': 1.0,
+    'dimension_offset': 40.0,  # Scaled units from the wall
+    'dimension_arrow_length': 8.0,
+    'dimension_arrow_width': 3.0,
+    'dimension_label_color': '#333',
+    'dimension_label_background': 'white',
+    'dimension_font_size': 10,
+    'window_color': '#888888',
+    'window_line_width': 1.5,
+    'window_symbol_line_width': 1.2,
+    'window_fill_color': 'white',
+    'door_color': '#888888',
+    'door_line_width': 1.5,
+    'door_perpendicular_line_length': 125.0,  # Scaled units
+    'object_fill_color': '#EEEEEE',
+    'object_edge_color': '#8A8A8A',
+    'object_line_width': 0.8,
+    'area_label_color': '#666666',
+    'area_font_size': 11,
+    'room_label_color': '#333',
+    'room_font_size': 14,
+    'room_label_offset': 25.0,  # Scaled units between the area and the room name
+    'diff_added_color': '#2E9E4F',
+    'diff_removed_color': '#D64541',
+    'diff_moved_color': '#F0A202',
+    'diff_line_width': 6.0,
+    'zorder': dict(RENDER_LAYERS),
+}
+
+def compile_style_profile(name, overrides):
+    """Validate a profile merged over the default and prebuild its matplotlib style dicts, raises ValueError"""
+    if not isinstance(overrides, dict):
+        raise ValueError(f"style profile '{name}': must be an object")
+    unknown = sorted(set(overrides) - set(DEFAULT_STYLE_PROFILE))
+    if unknown:
+        raise ValueError(f"style profile '{name}': unknown keys {unknown}")
+    zorder = overrides.get('zorder', {})
+    if not isinstance(zorder, dict) or not set(zorder) <= set(DEFAULT_STYLE_PROFILE['zorder']) \
+            or not all(_is_number(z) for z in zorder.values()):
+        raise ValueError(f"style profile '{name}': zorder must map layer names to numbers")
+    values = dict(DEFAULT_STYLE_PROFILE, **overrides)
+    values['zorder'] = dict(DEFAULT_STYLE_PROFILE['zorder'], **zorder)
+    for key, value in values.items():
+        if key == 'zorder':
+            continue
+        if key.endswith('_color') or key.endswith('_background'):
+            if not isinstance(value, str) or not is_color_like(value):
+                raise ValueError(f"style profile '{name}': {key}: not a colour")
+        elif not _is_number(value) or (value <= 0 and not key.endswith('_offset')):
+            raise ValueError(f"style profile '{name}': {key}: must be a positive number")
+    
+    label_styles = {style: dict(template) for style, template in LABEL_STYLES.items()}
+    for style in label_styles:
+        label_styles[style].update(color=values[f'{style}_label_color'], fontsize=values[f'{style}_font_size'])
+    label_styles['dimension']['bbox'] = dict(label_styles['dimension']['bbox'],
+                                             facecolor=values['dimension_label_background'])
+    return dict(
+        values,
+        name=name,
+        # Content hash: label rasters are shared by profiles that look the same
+        key=hashlib.sha256(canonical_json(values)).hexdigest()[:16],
+        # Layers in drawing (and compositing) order; the sort is stable, so equal z-orders keep RENDER_LAYERS order
+        layers=sorted(values['zorder'].items(), key=lambda layer: layer[1]),
+        label_styles=label_styles,
+        object_style={'facecolor': values['object_fill_color'], 'edgecolor': values['object_edge_color'],
+                      'linewidth': values['object_line_width']},
+        door_swing_style={'facecolor': 'none', 'edgecolor': values['door_color'], 'linewidth': values['door_line_width']},
+        window_symbol_style={'facecolor': values['window_fill_color'], 'edgecolor': values['window_color'],
+                             'linewidth': values['window_symbol_line_width']},
+    )
+
+def load_style_profiles(path):
+    """Default profile plus the profiles of a JSON file (if path is set)"""
+    profiles = {'default': compile_style_profile('default', {})}
+    if path:
+        with open(path, encoding='utf-8') as f:
+            for name, overrides in json.load(f).items():
+                profiles[name] = compile_style_profile(name, overrides)
+    return profiles
+
+STYLE_PROFILES = load_style_profiles(os.environ.get('STYLE_PROFILES_PATH'))
+# Part of every ETag, so editing a profile invalidates renders cached by clients and CDNs
+STYLE_PROFILES_VERSION = hashlib.sha256(
+    canonical_json({name: profile['key'] for name, profile in STYLE_PROFILES.items()})).hexdigest()[:16]
+
+
+# Localization: room name tables, plan titles, units and font fallback chains per locale. Locales from the
+# JSON file in LOCALES_PATH ({"code": {key: value, ...}}) extend or override the built-in ones; everything
+# is compiled once at import and requests pick a locale with the 'locale' option
+DEFAULT_LOCALE = DEFAULT_RENDER_OPTIONS['locale']
+FALLBACK_FONT = 'DejaVu Sans'  # Ships with matplotlib, covers Latin, Cyrillic and Greek
+LOCALE_KEYS = ('title', 'x_label', 'y_label', 'length_unit', 'area_unit', 'rooms', 'exact_room_names',
+               'fonts', 'font_files')
+UKRAINIAN_ROOM_NAMES = {
+    'BATHROOM': 'ВАННА КІМНАТА',
+    'BEDROOM': 'СПАЛЬНЯ',
+    'KITCHEN': 'КУХНЯ',
+    'LIVING ROOM': 'ВІТАЛЬНЯ',
+    'DINING ROOM': 'ЇДАЛЬНЯ',
+    'HALL': 'ХОЛ',
+    'CORRIDOR': 'КОРИДОР',
+    'ROOM': 'КІМНАТА',
+    'OFFICE': 'ОФІС',
+    'STUDY': 'КАБІНЕТ',
+    'CLOSET': 'ШАФА',
+    'STORAGE': 'КОМОРА',
+    'GARAGE': 'ГАРАЖ',
+    'BALCONY': 'БАЛКОН',
+    'TERRACE': 'ТЕРАСА',
+    'ENTRANCE': 'ВХІД',
+    'HALLWAY': 'ПЕРЕДПОКІЙ',
+}
+BUILTIN_LOCALES = {
+    'en': {
+        'title': 'Architectural Plan',
+        'x_label': 'X (scaled)',
+        'y_label': 'Y (scaled)',
+        'length_unit': 'm',
+        'area_unit': 'm²',
+        'rooms': {'LIVING ROOM': 'LIVING ROOM', 'DINING ROOM': 'DINING ROOM'},
+        'exact_room_names': False,  # True: match labels as-is (upper case), without the room_key normalization
+        'fonts': [FALLBACK_FONT],
+        'font_files': [],
+    },
+    # Pre-locale output, so renders only change when a client opts into a locale: English title, axes and
+    # length unit, 'м²' and Ukrainian room names matched exactly; 'default-en' is label_language 'en'
+    'default': {
+        'area_unit': 'м²',
+        'rooms': UKRAINIAN_ROOM_NAMES,
+        'exact_room_names': True,
+    },
+    'default-en': {
+        'area_unit': 'м²',
+        'rooms': {},
+        'exact_room_names': True,
+    },
+    'uk': {
+        'title': 'Архітектурний план',
+        'x_label': 'X (у масштабі)',
+        'y_label': 'Y (у масштабі)',
+        'length_unit': 'м',
+        'area_unit': 'м²',
+        'rooms': UKRAINIAN_ROOM_NAMES,
+    },
+    'ru': {
+        'title': 'Архитектурный план',
+        'x_label': 'X (в масштабе)',
+        'y_label': 'Y (в масштабе)',
+        'length_unit': 'м',
+        'area_unit': 'м²',
+        'rooms': {
+            'BATHROOM': 'ВАННАЯ',
+            'BEDROOM': 'СПАЛЬНЯ',
+            'KITCHEN': 'КУХНЯ',
+            'LIVING ROOM': 'ГОСТИНАЯ',
+            'DINING ROOM': 'СТОЛОВАЯ',
+            'HALL': 'ХОЛЛ',
+            'CORRIDOR': 'КОРИДОР',
+            'ROOM': 'КОМНАТА',
+            'OFFICE': 'ОФИС',
+            'STUDY': 'КАБИНЕТ',
+            'CLOSET': 'ШКАФ',
+            'STORAGE': 'КЛАДОВАЯ',
+            'GARAGE': 'ГАРАЖ',
+            'BALCONY': 'БАЛКОН',
+            'TERRACE': 'ТЕРРАСА',
+            'ENTRANCE': 'ВХОД',
+            'HALLWAY': 'ПРИХОЖАЯ',
+        },
+    },
+    'pl': {
+        'title': 'Plan architektoniczny',
+        'x_label': 'X (w skali)',
+        'y_label': 'Y (w skali)',
+        'rooms': {
+            'BATHROOM': 'ŁAZIENKA',
+            'BEDROOM': 'SYPIALNIA',
+            'KITCHEN': 'KUCHNIA',
+            'LIVING ROOM': 'SALON',
+            'DINING ROOM': 'JADALNIA',
+            'HALL': 'HOL',
+            'CORRIDOR': 'KORYTARZ',
+            'ROOM': 'POKÓJ',
+            'OFFICE': 'BIURO',
+            'STUDY': 'GABINET',
+            'CLOSET': 'SZAFA',
+            'STORAGE': 'SCHOWEK',
+            'GARAGE': 'GARAŻ',
+            'BALCONY': 'BALKON',
+            'TERRACE': 'TARAS',
+            'ENTRANCE': 'WEJŚCIE',
+            'HALLWAY': 'PRZEDPOKÓJ',
+        },
+    },
+    'de': {
+        'title': 'Architekturplan',
+        'x_label': 'X (skaliert)',
+        'y_label': 'Y (skaliert)',
+        'rooms': {
+            'BATHROOM': 'BADEZIMMER',
+            'BEDROOM': 'SCHLAFZIMMER',
+            'KITCHEN': 'KÜCHE',
+            'LIVING ROOM': 'WOHNZIMMER',
+            'DINING ROOM': 'ESSZIMMER',
+            'HALL': 'DIELE',
+            'CORRIDOR': 'FLUR',
+            'ROOM': 'ZIMMER',
+            'OFFICE': 'BÜRO',
+            'STUDY': 'ARBEITSZIMMER',
+            'CLOSET': 'SCHRANK',
+            'STORAGE': 'ABSTELLRAUM',
+            'GARAGE': 'GARAGE',
+            'BALCONY': 'BALKON',
+            'TERRACE': 'TERRASSE',
+            'ENTRANCE': 'EINGANG',
+            'HALLWAY': 'VORRAUM',
+        },
+    },
+}
+
+def room_key(name):
+    """Lookup key of a room label: 'livingRoom', 'LIVING ROOM' and 'living_room' are the same room"""
+    return ''.join(ch for ch in name.upper() if ch.isalnum())
+
+def compile_locale(code, overrides):
+    """Validate a locale merged over its built-in table (or English) and resolve its font chain, raises ValueError"""
+    if not isinstance(overrides, dict):
+        raise ValueError(f"locale '{code}': must be an object")
+    unknown = sorted(set(overrides) - set(LOCALE_KEYS))
+    if unknown:
+        raise ValueError(f"locale '{code}': unknown keys {unknown}")
+    base = dict(BUILTIN_LOCALES['en'], **BUILTIN_LOCALES.get(code, {}))
+    values = dict(base, **overrides)
+    for key in ('title', 'x_label', 'y_label', 'length_unit', 'area_unit'):
+        if not isinstance(values[key], str):
+            raise ValueError(f"locale '{code}': {key}: must be a string")
+    rooms = values['rooms']
+    if not isinstance(rooms, dict) or not all(isinstance(v, str) for v in rooms.values()):
+        raise ValueError(f"locale '{code}': rooms must map room labels to strings")
+    if not isinstance(values['exact_room_names'], bool):
+        raise ValueError(f"locale '{code}': exact_room_names must be true or false")
+    for key in ('fonts', 'font_files'):
+        if not isinstance(values[key], list) or not all(isinstance(v, str) for v in values[key]):
+            raise ValueError(f"locale '{code}': {key} must be a list of strings")
+    
+    for path in values['font_files']:
+        try:
+            font_manager.fontManager.addfont(path)
+        except (OSError, RuntimeError) as e:
+            raise ValueError(f"locale '{code}': font file {path}: {e}")
+    # Fallback chain of installed fonts only; matplotlib falls back per glyph along the chain
+    installed = {font.name for font in font_manager.fontManager.ttflist}
+    fonts = [font for font in values['fonts'] if font in installed]
+    missing = [font for font in values['fonts'] if font not in installed]
+    if missing:
+        print(f"⚠️  Locale '{code}': fonts not installed, skipped: {missing}")
+    if FALLBACK_FONT not in fonts:
+        fonts.append(FALLBACK_FONT)
+    
+    compiled = dict(
+        values,
+        # Built-in rooms stay translated when a file only adds or overrides a few of them
+        rooms={label.upper() if values['exact_room_names'] else room_key(label): name
+               for label, name in dict(base['rooms'], **rooms).items()},
+        fonts=tuple(fonts),
+    )
+    del compiled['font_files']
+    return dict(compiled, code=code, key=hashlib.sha256(canonical_json(compiled)).hexdigest()[:16])
+
+def load_locales(path):
+    """Built-in locales plus the locales of a JSON file (if path is set)"""
+    locales = {code: compile_locale(code, {}) for code in BUILTIN_LOCALES}
+    if path:
+        with open(path, encoding='utf-8') as f:
+            for code, overrides in json.load(f).items():
+                locales[code.lower()] = compile_locale(code.lower(), overrides)
+    return locales
+
+def resolve_locale(value):
+    """Known locale for a request value: exact code first, then its language ('uk-UA' -> 'uk'), else None"""
+    if not isinstance(value, str):
+        return None
+    code = value.strip().lower().replace('_', '-')
+    for candidate in (code, code.split('-')[0]):
+        if candidate in LOCALES:
+            return candidate
+    return None
+
+LOCALES = load_locales(os.environ.get('LOCALES_PATH'))
+LEGACY_LABEL_LANGUAGES = {'uk': 'default', 'en': 'default-en'}
+# Part of every ETag, like the style profile version
+LOCALES_VERSION = hashlib.sha256(
+    canonical_json({code: locale['key'] for code, locale in LOCALES.items()})).hexdigest()[:16]
+
 
 class RoomPlanWallExtractor:
     def __init__(self):
@@ -29,35 +1020,29 @@ class RoomPlanWallExtractor:
         self.openings = []
         self.fig = None
         self.ax = None
+        self._figure_lock = threading.Lock()
+        self._canvas = LAYER_CANVAS
+        # Rotated plan geometry, computed once by prepare_geometry()
+        self.geometry = None
+        # Parsed document and its content hash (plan id, key for layer caches)
+        self.document = None
+        self.plan_hash = None
+        # PlanValidationError from the last failed parse_room_plan_api call
+        self.parse_error = None
+        # STRtree over rotated elements, built lazily for tile rendering
+        self._spatial_index = None
+        # Wall thickness polygons by wall_line_width
+        self._wall_outlines = {}
         # Scaling factor (like SpriteKit example uses 200)
         self.scaling_factor = 200.0
         # Rotation angle will be calculated automatically from floor transform
         self.plan_rotation = 0.0  # Will be calculated in calculate_plan_rotation()
         
-    def translate_room_name(self, room_name):
-        """Translate room name to Ukrainian"""
-        translations = {
-            'BATHROOM': 'ВАННА КІМНАТА',
-            'BEDROOM': 'СПАЛЬНЯ',
-            'KITCHEN': 'КУХНЯ',
-            'LIVING ROOM': 'ВІТАЛЬНЯ',
-            'DINING ROOM': 'ЇДАЛЬНЯ',
-            'HALL': 'ХОЛ',
-            'CORRIDOR': 'КОРИДОР',
-            'ROOM': 'КІМНАТА',
-            'OFFICE': 'ОФІС',
-            'STUDY': 'КАБІНЕТ',
-            'CLOSET': 'ШАФА',
-            'STORAGE': 'КОМОРА',
-            'GARAGE': 'ГАРАЖ',
-            'BALCONY': 'БАЛКОН',
-            'TERRACE': 'ТЕРАСА',
-            'ENTRANCE': 'ВХІД',
-            'HALLWAY': 'ПЕРЕДПОКІЙ',
-        }
-        
+    def translate_room_name(self, room_name, locale=DEFAULT_LOCALE):
+        """Translate room name with the precompiled table of a locale"""
+        locale = LOCALES[locale]
         room_upper = room_name.upper()
-        return translations.get(room_upper, room_upper)
+        return locale['rooms'].get(room_upper if locale['exact_room_names'] else room_key(room_upper), room_upper)
     
     def calculate_plan_rotation(self):
         """Calculate rotation angle from floor transform (like Flutter code)"""
@@ -77,16 +1062,28 @@ class RoomPlanWallExtractor:
         
         # Calculate angle like Flutter code
         angle1 = -np.arctan2(transform_0, transform_2) - np.pi / 2
+        if DETERMINISTIC_RENDER:
+            angle1 = float(quantize(angle1, ANGLE_QUANTUM))
         
         return angle1
         
     def parse_room_plan_api(self, json_data):
-        """Parse Room Plan API JSON"""
+        """Parse Room Plan API JSON; on invalid input returns False and sets parse_error"""
         try:
-            if isinstance(json_data, str):
-                data = json.loads(json_data)
-            else:
-                data = json_data
+            data = load_plan_document(json_data)
+        except PlanValidationError as error:
+            print(f"Rejected plan: {error}")
+            self.parse_error = error
+            return False
+        if DETERMINISTIC_RENDER:
+            data = stable_plan_order(data)
+        try:
+            # Hash of the canonical form, so the same scan uploaded with different formatting dedupes
+            self.document = data
+            self.plan_hash = hashlib.sha256(canonical_json(data)).hexdigest()
+            self.geometry = None
+            self._spatial_index = None
+            self._wall_outlines = {}
                 
             # Parse main arrays - walls are in separate 'walls' array
             self.objects = data.get('objects', [])
@@ -149,6 +1146,8 @@ class RoomPlanWallExtractor:
         euler_x = np.arcsin(-rot[2][1])
         euler_y = np.arctan2(rot[2][0], rot[2][2])
         euler_z = np.arctan2(rot[0][1], rot[1][1])
+        if DETERMINISTIC_RENDER:
+            return quantize([euler_x, euler_y, euler_z], ANGLE_QUANTUM)
         return np.array([euler_x, euler_y, euler_z])
     
     
@@ -213,69 +1212,58 @@ class RoomPlanWallExtractor:
         
         return wall_segments
     
-    def normalize_wall_angles(self, wall_segments, threshold_degrees=5.0):
-        """Normalize wall angles - if deviation is small, align to axes (0°, 90°, 180°, 270°)"""
-        threshold_rad = np.deg2rad(threshold_degrees)
+    def dominant_orientation(self, wall_segments, bin_degrees=1.0):
+        """Plan orientation in [0, pi/2) from a length-weighted histogram of wall angles"""
+        if len(wall_segments) == 0:
+            return 0.0
+        angles = np.array([segment['rotation'] for segment in wall_segments], dtype=float)
+        weights = np.array([segment['length'] for segment in wall_segments], dtype=float)
+        
+        # Walls at 90 degrees to each other share an orientation: fold angles into [0, pi/2)
+        bins = int(round(90.0 / bin_degrees))
+        folded = np.mod(angles, np.pi / 2)
+        histogram = np.bincount((folded / (np.pi / 2) * bins).astype(int) % bins, weights=weights, minlength=bins)
+        smoothed = histogram + np.roll(histogram, 1) + np.roll(histogram, -1)
+        peak = (np.argmax(smoothed) + 0.5) * np.pi / 2 / bins
+        
+        # Refine with the weighted circular mean (period pi/2) of walls near the peak
+        offsets = np.mod(folded - peak + np.pi / 4, np.pi / 2) - np.pi / 4
+        near = np.abs(offsets) <= 3 * np.pi / 2 / bins
+        if not np.any(near):
+            return float(peak)
+        refined = peak + np.arctan2(np.sum(weights[near] * np.sin(4 * offsets[near])),
+                                    np.sum(weights[near] * np.cos(4 * offsets[near]))) / 4
+        return float(np.mod(refined, np.pi / 2))
+    
+    def normalize_wall_angles(self, wall_segments, threshold_degrees=5.0, orientation=None):
+        """Snap segment angles to the plan's dominant orientation (every 90 degrees) in one array pass"""
+        if len(wall_segments) == 0:
+            return wall_segments
+        if orientation is None:
+            orientation = self.dominant_orientation(wall_segments)
+        
+        rotations = np.array([segment['rotation'] for segment in wall_segments], dtype=float)
+        centers = np.array([segment['center'] for segment in wall_segments], dtype=float)
+        half_lengths = np.array([np.linalg.norm(segment['point_b'] - segment['point_a']) / 2.0
+                                 for segment in wall_segments])
         
-        # Main axis angles: 0, π/2, π, 3π/2 (0°, 90°, 180°, 270°)
-        axis_angles = [0, np.pi/2, np.pi, 3*np.pi/2]
+        # Signed deviation from the nearest orientation axis (orientation + k * 90 degrees)
+        deviation = np.mod(rotations - orientation + np.pi / 4, np.pi / 2) - np.pi / 4
+        snapped = np.where(np.abs(deviation) < np.deg2rad(threshold_degrees), rotations - deviation, rotations)
+        
+        # Rebuild endpoints around the unchanged centers
+        offsets = np.stack([np.cos(snapped), np.sin(snapped)], axis=1) * half_lengths[:, None]
+        points_a = centers - offsets
+        points_b = centers + offsets
         
         normalized_segments = []
-        for segment in wall_segments:
-            rotation = segment['rotation']
-            center = np.array(segment['center'])
-            length = segment['length'] * self.scaling_factor
-            
-            # Normalize rotation to [0, 2π)
-            rotation_normalized = rotation % (2 * np.pi)
-            if rotation_normalized < 0:
-                rotation_normalized += 2 * np.pi
-            
-            # Find closest axis angle
-            min_diff = float('inf')
-            closest_axis = rotation_normalized
-            
-            for axis_angle in axis_angles:
-                # Calculate difference (considering wrap-around)
-                diff1 = abs(rotation_normalized - axis_angle)
-                diff2 = abs(rotation_normalized - axis_angle + 2*np.pi)
-                diff3 = abs(rotation_normalized - axis_angle - 2*np.pi)
-                diff = min(diff1, diff2, diff3)
-                
-                if diff < min_diff:
-                    min_diff = diff
-                    closest_axis = axis_angle
-            
-            # If deviation is small, use normalized angle
-            if min_diff < threshold_rad:
-                normalized_rotation = closest_axis
-            else:
-                normalized_rotation = rotation
-            
-            # Recalculate points with normalized rotation
-            half_length = length / 2.0
-            point_a_local = np.array([-half_length, 0])
-            point_b_local = np.array([half_length, 0])
-            
-            cos_r = np.cos(normalized_rotation)
-            sin_r = np.sin(normalized_rotation)
-            rot_matrix = np.array([[cos_r, -sin_r], [sin_r, cos_r]])
-            
-            point_a_rotated = rot_matrix @ point_a_local
-            point_b_rotated = rot_matrix @ point_b_local
-            
-            point_a = center + point_a_rotated
-            point_b = center + point_b_rotated
-            
-            normalized_segments.append({
-                'point_a': point_a,
-                'point_b': point_b,
-                'center': center,
-                'length': segment['length'],
-                'rotation': normalized_rotation,
-                'transform': segment['transform'],
-                'category': segment['category']
-            })
+        for i, segment in enumerate(wall_segments):
+            normalized = dict(segment)
+            normalized['point_a'] = points_a[i]
+            normalized['point_b'] = points_b[i]
+            normalized['center'] = centers[i]
+            normalized['rotation'] = float(snapped[i])
+            normalized_segments.append(normalized)
         
         return normalized_segments
     
@@ -471,6 +1459,33 @@ class RoomPlanWallExtractor:
         
         return doors
     
+    def extract_object_footprints(self):
+        """Furniture and fixtures from 'objects' as footprint frames: center plus width/depth axes"""
+        objects = []
+        
+        for obj in self.objects:
+            category = obj.get('category', {})
+            obj_type = next(iter(category), 'unknown') if category else 'unknown'
+            transform = obj.get('transform', [])
+            if obj_type in STRUCTURAL_CATEGORIES or len(transform) < 16:
+                continue
+            
+            dims = obj.get('dimensions', [0.5, 0.5, 0.5])
+            # Local x (width) and z (depth) axes in plan coordinates, with the same (-x, z) mapping as walls
+            axis_x = np.array([-transform[0], transform[2]]) * abs(dims[0]) * self.scaling_factor
+            axis_z = np.array([-transform[8], transform[10]]) * abs(dims[2]) * self.scaling_factor
+            
+            objects.append({
+                'center': np.array([-transform[12] * self.scaling_factor, transform[14] * self.scaling_factor]),
+                'axes': np.column_stack([axis_x, axis_z]),
+                'width': abs(dims[0]),
+                'depth': abs(dims[2]),
+                'id': obj.get('identifier'),
+                'category': obj_type
+            })
+        
+        return objects
+    
     def extract_window_positions(self):
         """Extract window positions as lines (like SpriteKit approach)"""
         windows = []
@@ -521,6 +1536,7 @@ class RoomPlanWallExtractor:
                 'point_b': point_b,
                 'center': [pos_2d_x, pos_2d_y],
                 'width': window_width,
+                'height': abs(dims[1]) if len(dims) > 1 else 1.5,
                 'rotation': rotation,
                 'transform': transform,
                 'parent_id': window.get('parentIdentifier'),
@@ -529,14 +1545,11 @@ class RoomPlanWallExtractor:
         
         return windows
     
-    def calculate_room_area(self, section, wall_segments, threshold_distance=500.0):
-        """Calculate room area by finding walls near the room center and building a polygon"""
-        from shapely.geometry import Polygon, Point
-        from shapely.ops import unary_union
-        
+    def calculate_room_polygon(self, section, wall_segments, threshold_distance=500.0):
+        """Build room polygon (scaled units) from walls near the room center, None if not possible"""
         center_3d = section.get('center', [0, 0, 0])
         if len(center_3d) < 3:
-            return 0.0
+            return None
         
         # Convert section center to 2D coordinates
         pos_2d_x = -center_3d[0] * self.scaling_factor
@@ -561,7 +1574,7 @@ class RoomPlanWallExtractor:
                 nearby_walls.append(segment)
         
         if len(nearby_walls) < 3:
-            return 0.0
+            return None
         
         # Collect all wall endpoints
         all_points = []
@@ -573,26 +1586,16 @@ class RoomPlanWallExtractor:
         unique_points = list(set(all_points))
         
         if len(unique_points) < 3:
-            return 0.0
+            return None
         
         # Try to create a polygon from the points
         # Use convex hull as a simple approach
         try:
-            from scipy.spatial import ConvexHull
             points_array = np.array(unique_points)
             hull = ConvexHull(points_array)
             
             # Get hull vertices
-            hull_points = points_array[hull.vertices]
-            
-            # Create polygon
-            polygon = Polygon(hull_points)
-            
-            # Calculate area in scaled units, then convert to square meters
-            area_scaled = polygon.area
-            area_m2 = area_scaled / (self.scaling_factor ** 2)
-            
-            return area_m2
+            return Polygon(points_array[hull.vertices])
         except Exception as e:
             # Fallback: try simple polygon from points sorted by angle
             try:
@@ -603,13 +1606,9 @@ class RoomPlanWallExtractor:
                 sorted_indices = np.argsort(angles)
                 sorted_points = [unique_points[i] for i in sorted_indices]
                 
-                polygon = Polygon(sorted_points)
-                area_scaled = polygon.area
-                area_m2 = area_scaled / (self.scaling_factor ** 2)
-                
-                return area_m2
+                return Polygon(sorted_points)
             except:
-                return 0.0
+                return None
     
     def extract_opening_positions(self):
         """Extract opening positions as lines (like SpriteKit approach)"""
@@ -654,99 +1653,45 @@ class RoomPlanWallExtractor:
                 'width': opening_width,
                 'rotation': rotation,
                 'transform': transform,
+                'parent_id': opening.get('parentIdentifier'),
                 'category': 'opening'
             })
         
         return openings
     
-    def get_bounds(self):
-        """Get bounds from walls and sections"""
-        wall_segments = self.get_wall_segments()
-        doors = self.extract_door_positions()
-        windows = self.extract_window_positions()
-        openings = self.extract_opening_positions()
-        
-        all_points = []
-        for segment in wall_segments:
-            all_points.append(segment['point_a'])
-            all_points.append(segment['point_b'])
-        
-        for door in doors:
-            all_points.append(door['point_a'])
-            all_points.append(door['point_b'])
-        
-        for window in windows:
-            all_points.append(window['point_a'])
-            all_points.append(window['point_b'])
-        
-        for opening in openings:
-            all_points.append(opening['point_a'])
-            all_points.append(opening['point_b'])
-        
-        for section in self.sections:
-            center = section.get('center', [0, 0, 0])
-            if len(center) >= 3:
-                # Convert section center to 2D coordinates
-                pos_2d_x = -center[0] * self.scaling_factor
-                pos_2d_y = center[2] * self.scaling_factor
-                all_points.append([pos_2d_x, pos_2d_y])
-        
-        if len(all_points) == 0:
-            return {'minX': -1000, 'maxX': 1000, 'minY': -1000, 'maxY': 1000}
-        
-        points_array = np.array(all_points)
-        padding = 200  # Padding in scaled units
+    def prepare_geometry(self):
+        """Compute rotated plan geometry (walls, doors, windows, openings, bounds) without drawing"""
+        if self.geometry is not None:
+            return self.geometry
         
-        return {
-            'minX': float(np.min(points_array[:, 0])) - padding,
-            'maxX': float(np.max(points_array[:, 0])) + padding,
-            'minY': float(np.min(points_array[:, 1])) - padding,
-            'maxY': float(np.max(points_array[:, 1])) + padding
-        }
-    
-    
-    def generate_floor_plan(self, wall_line_width=None):
-        """Generate floor plan using SpriteKit-like approach: walls as lines"""
         # Calculate rotation angle from floor transform (like Flutter code)
         self.plan_rotation = self.calculate_plan_rotation()
         
-        # Create figure first (bounds will be recalculated after rotation)
-        self.fig, self.ax = plt.subplots(figsize=(16, 14), dpi=120)
-        self.ax.invert_yaxis()
-        self.ax.set_aspect('equal')
-        self.ax.grid(True, alpha=0.15, linestyle=':', linewidth=0.5, color='gray')
-        self.ax.set_facecolor('#FAFAFA')
-        self.ax.set_title('Architectural Plan', fontsize=20, fontweight='bold', pad=25, color='#333')
-        self.ax.set_xlabel('X (scaled)', fontsize=13, color='#555')
-        self.ax.set_ylabel('Y (scaled)', fontsize=13, color='#555')
-        
         # Get all elements
         wall_segments = self.get_wall_segments()
         
-        # Normalize wall angles (straighten walls that are close to axes) - disabled for now
-        # wall_segments = self.normalize_wall_angles(wall_segments, threshold_degrees=2.0)
-        
         # Merge collinear wall segments (combine segments on the same line) - disabled for now
         # wall_segments = self.merge_collinear_walls(wall_segments, threshold_distance=30.0, threshold_angle_degrees=1.0)
         
         doors = self.extract_door_positions()
         windows = self.extract_window_positions()
         openings = self.extract_opening_positions()
+        objects = self.extract_object_footprints()
+        
+        # Straighten walls close to the plan's dominant orientation; openings use the same
+        # orientation so they stay on their walls
+        if WALL_SNAP_DEGREES > 0:
+            orientation = self.dominant_orientation(wall_segments)
+            wall_segments = self.normalize_wall_angles(wall_segments, WALL_SNAP_DEGREES, orientation)
+            doors = self.normalize_wall_angles(doors, WALL_SNAP_DEGREES, orientation)
+            windows = self.normalize_wall_angles(windows, WALL_SNAP_DEGREES, orientation)
+            openings = self.normalize_wall_angles(openings, WALL_SNAP_DEGREES, orientation)
         
         # Calculate center of plan for rotation
         all_points_for_center = []
-        for segment in wall_segments:
-            all_points_for_center.append(segment['point_a'])
-            all_points_for_center.append(segment['point_b'])
-        for door in doors:
-            all_points_for_center.append(door['point_a'])
-            all_points_for_center.append(door['point_b'])
-        for window in windows:
-            all_points_for_center.append(window['point_a'])
-            all_points_for_center.append(window['point_b'])
-        for opening in openings:
-            all_points_for_center.append(opening['point_a'])
-            all_points_for_center.append(opening['point_b'])
+        for element in wall_segments + doors + windows + openings:
+            all_points_for_center.append(element['point_a'])
+            all_points_for_center.append(element['point_b'])
         
         if len(all_points_for_center) > 0:
             points_array = np.array(all_points_for_center)
@@ -757,7 +1702,7 @@ class RoomPlanWallExtractor:
         # Store plan center for use in label rotation
         self._plan_center = plan_center
         
-        # Apply plan rotation (45 degrees clockwise) to all points relative to plan center
+        # Apply plan rotation to all points relative to plan center
         cos_plan = np.cos(self.plan_rotation)
         sin_plan = np.sin(self.plan_rotation)
         rot_plan = np.array([[cos_plan, -sin_plan], [sin_plan, cos_plan]])
@@ -765,135 +1710,398 @@ class RoomPlanWallExtractor:
         # Store rot_plan for use in label rotation
         self._rot_plan = rot_plan
         
-        # Rotate all wall segments
-        for segment in wall_segments:
-            segment['point_a'] = rot_plan @ (segment['point_a'] - plan_center) + plan_center
-            segment['point_b'] = rot_plan @ (segment['point_b'] - plan_center) + plan_center
+        # Rotate all walls, doors, windows and openings
+        for element in wall_segments + doors + windows + openings:
+            element['point_a'] = rot_plan @ (element['point_a'] - plan_center) + plan_center
+            element['point_b'] = rot_plan @ (element['point_b'] - plan_center) + plan_center
+            if 'point_c' in element:
+                element['point_c'] = rot_plan @ (element['point_c'] - plan_center) + plan_center
+        for obj in objects:
+            obj['center'] = rot_plan @ (obj['center'] - plan_center) + plan_center
+            obj['axes'] = rot_plan @ obj['axes']
         
-        # Rotate all doors
-        for door in doors:
-            door['point_a'] = rot_plan @ (door['point_a'] - plan_center) + plan_center
-            door['point_b'] = rot_plan @ (door['point_b'] - plan_center) + plan_center
-            if 'point_c' in door:
-                door['point_c'] = rot_plan @ (door['point_c'] - plan_center) + plan_center
+        if DETERMINISTIC_RENDER:
+            # sin/cos/arctan2 may differ in the last bit between CPUs and libm builds
+            for element in wall_segments + doors + windows + openings:
+                for key in ('point_a', 'point_b', 'point_c'):
+                    if key in element:
+                        element[key] = quantize(element[key])
+            for obj in objects:
+                obj['center'] = quantize(obj['center'])
+                obj['axes'] = quantize(obj['axes'])
         
-        # Rotate all windows
-        for window in windows:
-            window['point_a'] = rot_plan @ (window['point_a'] - plan_center) + plan_center
-            window['point_b'] = rot_plan @ (window['point_b'] - plan_center) + plan_center
-        
-        # Rotate all openings
-        for opening in openings:
-            opening['point_a'] = rot_plan @ (opening['point_a'] - plan_center) + plan_center
-            opening['point_b'] = rot_plan @ (opening['point_b'] - plan_center) + plan_center
-        
-        # Recalculate bounds after rotation
-        bounds = self.get_bounds()
-        self.ax.set_xlim(bounds['minX'], bounds['maxX'])
-        self.ax.set_ylim(bounds['minY'], bounds['maxY'])
-        
-        # Define colors and line widths (like SpriteKit example)
-        wall_color = '#3E3E3E'
-        if wall_line_width is None:
-            wall_line_width = 22.0  # Default like surfaceWidth in SpriteKit
-        window_line_width = 8.0  # Same width for windows and doors
-        background_color = '#FAFAFA'
-        door_perpendicular_line_length = 125.0  # Fixed length for door perpendicular lines (in scaled units) - 25% longer
-        
-        # Z-order values (higher = on top)
-        z_dimension = -1  # Dimensions behind walls
-        z_wall = 0
-        z_hide_surface = 1
-        z_window = 10
-        z_door = 10  # Same z-order as windows
-        z_label = 30
-        
-        # Step 1: Draw walls as lines (like SpriteKit)
-        for segment in wall_segments:
-            point_a = segment['point_a']
-            point_b = segment['point_b']
-            self.ax.plot([point_a[0], point_b[0]], [point_a[1], point_b[1]],
-                        color=wall_color, linewidth=wall_line_width, 
-                        zorder=z_wall, solid_capstyle='projecting')
-            
-            # Calculate wall length in meters
-            wall_length_m = segment.get('length', np.linalg.norm(point_b - point_a) / self.scaling_factor)
-            
-            # Calculate wall direction and perpendicular
-            wall_dir = point_b - point_a
-            wall_length_px = np.linalg.norm(wall_dir)
-            if wall_length_px < 1e-6:
+        # Host walls are cut into solid pieces once; openings keep their wall_id (None when unattached)
+        solid_walls = self.cut_solid_walls(wall_segments, self.attach_openings(wall_segments, doors + windows + openings))
+        
+        # Room label positions (section centers rotated like the rest of the plan)
+        labels = []
+        for section in self.sections:
+            center_3d = section.get('center', [0, 0, 0])
+            if len(center_3d) >= 3:
+                center_2d = np.array([-center_3d[0] * self.scaling_factor, center_3d[2] * self.scaling_factor])
+                polygon = self.calculate_room_polygon(section, wall_segments, threshold_distance=500.0)
+                label_center = rot_plan @ (center_2d - plan_center) + plan_center
+                labels.append({
+                    'center': quantize(label_center) if DETERMINISTIC_RENDER else label_center,
+                    'label': section.get('label', 'Room'),
+                    'polygon': polygon,
+                    'area': polygon.area / (self.scaling_factor ** 2) if polygon is not None else 0.0
+                })
+        
+        # Bounds are taken from the rotated geometry so rotated plans are not clipped
+        bounds_points = [label['center'] for label in labels]
+        for element in wall_segments + doors + windows + openings:
+            bounds_points.append(element['point_a'])
+            bounds_points.append(element['point_b'])
+        for obj in objects:
+            bounds_points.extend(self.object_corners(obj))
+        
+        self.geometry = {
+            'walls': wall_segments,
+            'solid_walls': solid_walls,
+            'doors': doors,
+            'windows': windows,
+            'openings': openings,
+            'objects': objects,
+            'labels': labels,
+            'bounds': self._bounds_from_points(bounds_points)
+        }
+        return self.geometry
+    
+    def attach_openings(self, walls, elements):
+        """Map doors, windows and openings to host walls, returns {wall position: [(start, end) along the wall]}"""
+        # The host comes from an O(1) parentIdentifier lookup; only elements without a known parent
+        # query the STRtree for the nearest parallel wall. The cut goes to the host and its duplicates
+        positions = {wall['id']: position for position, wall in enumerate(walls)}
+        index = {}
+        duplicates = {}
+        max_distance = OPENING_ATTACH_DISTANCE * self.scaling_factor
+        cuts = {}
+        for element in elements:
+            element['wall_id'] = None
+            along = element['point_b'] - element['point_a']
+            if np.linalg.norm(along) < 1e-6 or not walls:
                 continue
             
-            wall_dir_norm = wall_dir / wall_length_px
-            perp_dir = np.array([-wall_dir_norm[1], wall_dir_norm[0]])  # Perpendicular to wall
-            
-            # Offset distance for dimension line (away from wall)
-            dimension_offset = 40.0  # Distance from wall in pixels
-            
-            # Calculate dimension line position (parallel to wall, offset perpendicularly)
-            dim_line_start = point_a + perp_dir * dimension_offset
-            dim_line_end = point_b + perp_dir * dimension_offset
-            
-            # Draw dimension line (thin line parallel to wall) - behind walls
-            dimension_color = '#666666'
-            dimension_linewidth = 1.0
-            self.ax.plot([dim_line_start[0], dim_line_end[0]], 
-                        [dim_line_start[1], dim_line_end[1]],
-                        color=dimension_color, linewidth=dimension_linewidth,
-                        zorder=z_dimension, linestyle='-')
-            
-            # Draw extension lines (perpendicular lines from wall edge to dimension line) - behind walls
-            # Extension lines start from wall edges and go to dimension line
-            ext_start_a = point_a  # Start from wall edge
-            ext_end_a = dim_line_start  # End at dimension line
-            ext_start_b = point_b  # Start from wall edge
-            ext_end_b = dim_line_end  # End at dimension line
-            
-            self.ax.plot([ext_start_a[0], ext_end_a[0]], 
-                        [ext_start_a[1], ext_end_a[1]],
-                        color=dimension_color, linewidth=dimension_linewidth,
-                        zorder=z_dimension, linestyle='-')
-            self.ax.plot([ext_start_b[0], ext_end_b[0]], 
-                        [ext_start_b[1], ext_end_b[1]],
-                        color=dimension_color, linewidth=dimension_linewidth,
-                        zorder=z_dimension, linestyle='-')
-            
-            # Draw arrowheads at ends of dimension line - behind walls
-            # Arrows pointing outward (away from wall)
-            arrow_length = 8.0
-            arrow_width = 3.0
-            
-            # Arrow at start (pointing outward, away from wall)
-            arrow_dir_start = wall_dir_norm  # Pointing outward
-            arrow_perp_start = perp_dir
-            arrow_tip_start = dim_line_start
-            arrow_base1_start = dim_line_start + arrow_dir_start * arrow_length + arrow_perp_start * arrow_width
-            arrow_base2_start = dim_line_start + arrow_dir_start * arrow_length - arrow_perp_start * arrow_width
-            
-            self.ax.plot([arrow_tip_start[0], arrow_base1_start[0]], 
-                        [arrow_tip_start[1], arrow_base1_start[1]],
-                        color=dimension_color, linewidth=dimension_linewidth,
-                        zorder=z_dimension)
-            self.ax.plot([arrow_tip_start[0], arrow_base2_start[0]], 
-                        [arrow_tip_start[1], arrow_base2_start[1]],
-                        color=dimension_color, linewidth=dimension_linewidth,
-                        zorder=z_dimension)
-            
-            # Arrow at end (pointing outward, away from wall)
-            arrow_dir_end = -wall_dir_norm  # Pointing outward (opposite direction)
-            arrow_perp_end = perp_dir
-            arrow_tip_end = dim_line_end
-            arrow_base1_end = dim_line_end + arrow_dir_end * arrow_length + arrow_perp_end * arrow_width
-            arrow_base2_end = dim_line_end + arrow_dir_end * arrow_length - arrow_perp_end * arrow_width
+            host = positions.get(element.get('parent_id'))
+            if host is None:
+                middle = Point((element['point_a'] + element['point_b']) / 2)
+                hosts = self._parallel_walls(walls, index, middle, along, max_distance)
+                if not hosts:
+                    continue
+                host = min(hosts)[1]
+            element['wall_id'] = walls[host]['id']
             
-            self.ax.plot([arrow_tip_end[0], arrow_base1_end[0]], 
-                        [arrow_tip_end[1], arrow_base1_end[1]],
-                        color=dimension_color, linewidth=dimension_linewidth,
-                        zorder=z_dimension)
-            self.ax.plot([arrow_tip_end[0], arrow_base2_end[0]], 
-                        [arrow_tip_end[1], arrow_base2_end[1]],
-                        color=dimension_color, linewidth=dimension_linewidth,
+            if host not in duplicates:
+                wall = walls[host]
+                line = LineString([wall['point_a'], wall['point_b']])
+                duplicates[host] = [position for _, position in self._parallel_walls(
+                    walls, index, line, wall['point_b'] - wall['point_a'], DUPLICATE_WALL_DISTANCE * self.scaling_factor)]
+            for position in sorted(set(duplicates[host]) | {host}):
+                # Opening extent projected onto the wall axis, clipped to the wall
+                wall = walls[position]
+                wall_dir = wall['point_b'] - wall['point_a']
+                wall_length = np.linalg.norm(wall_dir)
+                if wall_length < 1e-6:
+                    continue
+                unit = wall_dir / wall_length
+                t = sorted((float((element['point_a'] - wall['point_a']) @ unit), float((element['point_b'] - wall['point_a']) @ unit)))
+                start, end = max(t[0], 0.0), min(t[1], wall_length)
+                if end - start > 1e-6:
+                    cuts.setdefault(position, []).append((start, end))
+        return cuts
+    
+    def _parallel_walls(self, walls, index, geometry, direction, max_distance):
+        """(distance, position) of walls within max_distance of geometry and parallel to direction"""
+        if 'tree' not in index:
+            # Built on first use: for elements without a known parent and once per host wall with openings
+            index['lines'] = [LineString([wall['point_a'], wall['point_b']]) for wall in walls]
+            index['tree'] = STRtree(index['lines'])
+        direction_length = np.linalg.norm(direction)
+        found = []
+        for position in index['tree'].query(geometry.buffer(max_distance)):
+            distance = index['lines'][position].distance(geometry)
+            wall_dir = walls[position]['point_b'] - walls[position]['point_a']
+            cross = wall_dir[0] * direction[1] - wall_dir[1] * direction[0]
+            if distance <= max_distance and abs(cross) <= np.sin(OPENING_ATTACH_ANGLE) * np.linalg.norm(wall_dir) * direction_length:
+                found.append((distance, int(position)))
+        return found
+    
+    def cut_solid_walls(self, walls, cuts):
+        """Solid wall pieces between openings; cap_a/cap_b mark real wall ends (extended to close corners)"""
+        pieces = []
+        for position, wall in enumerate(walls):
+            wall_dir = wall['point_b'] - wall['point_a']
+            wall_length = np.linalg.norm(wall_dir)
+            if wall_length < 1e-6:
+                continue
+            unit = wall_dir / wall_length
+            start = 0.0
+            for cut_start, cut_end in sorted(cuts.get(position, [])) + [(wall_length, wall_length)]:
+                if cut_start - start > 1e-6:
+                    pieces.append({
+                        'point_a': wall['point_a'] + unit * start,
+                        'point_b': wall['point_a'] + unit * cut_start,
+                        'cap_a': start == 0.0,
+                        'cap_b': cut_start == wall_length,
+                        'length': (cut_start - start) / self.scaling_factor,
+                        'wall_id': wall['id'],
+                        'category': 'wall'
+                    })
+                start = max(start, cut_end)
+        return pieces
+    
+    def plan_coordinates(self, points):
+        """Room Plan x/z points (meters) in rotated plan coordinates, like the prepared geometry"""
+        self.prepare_geometry()
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        plan = np.column_stack([-points[:, 0], points[:, 1]]) * self.scaling_factor
+        return (plan - self._plan_center) @ self._rot_plan.T + self._plan_center
+    
+    def object_corners(self, obj):
+        """Footprint corners of an object frame"""
+        return [obj['center'] + obj['axes'] @ np.array(corner) for corner in
+                ((-0.5, -0.5), (0.5, -0.5), (0.5, 0.5), (-0.5, 0.5))]
+    
+    def _bounds_from_points(self, all_points, padding=200):
+        """Bounds of a list of 2D points with padding (in scaled units)"""
+        if len(all_points) == 0:
+            return {'minX': -1000, 'maxX': 1000, 'minY': -1000, 'maxY': 1000}
+        
+        points_array = np.array(all_points)
+        return {
+            'minX': float(np.min(points_array[:, 0])) - padding,
+            'maxX': float(np.max(points_array[:, 0])) + padding,
+            'minY': float(np.min(points_array[:, 1])) - padding,
+            'maxY': float(np.max(points_array[:, 1])) + padding
+        }
+    
+    def _style(self, options):
+        """Compiled style profile selected by render options"""
+        return STYLE_PROFILES.get(options.get('style'), STYLE_PROFILES['default'])
+    
+    def _locale(self, options):
+        """Compiled locale selected by render options"""
+        return LOCALES.get(options.get('locale'), LOCALES[DEFAULT_LOCALE])
+    
+    def _setup_axes(self, ax, bounds, decorated=True, style=None, locale=None):
+        """Apply plan limits and aspect; decorated axes also get background, grid and titles"""
+        style = style or STYLE_PROFILES['default']
+        locale = locale or LOCALES[DEFAULT_LOCALE]
+        ax.invert_yaxis()
+        ax.set_aspect('equal')
+        if decorated:
+            fonts = list(locale['fonts'])
+            ax.grid(True, alpha=0.15, linestyle=':', linewidth=0.5, color=style['grid_color'])
+            ax.set_facecolor(style['background_color'])
+            ax.set_title(locale['title'], fontsize=20, fontweight='bold', pad=25, color=style['title_color'],
+                         fontfamily=fonts)
+            ax.set_xlabel(locale['x_label'], fontsize=13, color=style['axis_label_color'], fontfamily=fonts)
+            ax.set_ylabel(locale['y_label'], fontsize=13, color=style['axis_label_color'], fontfamily=fonts)
+        else:
+            ax.set_axis_off()
+        ax.set_xlim(bounds['minX'], bounds['maxX'])
+        ax.set_ylim(bounds['minY'], bounds['maxY'])
+    
+    def generate_floor_plan(self, wall_line_width=None, options=None, canvas=None, fig=None):
+        """Generate floor plan using SpriteKit-like approach: walls as lines (into fig, e.g. a pooled one)"""
+        options = dict(options or DEFAULT_RENDER_OPTIONS)
+        if wall_line_width is not None:
+            options['wall_line_width'] = float(wall_line_width)
+        self._canvas = canvas or LAYER_CANVAS
+        
+        geometry = self.prepare_geometry()
+        
+        # Figure API instead of pyplot: no global figure registry, so threads can render concurrently.
+        # Laid out at the output dpi, so the canvas buffer is allocated once
+        if fig is None:
+            fig = Figure(figsize=self._canvas['figsize'], dpi=self._canvas['dpi'])
+            FigureCanvasAgg(fig)
+        style = self._style(options)
+        self.fig = fig
+        self.fig.patch.set_facecolor(style['page_color'])
+        self.ax = self.fig.add_subplot()
+        self._setup_axes(self.ax, geometry['bounds'], style=style, locale=self._locale(options))
+        
+        # All layers go into the same axes, z-order keeps them stacked like the layered renderer
+        for layer_name, _ in style['layers']:
+            if self._layer_enabled(layer_name, options):
+                self._draw_layer(self.ax, layer_name, options)
+        
+        # Legend removed per user request
+        
+        self.fig.tight_layout()
+    
+    def _layer_enabled(self, layer_name, options):
+        """Check whether a layer is drawn for the given render options"""
+        if layer_name == 'dimension':
+            return options['show_dimensions']
+        if layer_name == 'label':
+            return options['show_labels']
+        if layer_name == 'object':
+            return options['show_objects'] and bool(self.prepare_geometry()['objects'])
+        if layer_name == 'hide_surface':
+            # Solid wall pieces already leave attached openings free; only unattached ones need overdraw
+            geometry = self.prepare_geometry()
+            return options['wall_style'] == 'stroke' and any(
+                element['wall_id'] is None for element in geometry['openings'] + geometry['windows'] + geometry['doors'])
+        return True
+    
+    def _layer_params(self, layer_name, options):
+        """Render options that affect a single layer (part of the layer cache key)"""
+        if layer_name == 'wall':
+            return (options['wall_line_width'], options['wall_style'])
+        if layer_name == 'hide_surface':
+            return (options['wall_line_width'],)
+        if layer_name in ('base', 'dimension', 'label'):
+            # Titles, units and room names are localized
+            return (options['locale'],)
+        if layer_name == 'door':
+            return (options['door_style'],)
+        if layer_name == 'window' and options['window_style'] == 'symbol':
+            return (options['window_style'], options['wall_line_width'])
+        if layer_name == 'window':
+            return (options['window_style'],)
+        return ()
+    
+    def _draw_layer(self, ax, layer_name, options, geometry=None):
+        """Draw one z-ordered layer of the plan (or of a geometry subset) into the axes"""
+        if geometry is None:
+            geometry = self.prepare_geometry()
+        style = self._style(options)
+        zorder = style['zorder'][layer_name]
+        if layer_name == 'dimension':
+            self._draw_dimensions(ax, geometry['walls'], zorder, style, self._locale(options))
+        elif layer_name == 'wall' and options['wall_style'] == 'polygon':
+            outline = geometry.get('wall_outline')
+            if outline is None:
+                outline = self.get_wall_outline(options['wall_line_width'])
+            self._draw_wall_outline(ax, outline, zorder, style)
+        elif layer_name == 'wall':
+            self._draw_walls(ax, geometry['solid_walls'], options['wall_line_width'], zorder, style)
+        elif layer_name == 'hide_surface':
+            self._draw_hide_surfaces(ax, [element for element in geometry['openings'] + geometry['windows'] + geometry['doors']
+                                          if element['wall_id'] is None],
+                                     options['wall_line_width'], zorder, style)
+        elif layer_name == 'window' and options['window_style'] == 'symbol':
+            self._draw_window_symbols(ax, geometry['windows'], options['wall_line_width'], zorder, style)
+        elif layer_name == 'window':
+            self._draw_windows(ax, geometry['windows'], zorder, style)
+        elif layer_name == 'door' and options['door_style'] == 'swing':
+            self._draw_door_swings(ax, geometry['doors'], zorder, style)
+        elif layer_name == 'door':
+            self._draw_doors(ax, geometry['doors'], zorder, style)
+        elif layer_name == 'label':
+            self._draw_labels(ax, geometry['labels'], self._locale(options), zorder, style)
+        elif layer_name == 'object':
+            self._draw_objects(ax, geometry['objects'], zorder, style)
+    
+    def _draw_walls(self, ax, solid_walls, wall_line_width, z_wall, style):
+        """Draw solid wall pieces as thick lines (like SpriteKit), one collection"""
+        # Butt caps keep openings clear; real wall ends are extended by half the stroke to close corners
+        ax.apply_aspect()
+        pixels_per_unit = abs(ax.transData.transform((1, 0))[0] - ax.transData.transform((0, 0))[0])
+        half_width = wall_line_width / 2 * ax.figure.dpi / 72 / pixels_per_unit
+        segments = []
+        for piece in solid_walls:
+            unit = (piece['point_b'] - piece['point_a']) / np.linalg.norm(piece['point_b'] - piece['point_a'])
+            segments.append([piece['point_a'] - unit * half_width * piece['cap_a'],
+                             piece['point_b'] + unit * half_width * piece['cap_b']])
+        ax.add_collection(LineCollection(segments, colors=style['wall_color'], linewidths=wall_line_width,
+                                         capstyle='butt', zorder=z_wall), autolim=False)
+    
+    def get_wall_outline(self, wall_line_width):
+        """Walls buffered to their thickness, unioned once, with openings, windows and doors cut out"""
+        if wall_line_width in self._wall_outlines:
+            return self._wall_outlines[wall_line_width]
+        
+        geometry = self.prepare_geometry()
+        # Wall thickness follows the UI slider: wall_line_width / 100 meters
+        half_thickness = wall_line_width / 100.0 * self.scaling_factor / 2.0
+        # Solid pieces are already split at attached openings; real wall ends get square caps for the corners
+        walls = []
+        for piece in geometry['solid_walls']:
+            unit = (piece['point_b'] - piece['point_a']) / np.linalg.norm(piece['point_b'] - piece['point_a'])
+            walls.append(LineString([piece['point_a'] - unit * half_thickness * piece['cap_a'],
+                                     piece['point_b'] + unit * half_thickness * piece['cap_b']])
+                         .buffer(half_thickness, cap_style='flat', join_style='mitre'))
+        # Openings without a host wall are still cut out, slightly deeper than the wall so off-axis ones cut through
+        cuts = [LineString([element['point_a'], element['point_b']]).buffer(half_thickness * 1.5, cap_style='flat')
+                for element in geometry['openings'] + geometry['windows'] + geometry['doors']
+                if element['wall_id'] is None and np.linalg.norm(element['point_b'] - element['point_a']) > 1e-6]
+        
+        outline = unary_union(walls)
+        if cuts:
+            outline = outline.difference(unary_union(cuts))
+        self._wall_outlines[wall_line_width] = outline
+        return outline
+    
+    def _draw_wall_outline(self, ax, outline, z_wall, style):
+        """Draw the joined wall outline as a single filled path"""
+        if outline.is_empty:
+            return
+        ax.add_patch(PathPatch(polygon_path(outline), facecolor=style['wall_color'], edgecolor='none',
+                               linewidth=0, zorder=z_wall))
+    
+    def _draw_dimensions(self, ax, wall_segments, z_dimension, style, locale):
+        """Draw dimension lines, extension lines, arrows and length labels for walls"""
+        for segment in wall_segments:
+            point_a = segment['point_a']
+            point_b = segment['point_b']
+            
+            # Calculate wall length in meters
+            wall_length_m = segment.get('length', np.linalg.norm(point_b - point_a) / self.scaling_factor)
+            
+            # Calculate wall direction and perpendicular
+            wall_dir = point_b - point_a
+            wall_length_px = np.linalg.norm(wall_dir)
+            if wall_length_px < 1e-6:
+                continue
+            
+            wall_dir_norm = wall_dir / wall_length_px
+            perp_dir = np.array([-wall_dir_norm[1], wall_dir_norm[0]])  # Perpendicular to wall
+            
+            # Offset distance for dimension line (away from wall)
+            dimension_offset = style['dimension_offset']
+            
+            # Calculate dimension line position (parallel to wall, offset perpendicularly)
+            dim_line_start = point_a + perp_dir * dimension_offset
+            dim_line_end = point_b + perp_dir * dimension_offset
+            
+            # Draw dimension line (thin line parallel to wall) - behind walls
+            dimension_color = style['dimension_color']
+            dimension_linewidth = style['dimension_line_width']
+            ax.plot([dim_line_start[0], dim_line_end[0]],
+                    [dim_line_start[1], dim_line_end[1]],
+                    color=dimension_color, linewidth=dimension_linewidth,
+                    zorder=z_dimension, linestyle='-')
+            
+            # Draw extension lines (perpendicular lines from wall edge to dimension line) - behind walls
+            # Extension lines start from wall edges and go to dimension line
+            ax.plot([point_a[0], dim_line_start[0]],
+                    [point_a[1], dim_line_start[1]],
+                    color=dimension_color, linewidth=dimension_linewidth,
+                    zorder=z_dimension, linestyle='-')
+            ax.plot([point_b[0], dim_line_end[0]],
+                    [point_b[1], dim_line_end[1]],
+                    color=dimension_color, linewidth=dimension_linewidth,
+                    zorder=z_dimension, linestyle='-')
+            
+            # Draw arrowheads at ends of dimension line - behind walls
+            # Arrows pointing outward (away from wall)
+            arrow_length = style['dimension_arrow_length']
+            arrow_width = style['dimension_arrow_width']
+            
+            for arrow_tip, arrow_dir in ((dim_line_start, wall_dir_norm), (dim_line_end, -wall_dir_norm)):
+                arrow_base1 = arrow_tip + arrow_dir * arrow_length + perp_dir * arrow_width
+                arrow_base2 = arrow_tip + arrow_dir * arrow_length - perp_dir * arrow_width
+                ax.plot([arrow_tip[0], arrow_base1[0]],
+                        [arrow_tip[1], arrow_base1[1]],
+                        color=dimension_color, linewidth=dimension_linewidth,
+                        zorder=z_dimension)
+                ax.plot([arrow_tip[0], arrow_base2[0]],
+                        [arrow_tip[1], arrow_base2[1]],
+                        color=dimension_color, linewidth=dimension_linewidth,
                         zorder=z_dimension)
             
             # Calculate center of dimension line for text placement
@@ -903,60 +2111,92 @@ class RoomPlanWallExtractor:
             wall_angle_deg = np.degrees(np.arctan2(wall_dir[1], wall_dir[0]))
             
             # Format length text (show 2 decimal places, remove trailing zeros)
-            length_text = f'{wall_length_m:.2f}'.rstrip('0').rstrip('.') + 'm'
-            
-            # Add text label on dimension line - behind walls
-            self.ax.text(dim_center[0], dim_center[1], length_text,
-                        fontsize=10, ha='center', va='center', fontweight='bold',
-                        bbox=dict(boxstyle='round,pad=0.2', facecolor='white',
-                                alpha=0.95, edgecolor='none', linewidth=0),
-                        rotation=wall_angle_deg,
-                        zorder=z_dimension, color='#333')
-        
-        # Step 2: Draw openings to hide walls (like SpriteKit)
-        # Hide only the exact width of the opening - use same width as wall to cover it exactly
-        for opening in openings:
-            point_a = opening['point_a']
-            point_b = opening['point_b']
-            # Draw line with background color to hide wall - use wall_line_width to exactly cover the wall
-            self.ax.plot([point_a[0], point_b[0]], [point_a[1], point_b[1]],
-                        color=background_color, linewidth=wall_line_width,
-                        zorder=z_hide_surface, solid_capstyle='butt')
-        
-        # Step 3: Draw windows (hide wall first, then draw gray line along window - same style as doors)
-        # Hide only the exact width of the window - use same width as wall to cover it exactly
+            length_text = f'{wall_length_m:.2f}'.rstrip('0').rstrip('.') + locale['length_unit']
+            
+            # Add text label on dimension line - behind walls (repeated lengths reuse one raster)
+            ax.add_artist(CachedLabel(dim_center[0], dim_center[1], length_text, 'dimension',
+                                      rotation=wall_angle_deg, zorder=z_dimension, profile=style, fonts=locale['fonts']))
+    
+    def _draw_objects(self, ax, objects, z_object, style):
+        """Stamp each category's cached symbol onto object footprints, drawn as one PathCollection"""
+        if not objects:
+            return
+        by_category = {}
+        for obj in objects:
+            by_category.setdefault(obj['category'], []).append(obj)
+        
+        paths = []
+        for category, items in by_category.items():
+            symbol = OBJECT_SYMBOLS.get(category, OBJECT_SYMBOLS['unknown'])
+            # One affine per object applied to the shared symbol vertices
+            paths.extend(instance_paths(symbol, np.array([obj['axes'] for obj in items]),
+                                        np.array([obj['center'] for obj in items])))
+        ax.add_collection(PathCollection(paths, zorder=z_object, **style['object_style']), autolim=False)
+    
+    def _draw_hide_surfaces(self, ax, elements, wall_line_width, z_hide_surface, style):
+        """Hide walls under openings, windows and doors (like SpriteKit)"""
+        # Hide only the exact width of the element - use wall_line_width to exactly cover the wall
+        background_color = style['background_color']
+        for element in elements:
+            point_a = element['point_a']
+            point_b = element['point_b']
+            ax.plot([point_a[0], point_b[0]], [point_a[1], point_b[1]],
+                    color=background_color, linewidth=wall_line_width,
+                    zorder=z_hide_surface, solid_capstyle='butt')
+    
+    def _opening_frames(self, elements, depth=None):
+        """Unit-frame axes and origins for openings: x = point_a -> point_b, y = perpendicular (door width or depth)"""
+        points_a = np.array([element['point_a'] for element in elements], dtype=float).reshape(-1, 2)
+        along = np.array([element['point_b'] for element in elements], dtype=float).reshape(-1, 2) - points_a
+        lengths = np.linalg.norm(along, axis=1)
+        keep = lengths > 1e-6
+        points_a, along, lengths = points_a[keep], along[keep], lengths[keep]
+        across = np.column_stack([-along[:, 1], along[:, 0]])
+        if depth is not None:
+            across *= (depth / lengths)[:, None]
+        return np.stack([along, across], axis=2), points_a
+    
+    def _draw_door_swings(self, ax, doors, z_door, style):
+        """Door leaf and swing arc per door, stamped from one template and drawn as a single collection"""
+        frames, origins = self._opening_frames(doors)
+        if len(frames):
+            ax.add_collection(PathCollection(instance_paths(DOOR_SWING_SYMBOL, frames, origins),
+                                             zorder=z_door, **style['door_swing_style']), autolim=False)
+    
+    def _draw_window_symbols(self, ax, windows, wall_line_width, z_window, style):
+        """Window frame and glazing across the wall thickness, stamped from one template as a single collection"""
+        depth = wall_line_width / 100.0 * self.scaling_factor
+        frames, origins = self._opening_frames(windows, depth)
+        if len(frames):
+            ax.add_collection(PathCollection(instance_paths(WINDOW_SYMBOL, frames, origins),
+                                             zorder=z_window, **style['window_symbol_style']), autolim=False)
+    
+    def _draw_windows(self, ax, windows, z_window, style):
+        """Draw thin gray line along each window - same style as doors"""
+        window_line_width = style['window_line_width']
         for window in windows:
             point_a = window['point_a']
             point_b = window['point_b']
-            # Hide wall underneath - use wall_line_width to exactly cover the wall
-            self.ax.plot([point_a[0], point_b[0]], [point_a[1], point_b[1]],
-                        color=background_color, linewidth=wall_line_width,
-                        zorder=z_hide_surface, solid_capstyle='butt')
-            
-            # Draw thin gray line along window - same position and length as blue line was, but gray and thin like doors
-            door_line_width = 1.5
-            self.ax.plot([point_a[0], point_b[0]], [point_a[1], point_b[1]],
-                        color='#888888', linewidth=door_line_width,
-                        zorder=z_window, solid_capstyle='butt')
-        
-        # Step 4: Draw doors (hide wall, draw gray perpendicular line)
-        # Hide only the exact width of the door - use same width as wall to cover it exactly
+            ax.plot([point_a[0], point_b[0]], [point_a[1], point_b[1]],
+                    color=style['window_color'], linewidth=window_line_width,
+                    zorder=z_window, solid_capstyle='butt')
+    
+    def _draw_doors(self, ax, doors, z_door, style):
+        """Draw thin gray perpendicular line in the center of each door"""
+        door_perpendicular_line_length = style['door_perpendicular_line_length']  # Fixed length for all doors (scaled units)
+        door_line_width = style['door_line_width']
         for i, door in enumerate(doors):
             point_a = door['point_a']
             point_b = door['point_b']
             
-            # Hide wall underneath door - use wall_line_width to exactly cover the wall
-            self.ax.plot([point_a[0], point_b[0]], [point_a[1], point_b[1]],
-                        color=background_color, linewidth=wall_line_width,
-                        zorder=z_hide_surface, solid_capstyle='butt')
-            
-            # Draw thin gray perpendicular line in the center of the door
             # Calculate door center
             door_center = np.array([(point_a[0] + point_b[0]) / 2, (point_a[1] + point_b[1]) / 2])
             
             # Calculate door direction vector
             door_dir = point_b - point_a
             door_length = np.linalg.norm(door_dir)
+            if door_length < 1e-6:
+                continue
             
             # Calculate perpendicular direction (rotate 90 degrees)
             perp_dir = np.array([-door_dir[1], door_dir[0]]) / door_length  # Normalized perpendicular
@@ -966,71 +2206,314 @@ class RoomPlanWallExtractor:
             perp_start = door_center - perp_dir * (line_length / 2)
             perp_end = door_center + perp_dir * (line_length / 2)
             
-            # Use very thin line width for doors
-            door_line_width = 1.5
-            self.ax.plot([perp_start[0], perp_end[0]], [perp_start[1], perp_end[1]],
-                        color='#888888', linewidth=door_line_width,
-                        zorder=z_door, solid_capstyle='butt',
-                        label='Door' if i == 0 else '')
+            ax.plot([perp_start[0], perp_end[0]], [perp_start[1], perp_end[1]],
+                    color=style['door_color'], linewidth=door_line_width,
+                    zorder=z_door, solid_capstyle='butt',
+                    label='Door' if i == 0 else '')
+    
+    def _draw_labels(self, ax, labels, locale, z_label, style):
+        """Draw room labels with area"""
+        for room in labels:
+            center_rotated = room['center']
+            label = self.translate_room_name(room['label'], locale['code'])
+            area_text = f"{room['area']:.2f} {locale['area_unit']}"
+            
+            # Draw area at original position (where name was)
+            ax.add_artist(CachedLabel(center_rotated[0], center_rotated[1], area_text, 'area', zorder=z_label,
+                                      profile=style, fonts=locale['fonts']))
+            
+            # Draw room name below area (where area was)
+            ax.add_artist(CachedLabel(center_rotated[0], center_rotated[1] + style['room_label_offset'], label, 'room',
+                                      zorder=z_label, profile=style, fonts=locale['fonts']))
+    
+    def _render_layer(self, layer_name, options, canvas):
+        """Render a single layer into an RGBA buffer, cropped to its visible pixels"""
+        geometry = self.prepare_geometry()
+        # Buffers are copied out before the pooled figure is released
+        with canvas_pool.figure(canvas['figsize'], canvas['dpi']) as fig:
+            ax = fig.add_axes(LAYER_AXES_RECT)
+            if layer_name == 'base':
+                fig.patch.set_facecolor(self._style(options)['page_color'])
+                self._setup_axes(ax, geometry['bounds'], style=self._style(options), locale=self._locale(options))
+            else:
+                fig.patch.set_alpha(0.0)
+                self._setup_axes(ax, geometry['bounds'], decorated=False)
+                self._draw_layer(ax, layer_name, options)
+            fig.canvas.draw()
+            rgba = np.asarray(fig.canvas.buffer_rgba())
+            
+            # Base layer defines the output extent: axes with title and tick labels, without margins
+            if layer_name == 'base':
+                top, bottom, left, right = figure_crop_box(fig, ax)
+                return (top, left, rgba[top:bottom, left:right].copy())
+            
+            # Keep only the bounding box of non-transparent pixels - most layers are sparse
+            visible = np.nonzero(rgba[..., 3])
+            if len(visible[0]) == 0:
+                return (0, 0, rgba[:0, :0].copy())
+            y0, y1 = visible[0].min(), visible[0].max() + 1
+            x0, x1 = visible[1].min(), visible[1].max() + 1
+            return (int(y0), int(x0), rgba[y0:y1, x0:x1].copy())
+    
+    def render_layers(self, options=None, canvas=None):
+        """Render the plan by compositing cached per-layer RGBA buffers, returns an RGB array"""
+        options = options or DEFAULT_RENDER_OPTIONS
+        canvas = canvas or LAYER_CANVAS
+        canvas_key = (tuple(canvas['figsize']), canvas['dpi'])
+        style = self._style(options)
         
-        # Step 5: Draw room labels with perimeter
-        for section in self.sections:
-            center_3d = section.get('center', [0, 0, 0])
-            if len(center_3d) >= 3:
-                # Convert to 2D coordinates
-                pos_2d_x = -center_3d[0] * self.scaling_factor
-                pos_2d_y = center_3d[2] * self.scaling_factor
-                # Apply plan rotation (use plan_center from generate_floor_plan)
-                center_2d = np.array([pos_2d_x, pos_2d_y])
-                # Calculate plan center if not already calculated
-                if not hasattr(self, '_plan_center'):
-                    self._plan_center = np.array([0, 0])
-                if not hasattr(self, '_rot_plan'):
-                    cos_plan = np.cos(self.plan_rotation)
-                    sin_plan = np.sin(self.plan_rotation)
-                    self._rot_plan = np.array([[cos_plan, -sin_plan], [sin_plan, cos_plan]])
-                center_rotated = self._rot_plan @ (center_2d - self._plan_center) + self._plan_center
-                label_en = section.get('label', 'Room').upper()
-                label = self.translate_room_name(label_en)
-                
-                # Calculate room area
-                room_area = self.calculate_room_area(section, wall_segments, threshold_distance=500.0)
-                area_text = f'{room_area:.2f} м²'
-                
-                # Draw area at original position (where name was)
-                self.ax.text(center_rotated[0], center_rotated[1], area_text,
-                            fontsize=11, ha='center', va='center', fontweight='normal',
-                            style='italic',
-                            zorder=z_label, color='#666666')
-                
-                # Draw room name below area (where area was) - in Ukrainian
-                self.ax.text(center_rotated[0], center_rotated[1] + 25, label,
-                            fontsize=14, ha='center', va='center', fontweight='bold',
-                            zorder=z_label, color='#333')
+        buffers = []
+        for layer_name in ['base'] + [name for name, _ in style['layers']]:
+            if layer_name != 'base' and not self._layer_enabled(layer_name, options):
+                continue
+            # Every layer depends on the style profile, so its content hash is part of each key
+            key = (self.plan_hash, style['key'], layer_name, self._layer_params(layer_name, options), canvas_key)
+            layer = _layer_cache.get(key) if self.plan_hash else None
+            if layer is None:
+                layer = self._render_layer(layer_name, options, canvas)
+                if self.plan_hash:
+                    _layer_cache.put(key, layer, layer[2].nbytes)
+            buffers.append(layer)
         
-        # Legend removed per user request
+        return composite_layers(buffers)
+    
+    def get_layers_as_base64(self, options=None, canvas=None, encode_options=None):
+        """Render layered plan and encode it as base64 image"""
+        return base64.b64encode(encode_image(self.render_layers(options, canvas), encode_options)).decode()
+    
+    def get_spatial_index(self):
+        """STRtree over plan elements, built once per plan for tile queries"""
+        if self._spatial_index is not None:
+            return self._spatial_index
         
-        plt.tight_layout()
+        geometry = self.prepare_geometry()
+        items = []
+        shapes = []
+        for kind in ('walls', 'solid_walls', 'doors', 'windows', 'openings'):
+            for element in geometry[kind]:
+                items.append((kind, element))
+                shapes.append(LineString([element['point_a'], element['point_b']]))
+        for label in geometry['labels']:
+            items.append(('labels', label))
+            shapes.append(Point(label['center']))
+        for obj in geometry['objects']:
+            items.append(('objects', obj))
+            shapes.append(Polygon(self.object_corners(obj)))
+        
+        self._spatial_index = (STRtree(shapes), items)
+        return self._spatial_index
+    
+    def get_tile_extent(self):
+        """Square world extent covered by zoom level 0: (minX, maxY, size)"""
+        bounds = self.prepare_geometry()['bounds']
+        size = max(bounds['maxX'] - bounds['minX'], bounds['maxY'] - bounds['minY'])
+        center_x = (bounds['minX'] + bounds['maxX']) / 2
+        center_y = (bounds['minY'] + bounds['maxY']) / 2
+        return center_x - size / 2, center_y + size / 2, size
+    
+    def _reference_scale(self):
+        """Pixels per scaled unit of the full-plan layered render (tiles keep its proportions)"""
+        bounds = self.prepare_geometry()['bounds']
+        axes_w = LAYER_AXES_RECT[2] * LAYER_CANVAS['figsize'][0] * LAYER_CANVAS['dpi']
+        axes_h = LAYER_AXES_RECT[3] * LAYER_CANVAS['figsize'][1] * LAYER_CANVAS['dpi']
+        return min(axes_w / (bounds['maxX'] - bounds['minX']), axes_h / (bounds['maxY'] - bounds['minY']))
+    
+    def render_tile(self, z, x, y, options=None, encode_options=None):
+        """Render one TILE_SIZE x TILE_SIZE tile as image bytes, drawing only elements near it"""
+        options = options or DEFAULT_RENDER_OPTIONS
+        min_x, max_y, size = self.get_tile_extent()
+        tile_world = size / (2 ** z)
+        x0 = min_x + x * tile_world
+        y1 = max_y - y * tile_world
+        x1, y0 = x0 + tile_world, y1 - tile_world
+        
+        # Point sizes (line widths, fonts) scale with dpi, so matching the dpi to the zoom
+        # keeps tiles proportional to the full-plan render
+        tile_scale = TILE_SIZE / tile_world
+        dpi = LAYER_CANVAS['dpi'] * tile_scale / self._reference_scale()
+        
+        # Query a margin around the tile so dimension lines and labels crossing the edge are kept
+        margin = 200.0 / self._reference_scale() + 2 * options['wall_line_width'] / tile_scale
+        tree, items = self.get_spatial_index()
+        hits = tree.query(box(x0 - margin, y0 - margin, x1 + margin, y1 + margin))
+        subset = {'walls': [], 'solid_walls': [], 'doors': [], 'windows': [], 'openings': [], 'labels': [], 'objects': []}
+        for index in sorted(hits):
+            kind, element = items[index]
+            subset[kind].append(element)
+        if options['wall_style'] == 'polygon':
+            subset['wall_outline'] = self.get_wall_outline(options['wall_line_width']).intersection(
+                box(x0 - margin, y0 - margin, x1 + margin, y1 + margin))
+        
+        with canvas_pool.figure((TILE_SIZE / dpi, TILE_SIZE / dpi), dpi) as fig:
+            fig.patch.set_facecolor(self._style(options)['background_color'])
+            ax = fig.add_axes((0, 0, 1, 1))
+            ax.set_axis_off()
+            ax.set_xlim(x0, x1)
+            ax.set_ylim(y0, y1)
+            for layer_name, _ in self._style(options)['layers']:
+                if self._layer_enabled(layer_name, options):
+                    self._draw_layer(ax, layer_name, options, geometry=subset)
+            fig.canvas.draw()
+            return encode_image(np.asarray(fig.canvas.buffer_rgba())[..., :3], encode_options)
     
-    def get_figure_as_base64(self):
+    def get_geometry_geojson(self, wall_line_width=None):
+        """Rotated plan geometry as a GeoJSON FeatureCollection (coordinates in meters)"""
+        geometry = self.prepare_geometry()
+        scale = self.scaling_factor
+        features = []
+        for kind in ('walls', 'doors', 'windows', 'openings'):
+            for element in geometry[kind]:
+                properties = {'category': element['category']}
+                if 'id' in element:
+                    properties['id'] = element['id']
+                if 'length' in element:
+                    properties['length'] = float(element['length'])
+                if 'width' in element:
+                    properties['width'] = float(element['width'])
+                if element.get('parent_id'):
+                    properties['parent_id'] = element['parent_id']
+                if element.get('wall_id'):
+                    properties['wall_id'] = element['wall_id']
+                features.append({
+                    'type': 'Feature',
+                    'geometry': {
+                        'type': 'LineString',
+                        'coordinates': [[float(element['point_a'][0]) / scale, float(element['point_a'][1]) / scale],
+                                        [float(element['point_b'][0]) / scale, float(element['point_b'][1]) / scale]]
+                    },
+                    'properties': properties
+                })
+        
+        for obj in geometry['objects']:
+            ring = [[float(x) / scale, float(y) / scale] for x, y in self.object_corners(obj)]
+            properties = {'category': obj['category'], 'width': float(obj['width']), 'depth': float(obj['depth'])}
+            if obj['id']:
+                properties['id'] = obj['id']
+            features.append({
+                'type': 'Feature',
+                'geometry': {'type': 'Polygon', 'coordinates': [ring + ring[:1]]},
+                'properties': properties
+            })
+        
+        for room in geometry['labels']:
+            if room['polygon'] is None:
+                continue
+            ring = [[float(x) / scale, float(y) / scale] for x, y in room['polygon'].exterior.coords]
+            features.append({
+                'type': 'Feature',
+                'geometry': {'type': 'Polygon', 'coordinates': [ring]},
+                'properties': {'category': 'room', 'label': room['label'], 'area': float(room['area'])}
+            })
+        
+        if wall_line_width is not None:
+            outline = affine_transform(self.get_wall_outline(wall_line_width), [1 / scale, 0, 0, 1 / scale, 0, 0])
+            if not outline.is_empty:
+                features.append({
+                    'type': 'Feature',
+                    'geometry': mapping(outline),
+                    'properties': {'category': 'wall_outline', 'thickness': wall_line_width / 100.0}
+                })
+        
+        return {
+            'type': 'FeatureCollection',
+            'features': features,
+            'units': 'm',
+            'plan_rotation': float(self.plan_rotation)
+        }
+    
+    def get_geometry_binary(self):
+        """Rotated plan geometry in a compact little-endian float32 layout (coordinates in meters)"""
+        # Header: b'RPGB', uint16 version, uint16 reserved, uint32 counts of walls, doors, windows,
+        # openings, rooms and total room vertices. Body: float32 [ax, ay, bx, by] rows per element
+        # kind, uint32 vertex count per room, float32 area per room, float32 [x, y] room vertices.
+        geometry = self.prepare_geometry()
+        scale = self.scaling_factor
+        
+        def segment_array(elements):
+            rows = [np.concatenate([element['point_a'], element['point_b']]) for element in elements]
+            return (np.array(rows, dtype='<f8').reshape(-1, 4) / scale).astype('<f4')
+        
+        rooms = [room for room in geometry['labels'] if room['polygon'] is not None]
+        rings = [np.asarray(room['polygon'].exterior.coords)[:-1] for room in rooms]
+        vertices = (np.concatenate(rings) / scale).astype('<f4') if rings else np.zeros((0, 2), dtype='<f4')
+        
+        kinds = ('walls', 'doors', 'windows', 'openings')
+        header = np.array([len(geometry[kind]) for kind in kinds] + [len(rooms), len(vertices)], dtype='<u4')
+        parts = [b'RPGB', np.array([1, 0], dtype='<u2').tobytes(), header.tobytes()]
+        parts += [segment_array(geometry[kind]).tobytes() for kind in kinds]
+        parts.append(np.array([len(ring) for ring in rings], dtype='<u4').tobytes())
+        parts.append(np.array([room['area'] for room in rooms], dtype='<f4').tobytes())
+        parts.append(vertices.tobytes())
+        return b''.join(parts)
+    
+    def get_figure_as_base64(self, encode_options=None):
         """Convert figure to base64"""
         if self.fig is None:
             return None
         
-        buffer = io.BytesIO()
-        self.fig.savefig(buffer, format='png', bbox_inches='tight', dpi=100)
-        buffer.seek(0)
-        image_base64 = base64.b64encode(buffer.getvalue()).decode()
-        plt.close(self.fig)
+        # Draw once at output dpi and crop to the axes extent instead of savefig(bbox_inches='tight')
+        self.fig.canvas.draw()
+        top, bottom, left, right = figure_crop_box(self.fig, self.ax)
+        rgb = np.asarray(self.fig.canvas.buffer_rgba())[top:bottom, left:right, :3]
+        image_base64 = base64.b64encode(encode_image(rgb, encode_options)).decode()
+        self.fig = self.ax = None
         return image_base64
     
+    def render_figure_base64(self, options=None, canvas=None, encode_options=None):
+        """Draw and encode the single-figure render; serialized per plan since the figure lives on the instance"""
+        canvas = canvas or LAYER_CANVAS
+        with self._figure_lock, canvas_pool.figure(canvas['figsize'], canvas['dpi']) as fig:
+            try:
+                self.generate_floor_plan(options=options, canvas=canvas, fig=fig)
+                return self.get_figure_as_base64(encode_options)
+            finally:
+                # The pooled figure must not stay reachable from a cached plan, also after errors
+                self.fig = self.ax = None
+    
+    def _draw_diff(self, ax, diff, style):
+        """Highlight added, removed and moved elements of a plan diff over the drawn plan"""
+        groups = [
+            ([entry['outline'] for entry in diff['added']], style['diff_added_color'], 'solid'),
+            ([entry['outline'] for entry in diff['removed']], style['diff_removed_color'], 'solid'),
+            ([entry['previous_outline'] for entry in diff['moved']], style['diff_moved_color'], 'dashed'),
+            ([entry['outline'] for entry in diff['moved']], style['diff_moved_color'], 'solid'),
+        ]
+        points = []
+        for outlines, color, linestyle in groups:
+            segments = [self.plan_coordinates(outline) for outline in outlines]
+            if not segments:
+                continue
+            points.extend(segments)
+            ax.add_collection(LineCollection(segments, colors=color, linewidths=style['diff_line_width'],
+                                             linestyles=linestyle, alpha=0.8, zorder=DIFF_ZORDER,
+                                             capstyle='round'), autolim=False)
+        if points:
+            # Removed elements may lie outside the new plan; widen the limits to keep them in view
+            bounds = self.prepare_geometry()['bounds']
+            extra = self._bounds_from_points(np.vstack(points))
+            ax.set_xlim(min(bounds['minX'], extra['minX']), max(bounds['maxX'], extra['maxX']))
+            ax.set_ylim(min(bounds['minY'], extra['minY']), max(bounds['maxY'], extra['maxY']))
+    
+    def render_diff_base64(self, diff, options=None, canvas=None, encode_options=None):
+        """Draw the plan with a diff highlighted on top and encode it (single-figure render)"""
+        options = options or DEFAULT_RENDER_OPTIONS
+        canvas = canvas or LAYER_CANVAS
+        with self._figure_lock, canvas_pool.figure(canvas['figsize'], canvas['dpi']) as fig:
+            try:
+                self.generate_floor_plan(options=options, canvas=canvas, fig=fig)
+                self._draw_diff(self.ax, diff, self._style(options))
+                return self.get_figure_as_base64(encode_options)
+            finally:
+                self.fig = self.ax = None
+    
     def get_statistics(self):
         """Get plan statistics"""
-        wall_segments = self.get_wall_segments()
-        doors = self.extract_door_positions()
-        windows = self.extract_window_positions()
+        # Reuses the prepared geometry instead of extracting elements again
+        geometry = self.prepare_geometry()
+        wall_segments = geometry['walls']
         
-        # Calculate total wall length (perimeter)
+        # Total wall length including the spans under openings ('perimeter', kept for existing clients);
+        # the solid length without openings comes from the cut pieces below
         total_length = 0
         for segment in wall_segments:
             # Calculate length from point_a to point_b
@@ -1039,13 +2522,548 @@ class RoomPlanWallExtractor:
         
         return {
             'walls': len(wall_segments),
-            'doors': len(doors),
-            'windows': len(windows),
+            'doors': len(geometry['doors']),
+            'windows': len(geometry['windows']),
             'rooms': len(self.sections),
             'room_names': [s.get('label', 'Room') for s in self.sections],
-            'perimeter': float(total_length)
+            'perimeter': float(total_length),
+            # Wall length without the spans taken by doors, windows and openings
+            'solid_wall_length': float(sum(piece['length'] for piece in geometry['solid_walls']))
+        }
+    
+    def get_story_levels(self):
+        """Story number and floor height (transform[13]) of each floor, lowest first"""
+        levels = {}
+        for index, floor in enumerate(self.floors):
+            transform = floor.get('transform', [])
+            height = float(transform[13]) if len(transform) >= 16 else 0.0
+            story = floor.get('story', index)
+            levels[story] = min(height, levels.get(story, height))
+        return sorted(levels.items(), key=lambda level: level[1])
+    
+    def _element_story(self, element, levels):
+        """Story of an element: its 'story' metadata, otherwise the highest floor below its height"""
+        if 'story' in element:
+            return element['story']
+        transform = element.get('transform', [])
+        if len(transform) >= 16:
+            height = transform[13]
+        elif len(element.get('center', [])) >= 3:
+            height = element['center'][1]
+        else:
+            return levels[0][0]
+        
+        story = levels[0][0]
+        for level_story, level_height in levels:
+            # Element centers sit above their floor (walls at half height), allow for scan noise
+            if height >= level_height - 0.3:
+                story = level_story
+        return story
+    
+    def split_floors(self):
+        """Split the document into one Room Plan document per story, ordered by story"""
+        levels = self.get_story_levels() or [(0, 0.0)]
+        documents = {}
+        arrays = {
+            'objects': self.objects, 'walls': self.walls, 'doors': self.doors, 'windows': self.windows,
+            'openings': self.openings, 'sections': self.sections, 'floors': self.floors
+        }
+        for name, elements in arrays.items():
+            for element in elements:
+                story = self._element_story(element, levels)
+                document = documents.setdefault(story, {key: [] for key in arrays})
+                document[name].append(element)
+        
+        return sorted(documents.items(), key=lambda item: item[0])
+    
+    def to_document(self):
+        """Parsed arrays as a Room Plan document dict"""
+        return {
+            'objects': self.objects, 'walls': self.walls, 'doors': self.doors, 'windows': self.windows,
+            'openings': self.openings, 'sections': self.sections, 'floors': self.floors
         }
 
+# Multi-room merging: separately scanned rooms are aligned in the RoomPlan x/z plane
+# with a rigid transform (yaw + translation) and appended into one document
+MERGE_MATCH_DISTANCE = 0.35  # Meters between wall centers of a shared wall (scanned from both sides)
+MERGE_MATCH_ANGLE = np.deg2rad(5.0)
+MERGE_LENGTH_BUCKET = 0.1  # Meters per wall length hash bucket
+# Large plans rank alignment hypotheses on an evenly spaced sample of elements, then fully score the best few
+ALIGNMENT_SAMPLE_SIZE = 256
+ALIGNMENT_REFINE_COUNT = 8
+MERGE_CACHE_SIZE = int(os.environ.get('MERGE_CACHE_SIZE', 64))
+_merge_cache = OrderedDict()
+_merge_cache_lock = threading.Lock()
+
+def _wall_features(document, names=('walls',)):
+    """Centers (x, z), directions (radians) and lengths of walls (or other arrays) in the document frame"""
+    centers, angles, lengths = [], [], []
+    for wall in (element for name in names for element in document.get(name, [])):
+        transform = wall.get('transform', [])
+        if len(transform) < 16:
+            continue
+        centers.append((transform[12], transform[14]))
+        angles.append(math.atan2(transform[2], transform[0]))
+        lengths.append(abs(wall.get('dimensions', [1.0])[0]))
+    return np.array(centers, dtype=float).reshape(-1, 2), np.array(angles, dtype=float), np.array(lengths, dtype=float)
+
+def _opening_poses(document):
+    """Center and direction of doors, windows and openings by identifier"""
+    poses = {}
+    for name in ('doors', 'windows', 'openings'):
+        for element in document.get(name, []):
+            transform = element.get('transform', [])
+            if element.get('identifier') and len(transform) >= 16:
+                poses[element['identifier']] = (np.array([transform[12], transform[14]]), math.atan2(transform[2], transform[0]))
+    return poses
+
+def _document_footprint(document):
+    """Convex hull of wall endpoints (x, z), shrunk so rooms sharing a wall do not overlap"""
+    points = []
+    for wall in document.get('walls', []):
+        transform = wall.get('transform', [])
+        if len(transform) < 16:
+            continue
+        direction = np.array([transform[0], transform[2]])
+        norm = np.linalg.norm(direction)
+        if norm < 1e-9:
+            continue
+        half = direction / norm * abs(wall.get('dimensions', [1.0])[0]) / 2
+        center = np.array([transform[12], transform[14]])
+        points += [tuple(center - half), tuple(center + half)]
+    if len(points) < 3:
+        return Polygon()
+    return MultiPoint(points).convex_hull.buffer(-MERGE_MATCH_DISTANCE)
+
+def _rotation_2d(angle):
+    return np.array([[math.cos(angle), -math.sin(angle)], [math.sin(angle), math.cos(angle)]])
+
+def _match_walls(ref_features, ref_tree, new_features, angle, translation):
+    """Indices (ref, new) of walls that coincide after transforming the new walls"""
+    ref_centers, ref_angles, ref_lengths = ref_features
+    new_centers, new_angles, new_lengths = new_features
+    moved = new_centers @ _rotation_2d(angle).T + translation
+    candidates = ref_tree.query_ball_point(moved, MERGE_MATCH_DISTANCE)
+    counts = np.array([len(found) for found in candidates], dtype=int)
+    if not counts.sum():
+        return []
+    # All (new, ref) candidate pairs as flat arrays, checked at once instead of per wall
+    new_index = np.repeat(np.arange(len(candidates)), counts)
+    ref_index = np.concatenate(candidates).astype(int)
+    # Walls are undirected: compare directions modulo pi
+    diff = np.abs((ref_angles[ref_index] - new_angles[new_index] - angle + np.pi / 2) % np.pi - np.pi / 2)
+    compatible = (diff < MERGE_MATCH_ANGLE) & (np.abs(ref_lengths[ref_index] - new_lengths[new_index]) < 0.2 * ref_lengths[ref_index])
+    # First compatible candidate of each new wall
+    matched, first = np.unique(new_index[compatible], return_index=True)
+    return list(zip(ref_index[compatible][first].tolist(), matched.tolist()))
+
+def estimate_alignment(ref_document, new_document, ref_footprint=None, max_hypotheses=400, names=('walls',)):
+    """Rigid transform (angle, translation) mapping new_document onto ref_document, matching the names arrays"""
+    ref_features = _wall_features(ref_document, names)
+    new_features = _wall_features(new_document, names)
+    if len(ref_features[0]) == 0 or len(new_features[0]) == 0:
+        return {'angle': 0.0, 'translation': np.zeros(2), 'matched_walls': 0, 'method': 'identity'}
+    ref_tree = cKDTree(ref_features[0])
+    
+    # Hypotheses: identity (same AR session), shared door/window identifiers, walls of equal length
+    hypotheses = [(0.0, np.zeros(2), 'identity')]
+    ref_poses = _opening_poses(ref_document)
+    for identifier, (new_center, new_angle) in _opening_poses(new_document).items():
+        if identifier in ref_poses:
+            ref_center, ref_angle = ref_poses[identifier]
+            for flip in (0.0, np.pi):
+                angle = ref_angle - new_angle + flip
+                hypotheses.append((angle, ref_center - _rotation_2d(angle) @ new_center, 'identifier'))
+    
+    # Hash walls by quantized length, so candidate pairs are looked up instead of compared all-to-all
+    buckets = {}
+    for index, length in enumerate(ref_features[2]):
+        buckets.setdefault(int(round(length / MERGE_LENGTH_BUCKET)), []).append(index)
+    for new_index in np.argsort(-new_features[2]):
+        key = int(round(new_features[2][new_index] / MERGE_LENGTH_BUCKET))
+        for ref_index in buckets.get(key - 1, []) + buckets.get(key, []) + buckets.get(key + 1, []):
+            for flip in (0.0, np.pi):
+                angle = ref_features[1][ref_index] - new_features[1][new_index] + flip
+                translation = ref_features[0][ref_index] - _rotation_2d(angle) @ new_features[0][new_index]
+                hypotheses.append((angle, translation, 'walls'))
+        if len(hypotheses) >= max_hypotheses:
+            break
+    
+    # Separately scanned rooms share walls but not floor area, so overlap is penalized
+    new_footprint = _document_footprint(new_document)
+    if ref_footprint is None:
+        ref_footprint = _document_footprint(ref_document)
+    
+    def score(hypothesis, features):
+        angle, translation, method = hypothesis
+        pairs = _match_walls(ref_features, ref_tree, features, angle, translation)
+        value = sum(features[2][new_index] for _, new_index in pairs) + (1.0 if method == 'identifier' else 0.0)
+        if not new_footprint.is_empty and not ref_footprint.is_empty:
+            cos_a, sin_a = math.cos(angle), math.sin(angle)
+            moved = affine_transform(new_footprint, [cos_a, -sin_a, sin_a, cos_a, translation[0], translation[1]])
+            value -= 2.0 * ref_footprint.intersection(moved).area
+        return value, len(pairs)
+    
+    if len(new_features[0]) > ALIGNMENT_SAMPLE_SIZE:
+        sample = np.linspace(0, len(new_features[0]) - 1, ALIGNMENT_SAMPLE_SIZE).astype(int)
+        sample_features = tuple(values[sample] for values in new_features)
+        ranked = sorted(range(len(hypotheses)), key=lambda index: -score(hypotheses[index], sample_features)[0])
+        # Original order among the survivors, so ties resolve as in a full pass
+        hypotheses = [hypotheses[index] for index in sorted(ranked[:ALIGNMENT_REFINE_COUNT])]
+    
+    best = None
+    for angle, translation, method in hypotheses:
+        value, matched = score((angle, translation, method), new_features)
+        if best is None or value > best[0]:
+            best = (value, angle, translation, method, matched)
+    
+    _, angle, translation, method, matched = best
+    return {'angle': float((angle + np.pi) % (2 * np.pi) - np.pi), 'translation': translation, 'matched_walls': matched, 'method': method}
+
+def _transform_element(element, matrix):
+    """Copy of an element with its 4x4 transform (column-major) and center moved by matrix"""
+    element = dict(element)
+    transform = element.get('transform', [])
+    if len(transform) >= 16:
+        moved = matrix @ np.array(transform[:16], dtype=float).reshape(4, 4).T
+        element['transform'] = moved.T.reshape(-1).tolist()
+    center = element.get('center', [])
+    if len(center) >= 3:
+        element['center'] = (matrix @ np.array([center[0], center[1], center[2], 1.0]))[:3].tolist()
+    return element
+
+def apply_alignment(document, alignment):
+    """Room Plan document moved by a rigid x/z alignment"""
+    cos_a, sin_a = math.cos(alignment['angle']), math.sin(alignment['angle'])
+    tx, tz = alignment['translation']
+    matrix = np.array([[cos_a, 0, -sin_a, tx], [0, 1, 0, 0], [sin_a, 0, cos_a, tz], [0, 0, 0, 1]])
+    return {name: [_transform_element(element, matrix) for element in document.get(name, [])]
+            for name in ('objects', 'walls', 'doors', 'windows', 'openings', 'sections', 'floors')}
+
+def _append_room(merged, room):
+    """Append an aligned room, skipping walls already present and openings with known identifiers"""
+    merged = {name: list(merged.get(name, [])) for name in ('objects', 'walls', 'doors', 'windows', 'openings', 'sections', 'floors')}
+    ref_features = _wall_features(merged)
+    room_features = _wall_features(room)
+    shared = set()
+    if len(ref_features[0]) and len(room_features[0]):
+        shared = {new_index for _, new_index in _match_walls(ref_features, cKDTree(ref_features[0]), room_features, 0.0, np.zeros(2))}
+    known_ids = {element.get('identifier') for name in ('doors', 'windows', 'openings') for element in merged[name]}
+    
+    walls = [wall for wall in room.get('walls', []) if len(wall.get('transform', [])) >= 16]
+    merged['walls'] += [wall for index, wall in enumerate(walls) if index not in shared]
+    for name in ('doors', 'windows', 'openings'):
+        merged[name] += [element for element in room.get(name, [])
+                         if not element.get('identifier') or element.get('identifier') not in known_ids]
+    merged['objects'] += room.get('objects', [])
+    merged['sections'] += room.get('sections', [])
+    # Floors of the first room define the plan rotation
+    if not merged['floors']:
+        merged['floors'] = room.get('floors', [])
+    return merged
+
+def merge_room_documents(documents, hashes):
+    """Merge per-room Room Plan documents into one, reusing the cached merge of the longest known prefix"""
+    key = tuple(hashes)
+    with _merge_cache_lock:
+        start = 0
+        merged, alignments, footprint = {}, [], Polygon()
+        for end in range(len(key), 0, -1):
+            if key[:end] in _merge_cache:
+                merged, alignments, footprint = _merge_cache[key[:end]]
+                alignments = list(alignments)
+                start = end
+                break
+    
+    # Only rooms after the cached prefix are aligned - adding a room is incremental
+    for index in range(start, len(documents)):
+        if index == 0:
+            alignment = {'angle': 0.0, 'translation': np.zeros(2), 'matched_walls': 0, 'method': 'reference'}
+        else:
+            alignment = estimate_alignment(merged, documents[index], footprint)
+        room = apply_alignment(documents[index], alignment)
+        merged = _append_room(merged, room)
+        footprint = footprint.union(_document_footprint(room))
+        alignments.append({
+            'index': index,
+            'rotation_degrees': float(np.degrees(alignment['angle'])),
+            'translation': [float(value) for value in alignment['translation']],
+            'matched_walls': int(alignment['matched_walls']),
+            'method': alignment['method']
+        })
+        with _merge_cache_lock:
+            _merge_cache[key[:index + 1]] = (merged, list(alignments), footprint)
+            while len(_merge_cache) > MERGE_CACHE_SIZE:
+                _merge_cache.popitem(last=False)
+    
+    return merged, alignments
+
+# Plan diffing: a re-scan is aligned onto the earlier scan with the merge alignment (without the overlap
+# penalty - both scans cover the same space), then elements are matched by identifier and, for the rest,
+# by the nearest compatible element within DIFF_MATCH_DISTANCE (KD-tree, closest pairs first)
+DIFF_MATCH_DISTANCE = float(os.environ.get('DIFF_MATCH_DISTANCE', 1.0))  # Meters between element centers
+DIFF_MATCH_ANGLE = np.deg2rad(15.0)
+# Matched elements count as moved beyond scan noise: center shift, size change or turn
+DIFF_MOVE_DISTANCE = float(os.environ.get('DIFF_MOVE_DISTANCE', 0.1))  # Meters
+DIFF_MOVE_ANGLE = np.deg2rad(3.0)
+DIFF_KINDS = {'walls': 'wall', 'doors': 'door', 'windows': 'window', 'openings': 'opening', 'objects': 'object'}
+DIFF_ZORDER = 40  # Above every plan layer
+DIFF_CACHE_SIZE = int(os.environ.get('DIFF_CACHE_SIZE', 64))
+_diff_cache = OrderedDict()
+_diff_cache_lock = threading.Lock()
+
+def _diff_elements(document, name):
+    """Center, direction, size and outline (x, z in meters) of the elements of one array"""
+    elements = []
+    for element in document.get(name, []):
+        transform = element.get('transform', [])
+        if len(transform) < 16:
+            continue
+        category = element.get('category', {})
+        category = next(iter(category), 'unknown') if isinstance(category, dict) and category else None
+        if name == 'objects' and category in STRUCTURAL_CATEGORIES:
+            continue
+        dims = element.get('dimensions', [1.0, 0.0, 0.0])
+        center = np.array([transform[12], transform[14]], dtype=float)
+        axis_x = np.array([transform[0], transform[2]], dtype=float) * abs(dims[0])
+        if name == 'objects':
+            axis_z = np.array([transform[8], transform[10]], dtype=float) * abs(dims[2] if len(dims) > 2 else 0.0)
+            outline = [center + axis_x * sx / 2 + axis_z * sz / 2 for sx, sz in ((-1, -1), (1, -1), (1, 1), (-1, 1), (-1, -1))]
+        else:
+            outline = [center - axis_x / 2, center + axis_x / 2]
+        elements.append({
+            'identifier': element.get('identifier'),
+            'category': category,
+            'center': center,
+            'angle': math.atan2(transform[2], transform[0]),
+            'size': abs(dims[0]),
+            'outline': np.array(outline)
+        })
+    return elements
+
+def _angle_difference(a, b, undirected):
+    """Absolute difference of two directions, modulo pi for undirected elements (walls, openings)"""
+    period = np.pi if undirected else 2 * np.pi
+    return abs((a - b + period / 2) % period - period / 2)
+
+def _match_elements(before, after, undirected):
+    """One-to-one (before, after) index pairs: shared identifiers first, then nearest compatible elements"""
+    after_ids = {element['identifier']: index for index, element in enumerate(after) if element['identifier']}
+    pairs = [(index, after_ids[element['identifier']]) for index, element in enumerate(before)
+             if element['identifier'] in after_ids]
+    matched_before = {i for i, _ in pairs}
+    matched_after = {j for _, j in pairs}
+    rest_before = [i for i in range(len(before)) if i not in matched_before]
+    rest_after = [j for j in range(len(after)) if j not in matched_after]
+    if not rest_before or not rest_after:
+        return pairs
+    
+    tree = cKDTree(np.array([before[i]['center'] for i in rest_before]))
+    candidates = []
+    near = tree.query_ball_point(np.array([after[j]['center'] for j in rest_after]), DIFF_MATCH_DISTANCE)
+    for j, neighbours in zip(rest_after, near):
+        for k in neighbours:
+            i = rest_before[k]
+            if before[i]['category'] != after[j]['category'] or \
+                    _angle_difference(before[i]['angle'], after[j]['angle'], undirected) > DIFF_MATCH_ANGLE:
+                continue
+            cost = np.linalg.norm(before[i]['center'] - after[j]['center']) + abs(before[i]['size'] - after[j]['size'])
+            candidates.append((cost, i, j))
+    # Closest pairs first, each element is matched at most once
+    for _, i, j in sorted(candidates):
+        if i not in matched_before and j not in matched_after:
+            pairs.append((i, j))
+            matched_before.add(i)
+            matched_after.add(j)
+    return pairs
+
+def _diff_entry(kind, element):
+    """JSON entry of an added or removed element"""
+    entry = {'kind': kind, 'identifier': element['identifier'],
+             'center': [round(float(v), 3) for v in element['center']], 'size': round(element['size'], 3),
+             'outline': np.round(element['outline'], 3).tolist()}
+    if kind == 'object':
+        entry['category'] = element['category']
+    return entry
+
+def diff_documents(before_document, after_document, align=True):
+    """Added, removed and moved elements of a re-scan (after) against an earlier scan (before)
+
+    Coordinates are Room Plan x/z meters in the frame of the earlier scan; returns (diff, aligned after document).
+    """
+    if align:
+        # An empty reference footprint switches off the overlap penalty meant for neighbouring rooms;
+        # openings are matched too, they tell apart symmetric wall layouts
+        alignment = estimate_alignment(before_document, after_document, ref_footprint=Polygon(),
+                                       names=('walls', 'doors', 'windows', 'openings'))
+    else:
+        alignment = {'angle': 0.0, 'translation': np.zeros(2), 'matched_walls': 0, 'method': 'identity'}
+    aligned = apply_alignment(after_document, alignment)
+    
+    diff = {'added': [], 'removed': [], 'moved': [], 'unchanged': 0}
+    for name, kind in DIFF_KINDS.items():
+        before = _diff_elements(before_document, name)
+        after = _diff_elements(aligned, name)
+        undirected = name != 'objects'
+        pairs = _match_elements(before, after, undirected)
+        for i, j in pairs:
+            old, new = before[i], after[j]
+            distance = float(np.linalg.norm(new['center'] - old['center']))
+            turn = _angle_difference(new['angle'], old['angle'], undirected)
+            size_change = new['size'] - old['size']
+            if distance <= DIFF_MOVE_DISTANCE and abs(size_change) <= DIFF_MOVE_DISTANCE and turn <= DIFF_MOVE_ANGLE:
+                diff['unchanged'] += 1
+                continue
+            entry = _diff_entry(kind, new)
+            entry.update(
+                previous_identifier=old['identifier'],
+                previous_center=[round(float(v), 3) for v in old['center']],
+                previous_outline=np.round(old['outline'], 3).tolist(),
+                distance=round(distance, 3),
+                rotation_degrees=round(float(np.degrees(turn)), 2),
+                size_change=round(size_change, 3)
+            )
+            diff['moved'].append(entry)
+        matched_before = {i for i, _ in pairs}
+        matched_after = {j for _, j in pairs}
+        diff['removed'] += [_diff_entry(kind, element) for i, element in enumerate(before) if i not in matched_before]
+        diff['added'] += [_diff_entry(kind, element) for j, element in enumerate(after) if j not in matched_after]
+    
+    diff['alignment'] = {
+        'rotation_degrees': float(np.degrees(alignment['angle'])),
+        'translation': [float(value) for value in alignment['translation']],
+        'matched_elements': int(alignment['matched_walls']),
+        'method': alignment['method']
+    }
+    diff['summary'] = {key: len(diff[key]) for key in ('added', 'removed', 'moved')}
+    diff['summary']['unchanged'] = diff.pop('unchanged')
+    return diff, aligned
+
+def plan_diff(before, after, align=True):
+    """Diff of two parsed plans and the overlay converter (aligned re-scan in the earlier scan's frame), cached.
+    
+    Raises PlanValidationError if the overlay document is rejected.
+    """
+    key = (before.plan_hash, after.plan_hash, align)
+    with _diff_cache_lock:
+        if key in _diff_cache:
+            _diff_cache.move_to_end(key)
+            return _diff_cache[key]
+    
+    diff, aligned = diff_documents(before.to_document(), after.to_document(), align)
+    overlay = RoomPlanWallExtractor()
+    # The earlier scan's floors fix the plan rotation, so both scans are drawn in one frame
+    if not overlay.parse_room_plan_api(dict(aligned, floors=before.floors or aligned['floors'])):
+        raise overlay.parse_error
+    with _diff_cache_lock:
+        _diff_cache[key] = (diff, overlay)
+        while len(_diff_cache) > DIFF_CACHE_SIZE:
+            _diff_cache.popitem(last=False)
+    return diff, overlay
+
+# Plan analytics: per-room and per-plan figures from the prepared geometry, without rendering.
+# Walls and openings count for every room whose outline passes within this distance of their midpoint,
+# so a door between two rooms counts for both
+ANALYTICS_BOUNDARY_DISTANCE = 0.3  # Meters
+ANALYTICS_ROOM_FIELDS = [
+    ('plan_id', 'string'), ('room', 'int64'), ('label', 'string'), ('story', 'int64'),
+    ('area_m2', 'float64'), ('perimeter_m', 'float64'), ('walls', 'int64'), ('doors', 'int64'),
+    ('windows', 'int64'), ('openings', 'int64'), ('window_area_m2', 'float64'), ('window_to_floor', 'float64'),
+]
+ANALYTICS_PLAN_FIELDS = [
+    ('plan_id', 'string'), ('stories', 'int64'), ('rooms', 'int64'), ('floor_area_m2', 'float64'),
+    ('outline_perimeter_m', 'float64'), ('wall_length_m', 'float64'), ('solid_wall_length_m', 'float64'),
+    ('walls', 'int64'), ('doors', 'int64'), ('windows', 'int64'), ('openings', 'int64'),
+    ('window_area_m2', 'float64'), ('window_to_floor', 'float64'), ('error', 'string'),
+]
+
+def _near_outlines(outlines, elements, distance):
+    """Boolean rooms x elements matrix: element midpoint within distance of the room outline"""
+    if not elements or not len(outlines):
+        return np.zeros((len(outlines), len(elements)), dtype=bool)
+    midpoints = shapely.points(np.array([(e['point_a'] + e['point_b']) / 2 for e in elements]))
+    # Empty outlines (rooms without a polygon) give NaN distances, which compare False
+    with np.errstate(invalid='ignore'):
+        return shapely.distance(outlines[:, None], midpoints[None, :]) <= distance
+
+def _story_analytics(converter, story):
+    """Room rows and totals of a single-story plan"""
+    geometry = converter.prepare_geometry()
+    scale = converter.scaling_factor
+    polygons = np.array([label['polygon'] if label['polygon'] is not None else Polygon()
+                         for label in geometry['labels']], dtype=object)
+    
+    areas = shapely.area(polygons) / scale ** 2
+    perimeters = shapely.length(polygons) / scale
+    outlines = shapely.boundary(polygons)
+    distance = ANALYTICS_BOUNDARY_DISTANCE * scale
+    walls = _near_outlines(outlines, geometry['walls'], distance)
+    doors = _near_outlines(outlines, geometry['doors'], distance)
+    windows = _near_outlines(outlines, geometry['windows'], distance)
+    openings = _near_outlines(outlines, geometry['openings'], distance)
+    window_areas = np.array([window['width'] * window['height'] for window in geometry['windows']], dtype=float)
+    room_window_areas = windows.astype(float) @ window_areas
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratios = np.where(areas > 0, room_window_areas / areas, 0.0)
+    
+    rooms = [{
+        'room': index,
+        'label': label['label'],
+        'story': story,
+        'area_m2': round(float(areas[index]), 4),
+        'perimeter_m': round(float(perimeters[index]), 4),
+        'walls': int(walls[index].sum()),
+        'doors': int(doors[index].sum()),
+        'windows': int(windows[index].sum()),
+        'openings': int(openings[index].sum()),
+        'window_area_m2': round(float(room_window_areas[index]), 4),
+        'window_to_floor': round(float(ratios[index]), 4),
+    } for index, label in enumerate(geometry['labels'])]
+    
+    # Outline of all rooms together, unlike get_statistics' 'perimeter' which sums every wall
+    footprint = unary_union([polygon for polygon in polygons if not polygon.is_empty])
+    totals = {
+        'floor_area_m2': float(areas.sum()),
+        'outline_perimeter_m': float(shapely.length(shapely.boundary(footprint))) / scale,
+        'wall_length_m': float(sum(np.linalg.norm(wall['point_b'] - wall['point_a']) for wall in geometry['walls'])) / scale,
+        'solid_wall_length_m': float(sum(piece['length'] for piece in geometry['solid_walls'])),
+        'walls': len(geometry['walls']),
+        'doors': len(geometry['doors']),
+        'windows': len(geometry['windows']),
+        'openings': len(geometry['openings']),
+        'window_area_m2': float(window_areas.sum()),
+    }
+    return rooms, totals
+
+def plan_analytics(converter):
+    """Rooms (area, perimeter, walls, doors, windows, window-to-floor ratio) and plan totals in meters"""
+    # Stories are analysed separately so rooms stacked above each other don't share walls and windows
+    floors = converter.split_floors()
+    if len(floors) <= 1:
+        floors = [(floors[0][0] if floors else 0, converter)]
+    
+    rooms, totals = [], {}
+    for story, floor in floors:
+        if not isinstance(floor, RoomPlanWallExtractor):
+            document, floor = floor, RoomPlanWallExtractor()
+            floor.parse_room_plan_api(document)
+        story_rooms, story_totals = _story_analytics(floor, story)
+        rooms.extend(story_rooms)
+        for key, value in story_totals.items():
+            totals[key] = totals.get(key, 0) + value
+    for index, room in enumerate(rooms):
+        # Numbered across stories
+        room['room'] = index
+    
+    floor_area = totals.get('floor_area_m2', 0.0)
+    totals = {key: round(value, 4) if isinstance(value, float) else value for key, value in totals.items()}
+    totals.update({
+        'stories': len(floors),
+        'rooms': len(rooms),
+        'window_to_floor': round(totals.get('window_area_m2', 0.0) / floor_area, 4) if floor_area > 0 else 0.0,
+    })
+    return {'rooms': rooms, 'totals': totals}
+
 # Converter will be created per request to avoid state issues
 
 HTML_TEMPLATE = '''
@@ -1151,6 +3169,7 @@ HTML_TEMPLATE = '''
 
     <script>
         let currentJsonData = '';
+        let currentRequest = 0;
         
         function handleFileUpload(event) {
             const file = event.target.files[0];
@@ -1187,7 +3206,25 @@ HTML_TEMPLATE = '''
             // Get value in pixels (slider works in pixels, but we display in meters)
             const wallThickness = parseFloat(document.getElementById('wallThickness').value);
             
-            fetch('/convert', {
+            const request = ++currentRequest;
+            const showError = message => {
+                canvas.innerHTML = '<div style="text-align: center; color: #c62828; font-size: 18px; padding: 50px;">❌ Помилка: ' + message + '</div>';
+            };
+            const showImage = (data, opacity) => {
+                canvas.innerHTML = '<img src="data:' + (data.image_mime || 'image/png') + ';base64,' + data.image + '" class="canvas-image" style="opacity: ' + opacity + '">';
+            };
+            
+            // Stage events: parsed -> geometry -> low-res preview -> final image
+            const handlers = {
+                parsed: data => {
+                    canvas.innerHTML = '<div style="text-align: center; color: #999; font-size: 18px; padding: 50px;">⏳ Стін: ' + data.counts.walls + ', дверей: ' + data.counts.doors + ', вікон: ' + data.counts.windows + '</div>';
+                },
+                preview: data => showImage(data, 0.6),
+                image: data => showImage(data, 1),
+                error: data => showError(data.error)
+            };
+            
+            fetch('/convert/stream', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
                 body: JSON.stringify({ 
@@ -1195,16 +3232,33 @@ HTML_TEMPLATE = '''
                     wall_line_width: wallThickness
                 })
             })
-            .then(r => r.json())
-            .then(data => {
-                if (data.success) {
-                    canvas.innerHTML = '<img src="data:image/png;base64,' + data.image + '" class="canvas-image">';
-                } else {
-                    canvas.innerHTML = '<div style="text-align: center; color: #c62828; font-size: 18px; padding: 50px;">❌ Помилка: ' + data.error + '</div>';
+            .then(async r => {
+                if (!r.ok) {
+                    const data = await r.json();
+                    throw new Error(data.error);
+                }
+                const reader = r.body.getReader();
+                const decoder = new TextDecoder();
+                let buffer = '';
+                while (true) {
+                    const { done, value } = await reader.read();
+                    if (done) break;
+                    buffer += decoder.decode(value, { stream: true });
+                    let end;
+                    while ((end = buffer.indexOf('\\n\\n')) >= 0) {
+                        const message = buffer.slice(0, end);
+                        buffer = buffer.slice(end + 2);
+                        const event = message.match(/^event: (.*)$/m);
+                        const payload = message.match(/^data: (.*)$/m);
+                        // A newer slider change supersedes this stream
+                        if (request === currentRequest && event && payload && handlers[event[1]]) {
+                            handlers[event[1]](JSON.parse(payload[1]));
+                        }
+                    }
                 }
             })
             .catch(err => {
-                canvas.innerHTML = '<div style="text-align: center; color: #c62828; font-size: 18px; padding: 50px;">❌ Помилка: ' + err.message + '</div>';
+                if (request === currentRequest) showError(err.message);
             });
         }
     </script>
@@ -1212,6 +3266,336 @@ HTML_TEMPLATE = '''
 </html>
 '''
 
+# Worker processes for rendering floors in parallel (matplotlib is CPU bound and holds the GIL).
+# Every gunicorn worker owns a pool, and worker recycling only sees the worker's own RSS, so keep it small
+RENDER_POOL_WORKERS = int(os.environ.get('RENDER_POOL_WORKERS', min(2, os.cpu_count() or 1)))
+# Pools are created from threaded workers; a forked child could inherit a lock held by another thread
+# (caches, metrics, matplotlib's font cache) and block forever, so children start from a clean process
+RENDER_POOL_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+def get_render_pool():
+    """Lazily created process pool, None when parallel rendering is disabled"""
+    global _render_pool
+    if RENDER_POOL_WORKERS <= 0:
+        return None
+    with _render_pool_lock:
+        if _render_pool is None:
+            _render_pool = ProcessPoolExecutor(max_workers=RENDER_POOL_WORKERS,
+                                               mp_context=multiprocessing.get_context(RENDER_POOL_START_METHOD))
+        return _render_pool
+
+def render_floor_job(document, options, canvas, encode_options, encode):
+    """Render one floor document; returns encoded image bytes (or the RGB array) and statistics"""
+    converter = RoomPlanWallExtractor()
+    converter.parse_room_plan_api(document)
+    rgb = converter.render_layers(options, canvas)
+    image = encode_image(rgb, encode_options) if encode else rgb
+    return image, converter.get_statistics()
+
+def render_floors(converter, options, canvas, encode_options, encode=True):
+    """Render every story of a parsed plan in the worker pool, returns [(story, image, stats)]"""
+    floors = converter.split_floors()
+    pool = get_render_pool()
+    if pool is None or len(floors) == 1:
+        results = [render_floor_job(document, options, canvas, encode_options, encode) for _, document in floors]
+    else:
+        futures = [pool.submit(render_floor_job, document, options, canvas, encode_options, encode)
+                   for _, document in floors]
+        results = [future.result() for future in futures]
+    return [(story, image, stats) for (story, _), (image, stats) in zip(floors, results)]
+
+def stack_images(images, gap=20):
+    """Stack RGB arrays vertically on a white sheet"""
+    width = max(image.shape[1] for image in images)
+    height = sum(image.shape[0] for image in images) + gap * (len(images) - 1)
+    check_canvas_pixels(width, height)
+    sheet = np.full((height, width, 3), 255, dtype=np.uint8)
+    top = 0
+    for image in images:
+        left = (width - image.shape[1]) // 2
+        sheet[top:top + image.shape[0], left:left + image.shape[1]] = image
+        top += image.shape[0] + gap
+    return sheet
+
+def render_plan_image(converter, options, canvas, encode_options, floor_mode='combined', layered=True):
+    """Render a parsed plan for /convert, returns (image base64 or None, per-floor entries or None)"""
+    with render_memory('plan'):
+        if floor_mode == 'per_floor':
+            # One image per story, rendered in parallel
+            floors = [{'story': story, 'image': base64.b64encode(image).decode(), 'stats': floor_stats}
+                      for story, image, floor_stats in render_floors(converter, options, canvas, encode_options)]
+            return None, floors
+        if floor_mode == 'sheet':
+            # All stories rendered in parallel and stacked into one sheet
+            rendered = render_floors(converter, options, canvas, encode_options, encode=False)
+            floors = [{'story': story, 'stats': floor_stats} for story, _, floor_stats in rendered]
+            sheet = stack_images([rgb for _, rgb, _ in rendered])
+            return base64.b64encode(encode_image(sheet, encode_options)).decode(), floors
+        if layered:
+            # Composite from cached layers - only layers whose options changed are redrawn
+            return converter.get_layers_as_base64(options, canvas, encode_options), None
+        return converter.render_figure_base64(options, canvas, encode_options), None
+
+# Process-wide counters exposed on /metrics
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+def record_metric(name, value=1):
+    """Increment a named counter"""
+    with _metrics_lock:
+        _metrics[name] = _metrics.get(name, 0) + value
+
+# Render memory per kind of render: RSS peaks sampled while canvases are live
+_render_memory = {}
+
+def record_memory(kind, peak, growth, raised_process_peak):
+    """Record the RSS peak of one render and how much it grew over the start of the render"""
+    with _metrics_lock:
+        stats = _render_memory.setdefault(kind, {'renders': 0, 'last_peak_bytes': 0, 'max_peak_bytes': 0,
+                                                 'max_growth_bytes': 0, 'raised_process_peak': 0})
+        stats['renders'] += 1
+        stats['last_peak_bytes'] = peak
+        stats['max_peak_bytes'] = max(stats['max_peak_bytes'], peak)
+        stats['max_growth_bytes'] = max(stats['max_growth_bytes'], growth)
+        stats['raised_process_peak'] += bool(raised_process_peak)
+
+def estimate_request_cost(payload_bytes, element_count):
+    """Rough render cost (in milliseconds of worker time) from payload size and element count"""
+    return 150.0 + 4.0 * element_count + payload_bytes / 10000.0
+
+class AdmissionRejected(Exception):
+    """Raised when a request is shed; carries the HTTP status and a retry hint in seconds"""
+    
+    def __init__(self, message, status, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """Bounds in-flight render cost per process, with a short wait queue and per-client concurrency"""
+    
+    def __init__(self, max_cost, max_queue, queue_timeout, client_concurrency, downgrade_cost):
+        self.max_cost = max_cost
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.client_concurrency = client_concurrency
+        self.downgrade_cost = downgrade_cost
+        self.inflight_cost = 0.0
+        self.inflight = 0
+        self.waiting = 0
+        self._clients = {}
+        self._cond = threading.Condition()
+    
+    def _fits(self, cost):
+        # A single request bigger than the budget still runs when nothing else is in flight
+        return self.inflight == 0 or self.inflight_cost + cost <= self.max_cost
+    
+    def acquire(self, client_id, cost, allow_downgrade=True):
+        """Admit a request, returns (admitted_cost, tier); raises AdmissionRejected when shedding"""
+        thumbnail_cost = cost * RENDER_TIERS['thumbnail']['dpi'] ** 2 / RENDER_TIERS['full']['dpi'] ** 2 / 4
+        with self._cond:
+            if self._clients.get(client_id, 0) >= self.client_concurrency:
+                record_metric('admission_rejected_client')
+                raise AdmissionRejected('Too many concurrent requests for this client', 429, 1)
+            
+            tier = 'full'
+            if not self._fits(cost):
+                if allow_downgrade and cost >= self.downgrade_cost and self._fits(thumbnail_cost):
+                    # Heavy request under pressure: serve a thumbnail now instead of queueing
+                    tier, cost = 'thumbnail', thumbnail_cost
+                elif self.waiting >= self.max_queue:
+                    record_metric('admission_rejected_queue_full')
+                    raise AdmissionRejected('Server busy', 503, self._retry_after())
+                else:
+                    self.waiting += 1
+                    try:
+                        admitted = self._cond.wait_for(lambda: self._fits(cost), timeout=self.queue_timeout)
+                    finally:
+                        self.waiting -= 1
+                    if not admitted:
+                        record_metric('admission_rejected_timeout')
+                        raise AdmissionRejected('Server busy', 503, self._retry_after())
+            
+            self.inflight += 1
+            self.inflight_cost += cost
+            self._clients[client_id] = self._clients.get(client_id, 0) + 1
+            record_metric('admission_admitted')
+            if tier != 'full':
+                record_metric('admission_downgraded')
+            return cost, tier
+    
+    def release(self, client_id, cost):
+        """Return a request's cost to the budget and wake queued requests"""
+        with self._cond:
+            self.inflight -= 1
+            self.inflight_cost -= cost
+            remaining = self._clients.get(client_id, 1) - 1
+            if remaining > 0:
+                self._clients[client_id] = remaining
+            else:
+                self._clients.pop(client_id, None)
+            self._cond.notify_all()
+    
+    def _retry_after(self):
+        # Seconds until the current in-flight work should have drained
+        return max(1, int(math.ceil(self.inflight_cost / 1000.0)))
+    
+    def snapshot(self):
+        with self._cond:
+            return {
+                'inflight': self.inflight,
+                'inflight_cost': self.inflight_cost,
+                'waiting': self.waiting,
+                'max_cost': self.max_cost
+            }
+
+admission = AdmissionController(
+    max_cost=float(os.environ.get('ADMISSION_MAX_COST', 4000)),
+    max_queue=int(os.environ.get('ADMISSION_MAX_QUEUE', 8)),
+    queue_timeout=float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 2.0)),
+    client_concurrency=int(os.environ.get('ADMISSION_CLIENT_CONCURRENCY', 2)),
+    downgrade_cost=float(os.environ.get('ADMISSION_DOWNGRADE_COST', 1000))
+)
+
+class WorkerLifecycle:
+    """Request and RSS budget of a worker process, its warm-up state and recent request latency"""
+    
+    def __init__(self, max_requests, jitter, max_rss_bytes, latency_window=512):
+        # Jitter keeps workers started together from recycling together
+        self.max_requests = max_requests + random.randint(0, jitter) if max_requests > 0 else 0
+        self.max_rss_bytes = max_rss_bytes
+        self.started_at = time.time()
+        self.requests = 0
+        self.recycle_reason = None
+        self.warmup = {'done': False, 'ms': None, 'error': None}
+        self._latencies = deque(maxlen=latency_window)
+        self._lock = threading.Lock()
+    
+    def record_request(self, seconds):
+        """Count a finished request; returns the recycle reason once the budget is used up, else None"""
+        rss = rss_bytes() if self.max_rss_bytes > 0 else None
+        with self._lock:
+            self.requests += 1
+            self._latencies.append(seconds)
+            if self.recycle_reason is not None:
+                return self.recycle_reason
+            if self.max_requests and self.requests >= self.max_requests:
+                self.recycle_reason = 'max_requests'
+            elif rss is not None and rss > self.max_rss_bytes:
+                self.recycle_reason = 'max_rss'
+            reason = self.recycle_reason
+        if reason is not None:
+            print(f"♻️ Worker {os.getpid()} due for recycling ({reason}) after {self.requests} requests")
+            record_metric(f'worker_recycle_{reason}')
+        return reason
+    
+    def snapshot(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            state = {
+                'uptime_s': round(time.time() - self.started_at, 1),
+                'requests': self.requests,
+                'max_requests': self.max_requests,
+                'max_rss_bytes': self.max_rss_bytes,
+                'recycle_reason': self.recycle_reason,
+                'warmup': dict(self.warmup),
+            }
+        if latencies:
+            state['latency_ms'] = {
+                'window': len(latencies),
+                'p50': round(latencies[len(latencies) // 2] * 1000, 1),
+                'p95': round(latencies[int(len(latencies) * 0.95)] * 1000, 1),
+                'max': round(latencies[-1] * 1000, 1),
+            }
+        return state
+
+worker_lifecycle = WorkerLifecycle(
+    max_requests=int(os.environ.get('WORKER_MAX_REQUESTS', 2000)),
+    jitter=int(os.environ.get('WORKER_MAX_REQUESTS_JITTER', 200)),
+    max_rss_bytes=int(os.environ.get('WORKER_MAX_RSS_MB', 1536)) * 1024 * 1024
+)
+WORKER_WARMUP = os.environ.get('WORKER_WARMUP', 'True').lower() == 'true'
+
+def warm_up():
+    """Render the bundled sample plan once, so fonts, label rasters, pooled canvases and code paths are loaded"""
+    started = time.perf_counter()
+    try:
+        with open(os.path.join(SAMPLES_DIR, 'single_room.json'), encoding='utf-8') as f:
+            document = json.load(f)
+        converter = RoomPlanWallExtractor()
+        if not converter.parse_room_plan_api(document):
+            raise ValueError(f'warm-up sample rejected: {converter.parse_error}')
+        for canvas in RENDER_TIERS.values():
+            render_plan_image(converter, DEFAULT_RENDER_OPTIONS, canvas, DEFAULT_ENCODE_OPTIONS)
+        converter.render_tile(0, 0, 0)
+        converter.get_geometry_geojson()
+        error = None
+    except Exception as e:
+        # A failed warm-up only costs the first requests their latency, so the worker still serves
+        print(f"Warm-up failed: {e}")
+        error = str(e)
+    elapsed = round((time.perf_counter() - started) * 1000, 1)
+    worker_lifecycle.warmup = {'done': error is None, 'ms': elapsed, 'error': error}
+    print(f"🔥 Worker {os.getpid()} warmed up in {elapsed} ms")
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def count_request(response):
+    # gunicorn.conf.py ends the worker gracefully once a recycle reason is set
+    started = g.get('request_started')
+    if started is not None:
+        worker_lifecycle.record_request(time.perf_counter() - started)
+    return response
+
+# Shared secret of trusted callers (e.g. a backend serving many users) whose X-Client-Id keys the limits;
+# unset, the header is ignored
+CLIENT_ID_TOKEN = os.environ.get('CLIENT_ID_TOKEN', '')
+
+def request_client_id():
+    """Client identity for per-client limits: remote address, or X-Client-Id sent with a valid X-Client-Token"""
+    client_id = request.headers.get('X-Client-Id')
+    token = request.headers.get('X-Client-Token', '')
+    if client_id and CLIENT_ID_TOKEN and hmac.compare_digest(token.encode(), CLIENT_ID_TOKEN.encode()):
+        return f'client:{client_id}'
+    return request.remote_addr or 'unknown'
+
+def plan_error_response(error):
+    """400 response for a payload rejected by validation, counted per error kind"""
+    record_metric('plan_rejected')
+    record_metric(f'plan_rejected_{error.kind}')
+    return jsonify({'success': False, 'error': str(error), 'path': error.path}), 400
+
+def rejection_response(rejection):
+    """JSON error with Retry-After for a shed request"""
+    response = jsonify({
+        'success': False,
+        'error': str(rejection),
+        'retry_after': rejection.retry_after
+    })
+    response.status_code = rejection.status
+    response.headers['Retry-After'] = str(rejection.retry_after)
+    return response
+
+@app.route('/metrics')
+def metrics():
+    """Process counters and admission control state"""
+    with _metrics_lock:
+        counters = dict(_metrics)
+        renders = {kind: dict(stats) for kind, stats in _render_memory.items()}
+    return jsonify({
+        'pid': os.getpid(),
+        'counters': counters,
+        'memory': {'rss_bytes': rss_bytes(), 'peak_rss_bytes': peak_rss_bytes(),
+                   'renders': renders, 'canvas_pool': canvas_pool.snapshot()},
+        'lifecycle': worker_lifecycle.snapshot(),
+        'admission': admission.snapshot()
+    })
+
 @app.route('/')
 def index():
     return render_template_string(HTML_TEMPLATE)
@@ -1232,25 +3616,79 @@ def load_room_json():
             'error': str(e)
         })
 
+def start_conversion(data, conditional=True):
+    """Options, parsed plan and an admission slot for /convert and /convert/stream, and an error response.
+    
+    Returns (conversion, None) with the render tier granted by admission, which the caller frees with
+    admission.release(conversion['client_id'], conversion['cost']), or (None, response) for 404, 400,
+    304 (only when conditional) and shed requests.
+    """
+    options = parse_render_options(data)  # Wall thickness, annotation toggles, label language
+    encode_options = parse_encode_options(data)  # Image format, palette/grey, compression
+    requested_tier = data.get('render_tier') if data.get('render_tier') in RENDER_TIERS else 'full'
+    floor_mode = data.get('floor_mode', 'combined')
+    layered = data.get('layered', True)
+    
+    # Stored plans skip upload and parse; uploads are validated before admission and any geometry work
+    converter, error_response = load_converter(data)
+    if converter is None:
+        return None, error_response
+    
+    if conditional:
+        # The image is a pure function of plan and options, so a matching ETag skips admission and render
+        response = not_modified(render_etag(converter.plan_hash, options, encode_options, requested_tier, floor_mode, layered),
+                                PRIVATE_CACHE_CONTROL)
+        if response is not None:
+            return None, response
+    cost = estimate_request_cost(request.content_length or len(data.get('json_data', '')), plan_element_count(converter))
+    if requested_tier == 'thumbnail':
+        cost /= 4
+    client_id = request_client_id()
+    try:
+        cost, tier = admission.acquire(client_id, cost, allow_downgrade=_as_bool(data.get('allow_downgrade', True)))
+    except AdmissionRejected as rejection:
+        return None, rejection_response(rejection)
+    return {
+        'converter': converter,
+        'options': options,
+        'encode_options': encode_options,
+        'requested_tier': requested_tier,
+        'tier': 'thumbnail' if requested_tier == 'thumbnail' else tier,
+        'floor_mode': floor_mode,
+        'layered': layered,
+        'client_id': client_id,
+        'cost': cost,
+    }, None
+
 @app.route('/convert', methods=['POST'])
 def convert():
     try:
-        data = request.json
-        json_str = data.get('json_data', '')
-        wall_line_width = data.get('wall_line_width', None)  # Get wall thickness from request
+        conversion, response = start_conversion(request.json)
+        if conversion is None:
+            return response
+        converter, options, encode_options = conversion['converter'], conversion['options'], conversion['encode_options']
+        requested_tier, tier = conversion['requested_tier'], conversion['tier']
+        floor_mode, layered = conversion['floor_mode'], conversion['layered']
         
-        # Create new converter instance for each request
-        converter = RoomPlanWallExtractor()
-        converter.parse_room_plan_api(json_str)
-        converter.generate_floor_plan(wall_line_width=wall_line_width)
-        image_base64 = converter.get_figure_as_base64()
-        stats = converter.get_statistics()
+        try:
+            image_base64, floors = render_plan_image(converter, options, RENDER_TIERS[tier], encode_options,
+                                                     floor_mode, layered)
+            stats = converter.get_statistics()
+        finally:
+            admission.release(conversion['client_id'], conversion['cost'])
         
-        return jsonify({
+        response = jsonify({
             'success': True,
             'image': image_base64,
+            'image_mime': IMAGE_MIME_TYPES[encode_options['image_format']],
+            'render_tier': tier,
+            'downgraded': tier != requested_tier,
+            'floors': floors,
             'stats': stats
         })
+        # Downgraded renders carry their own tier in the ETag, so the full image is fetched once load drops
+        etag = render_etag(converter.plan_hash, options, encode_options, tier, floor_mode, layered)
+        return with_cache_headers(response, etag, PRIVATE_CACHE_CONTROL if tier == requested_tier else 'no-store')
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -1259,10 +3697,752 @@ def convert():
             'error': str(e)
         })
 
+def sse_event(event, payload):
+    """One Server-Sent Events message with a JSON payload"""
+    return f'event: {event}\ndata: {json.dumps(payload)}\n\n'
+
+@app.route('/convert/stream', methods=['POST'])
+def convert_stream():
+    """/convert as Server-Sent Events: parsed, geometry, preview and image stages, or error"""
+    # Invalid payloads and shed requests get a plain response before the stream opens; the stream is
+    # not cacheable (no-store), so there is no conditional 304
+    conversion, response = start_conversion(request.json, conditional=False)
+    if conversion is None:
+        return response
+    converter, options, encode_options = conversion['converter'], conversion['options'], conversion['encode_options']
+    requested_tier, tier = conversion['requested_tier'], conversion['tier']
+    floor_mode, layered = conversion['floor_mode'], conversion['layered']
+    
+    def generate():
+        try:
+            yield sse_event('parsed', {'plan_id': converter.plan_hash,
+                                       'counts': {name: len(elements) for name, elements in converter.to_document().items()}})
+            
+            geometry = converter.prepare_geometry()
+            yield sse_event('geometry', {
+                'bounds': geometry['bounds'],
+                'rooms': [{'label': label['label'], 'area': label['area']} for label in geometry['labels']]
+            })
+            
+            if tier != 'thumbnail':
+                # A thumbnail of the combined plan renders in a fraction of the full time
+                with render_memory('preview'):
+                    preview = converter.get_layers_as_base64(options, RENDER_TIERS['thumbnail'], encode_options)
+                yield sse_event('preview', {'image': preview, 'image_mime': IMAGE_MIME_TYPES[encode_options['image_format']]})
+            
+            image_base64, floors = render_plan_image(converter, options, RENDER_TIERS[tier], encode_options,
+                                                     floor_mode, layered)
+            yield sse_event('image', {
+                'success': True,
+                'image': image_base64,
+                'image_mime': IMAGE_MIME_TYPES[encode_options['image_format']],
+                'render_tier': tier,
+                'downgraded': tier != requested_tier,
+                'floors': floors,
+                'stats': converter.get_statistics()
+            })
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            yield sse_event('error', {'success': False, 'error': str(e)})
+    
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-store'
+    # Stop proxies from buffering the stream, otherwise the preview arrives with the final image
+    response.headers['X-Accel-Buffering'] = 'no'
+    # Released when the response closes, even if the client disconnects before the generator starts
+    response.call_on_close(lambda: admission.release(conversion['client_id'], conversion['cost']))
+    return response
+
+class PlanStore:
+    """SQLite store of uploaded plans: one zlib-compressed canonical JSON row per content hash"""
+    
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS plans ('
+                'id TEXT PRIMARY KEY, data BLOB NOT NULL, raw_size INTEGER NOT NULL, '
+                'stored_size INTEGER NOT NULL, created_at REAL NOT NULL)'
+            )
+    
+    def _connect(self):
+        # A connection per call keeps the store safe across threads and forked workers
+        return closing_connection(sqlite3.connect(self.path, timeout=10))
+    
+    def put(self, plan_id, document):
+        """Store a document once; uploads with the same content hash are deduplicated"""
+        raw = canonical_json(document)
+        compressed = zlib.compress(raw, 6)
+        with self._connect() as connection:
+            connection.execute(
+                'INSERT OR IGNORE INTO plans (id, data, raw_size, stored_size, created_at) VALUES (?, ?, ?, ?, ?)',
+                (plan_id, compressed, len(raw), len(compressed), time.time())
+            )
+    
+    def get(self, plan_id):
+        """Stored document as a dict, None if unknown"""
+        with self._connect() as connection:
+            row = connection.execute('SELECT data FROM plans WHERE id = ?', (plan_id,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(zlib.decompress(row[0]))
+    
+    def ids(self):
+        """Ids of all stored plans, oldest first"""
+        with self._connect() as connection:
+            return [row[0] for row in connection.execute('SELECT id FROM plans ORDER BY created_at, id')]
+    
+    def documents(self, plan_ids):
+        """{plan id: document} for the stored plans among plan_ids"""
+        placeholders = ','.join('?' * len(plan_ids))
+        with self._connect() as connection:
+            rows = connection.execute(f'SELECT id, data FROM plans WHERE id IN ({placeholders})', list(plan_ids)).fetchall()
+        return {plan_id: json.loads(zlib.decompress(data)) for plan_id, data in rows}
+    
+    def info(self, plan_id):
+        """Sizes and creation time of a stored plan, None if unknown"""
+        with self._connect() as connection:
+            row = connection.execute(
+                'SELECT raw_size, stored_size, created_at FROM plans WHERE id = ?', (plan_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {'raw_size': row[0], 'stored_size': row[1], 'created_at': row[2]}
+
+@contextmanager
+def closing_connection(connection):
+    """Commit on success and always close the SQLite connection"""
+    try:
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+plan_store = PlanStore(os.environ.get('PLAN_STORE_PATH', 'plans.sqlite3'))
+
+# Parsed plans kept in memory by content hash, so repeated requests skip the parse
+PLAN_CACHE_SIZE = int(os.environ.get('PLAN_CACHE_SIZE', 32))
+_plans = OrderedDict()
+_plans_lock = threading.Lock()
+
+def _cache_plan(converter):
+    with _plans_lock:
+        _plans[converter.plan_hash] = converter
+        _plans.move_to_end(converter.plan_hash)
+        while len(_plans) > PLAN_CACHE_SIZE:
+            _plans.popitem(last=False)
+
+def register_plan(converter):
+    """Persist a parsed plan and keep it in the in-memory LRU, returns its plan id"""
+    plan_store.put(converter.plan_hash, converter.document)
+    _cache_plan(converter)
+    return converter.plan_hash
+
+def get_plan(plan_id):
+    """Look up a plan by id in memory, then in the plan store; None if unknown"""
+    with _plans_lock:
+        converter = _plans.get(plan_id)
+        if converter is not None:
+            _plans.move_to_end(plan_id)
+            return converter
+    
+    document = plan_store.get(plan_id)
+    if document is None:
+        return None
+    converter = RoomPlanWallExtractor()
+    converter.parse_room_plan_api(document)
+    _cache_plan(converter)
+    return converter
+
+def plan_element_count(converter):
+    """Number of elements in a parsed plan, for admission cost"""
+    return sum(len(elements) for elements in converter.to_document().values())
+
+# Bump when renderer or export output changes, so clients and CDNs drop stale ETags
+RENDER_VERSION = '6'
+# Renders by plan id are a pure function of the URL, so shared caches may keep them
+CACHE_MAX_AGE = int(os.environ.get('CACHE_MAX_AGE', 86400))
+PUBLIC_CACHE_CONTROL = f'public, max-age={CACHE_MAX_AGE}'
+# POST bodies are not cacheable by CDNs; clients revalidate with If-None-Match
+PRIVATE_CACHE_CONTROL = 'private, no-cache'
+
+def render_etag(plan_id, *parts):
+    """Strong ETag from the plan content hash, renderer, style profile and locale versions and normalized options"""
+    key = json.dumps([RENDER_VERSION, STYLE_PROFILES_VERSION, LOCALES_VERSION, plan_id, parts],
+                     sort_keys=True, default=str)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+def not_modified(etag, cache_control):
+    """304 response if the request already holds this ETag, else None"""
+    if not request.if_none_match.contains(etag):
+        return None
+    record_metric('not_modified')
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+def with_cache_headers(response, etag, cache_control):
+    """Attach ETag and Cache-Control to a response"""
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+@app.route('/plans', methods=['POST'])
+def upload_plan():
+    """Parse a Room Plan document once and return a plan id for tile requests"""
+    try:
+        data = request.json
+        converter = RoomPlanWallExtractor()
+        if not converter.parse_room_plan_api(data.get('json_data', '')):
+            return plan_error_response(converter.parse_error)
+        plan_id = register_plan(converter)
+        geometry = converter.prepare_geometry()
+        
+        return jsonify({
+            'success': True,
+            'plan_id': plan_id,
+            'storage': plan_store.info(plan_id),
+            'bounds': geometry['bounds'],
+            'tile_size': TILE_SIZE,
+            'max_zoom': MAX_TILE_ZOOM,
+            'stats': converter.get_statistics()
+        })
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        })
+
+def load_converter(data):
+    """Converter for a request (registered plan by plan_id, or parsed from json_data) and an error response"""
+    plan_id = data.get('plan_id')
+    if plan_id:
+        converter = get_plan(plan_id)
+        if converter is None:
+            return None, (jsonify({'success': False, 'error': 'Plan not found'}), 404)
+        return converter, None
+    converter = RoomPlanWallExtractor()
+    if not converter.parse_room_plan_api(data.get('json_data', '')):
+        return None, plan_error_response(converter.parse_error)
+    return converter, None
+
+@app.route('/geometry', methods=['POST'])
+def geometry():
+    """Export rotated plan geometry without rendering: GeoJSON (default) or compact binary"""
+    try:
+        data = request.json
+        converter, error_response = load_converter(data)
+        if converter is None:
+            return error_response
+        
+        export_format = data.get('format', 'geojson')
+        wall_line_width = parse_render_options(data)['wall_line_width'] if data.get('wall_outline') else None
+        etag = render_etag(converter.plan_hash, 'geometry', export_format, wall_line_width)
+        response = not_modified(etag, PRIVATE_CACHE_CONTROL)
+        if response is not None:
+            return response
+        
+        if export_format == 'binary':
+            response = Response(converter.get_geometry_binary(), mimetype='application/octet-stream')
+        else:
+            response = jsonify({
+                'success': True,
+                'geometry': converter.get_geometry_geojson(wall_line_width),
+                'stats': converter.get_statistics()
+            })
+        return with_cache_headers(response, etag, PRIVATE_CACHE_CONTROL)
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        })
+
+@app.route('/merge', methods=['POST'])
+def merge():
+    """Merge separately scanned rooms (json_data_list or plan_ids) into one registered plan"""
+    try:
+        data = request.json
+        converters = []
+        for plan_id in data.get('plan_ids', []):
+            converter = get_plan(plan_id)
+            if converter is None:
+                return jsonify({'success': False, 'error': f'Plan not found: {plan_id}'}), 404
+            converters.append(converter)
+        for json_str in data.get('json_data_list', []):
+            converter = RoomPlanWallExtractor()
+            if not converter.parse_room_plan_api(json_str):
+                return plan_error_response(converter.parse_error)
+            converters.append(converter)
+        if not converters:
+            return jsonify({'success': False, 'error': 'No rooms to merge'}), 400
+        
+        merged, alignments = merge_room_documents([converter.to_document() for converter in converters],
+                                                  [converter.plan_hash for converter in converters])
+        merged_converter = RoomPlanWallExtractor()
+        # The merged plan can exceed the element limits that each room passed on its own
+        if not merged_converter.parse_room_plan_api(merged):
+            return plan_error_response(merged_converter.parse_error)
+        plan_id = register_plan(merged_converter)
+        
+        result = {
+            'success': True,
+            'plan_id': plan_id,
+            'alignments': alignments,
+            'stats': merged_converter.get_statistics()
+        }
+        if data.get('render'):
+            encode_options = parse_encode_options(data)
+            with render_memory('merge'):
+                result['image'] = merged_converter.get_layers_as_base64(parse_render_options(data), encode_options=encode_options)
+            result['image_mime'] = IMAGE_MIME_TYPES[encode_options['image_format']]
+        return jsonify(result)
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        })
+
+@app.route('/diff', methods=['POST'])
+def diff_plans():
+    """Added, removed and moved elements between two scans of the same space, optionally as an overlay render"""
+    try:
+        data = request.json
+        before, error_response = load_converter({'plan_id': data.get('before_plan_id'),
+                                                 'json_data': data.get('before_json_data', '')})
+        if before is None:
+            return error_response
+        after, error_response = load_converter({'plan_id': data.get('after_plan_id'),
+                                                'json_data': data.get('after_json_data', '')})
+        if after is None:
+            return error_response
+        
+        align = _as_bool(data.get('align', True))
+        options = parse_render_options(data)
+        encode_options = parse_encode_options(data)
+        render = _as_bool(data.get('render', False))
+        etag = render_etag(f'{before.plan_hash}:{after.plan_hash}', 'diff', align,
+                           render and options, render and encode_options)
+        response = not_modified(etag, PRIVATE_CACHE_CONTROL)
+        if response is not None:
+            return response
+        
+        result, overlay = plan_diff(before, after, align)
+        result = dict(result, success=True, before_plan_id=before.plan_hash, after_plan_id=after.plan_hash)
+        if render:
+            with render_memory('diff'):
+                result['image'] = overlay.render_diff_base64(result, options, encode_options=encode_options)
+            result['image_mime'] = IMAGE_MIME_TYPES[encode_options['image_format']]
+        return with_cache_headers(jsonify(result), etag, PRIVATE_CACHE_CONTROL)
+    except PlanValidationError as error:
+        return plan_error_response(error)
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        })
+
+@app.route('/plans/<plan_id>')
+def plan_info(plan_id):
+    """Stored plan metadata: storage sizes, bounds and statistics"""
+    converter = get_plan(plan_id)
+    if converter is None:
+        return jsonify({'success': False, 'error': 'Plan not found'}), 404
+    etag = render_etag(plan_id, 'info')
+    response = not_modified(etag, PUBLIC_CACHE_CONTROL)
+    if response is not None:
+        return response
+    response = jsonify({
+        'success': True,
+        'plan_id': plan_id,
+        'storage': plan_store.info(plan_id),
+        'bounds': converter.prepare_geometry()['bounds'],
+        'tile_size': TILE_SIZE,
+        'max_zoom': MAX_TILE_ZOOM,
+        'stats': converter.get_statistics()
+    })
+    return with_cache_headers(response, etag, PUBLIC_CACHE_CONTROL)
+
+@app.route('/plans/<plan_id>/image')
+def plan_image(plan_id):
+    """Rendered plan by id as a raw image; options come from the query string so CDNs can cache it"""
+    converter = get_plan(plan_id)
+    if converter is None:
+        return jsonify({'success': False, 'error': 'Plan not found'}), 404
+    options = parse_render_options(request.args)
+    encode_options = parse_encode_options(request.args)
+    tier = request.args.get('render_tier') if request.args.get('render_tier') in RENDER_TIERS else 'full'
+    etag = render_etag(plan_id, options, encode_options, tier, 'combined', True)
+    response = not_modified(etag, PUBLIC_CACHE_CONTROL)
+    if response is not None:
+        return response
+    
+    cost = estimate_request_cost(0, plan_element_count(converter))
+    if tier == 'thumbnail':
+        cost /= 4
+    client_id = request_client_id()
+    try:
+        # No downgrade here: a shared cache would keep the lower tier under the full-tier URL
+        cost, _ = admission.acquire(client_id, cost, allow_downgrade=False)
+    except AdmissionRejected as rejection:
+        return rejection_response(rejection)
+    try:
+        with render_memory('image'):
+            image = base64.b64decode(converter.get_layers_as_base64(options, RENDER_TIERS[tier], encode_options))
+    finally:
+        admission.release(client_id, cost)
+    
+    response = Response(image, mimetype=IMAGE_MIME_TYPES[encode_options['image_format']])
+    return with_cache_headers(response, etag, PUBLIC_CACHE_CONTROL)
+
+@app.route('/plans/<plan_id>/tiles/<int:z>/<int:x>/<int:y>')
+@app.route('/plans/<plan_id>/tiles/<int:z>/<int:x>/<int:y>.png')
+def plan_tile(plan_id, z, x, y):
+    """Render (or serve from cache) a single PNG tile of a registered plan"""
+    converter = get_plan(plan_id)
+    if converter is None:
+        return jsonify({'success': False, 'error': 'Plan not found'}), 404
+    if z < 0 or z > MAX_TILE_ZOOM or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        return jsonify({'success': False, 'error': 'Tile out of range'}), 404
+    
+    options = parse_render_options(request.args)
+    encode_options = parse_encode_options(request.args)
+    etag = render_etag(plan_id, 'tile', z, x, y, options, encode_options)
+    response = not_modified(etag, PUBLIC_CACHE_CONTROL)
+    if response is not None:
+        return response
+    
+    key = (plan_id, z, x, y, tuple(sorted(options.items())), tuple(sorted(encode_options.items())))
+    tile = _tile_cache.get(key)
+    if tile is None:
+        with render_memory('tile'):
+            tile = converter.render_tile(z, x, y, options, encode_options)
+        _tile_cache.put(key, tile, len(tile))
+    response = Response(tile, mimetype=IMAGE_MIME_TYPES[encode_options['image_format']])
+    return with_cache_headers(response, etag, PUBLIC_CACHE_CONTROL)
+
+@app.route('/plans/<plan_id>/analytics')
+def plan_analytics_info(plan_id):
+    """Room and total analytics of a stored plan (no render)"""
+    converter = get_plan(plan_id)
+    if converter is None:
+        return jsonify({'success': False, 'error': 'Plan not found'}), 404
+    etag = render_etag(plan_id, 'analytics')
+    response = not_modified(etag, PUBLIC_CACHE_CONTROL)
+    if response is not None:
+        return response
+    response = jsonify(dict(plan_analytics(converter), success=True, plan_id=plan_id))
+    return with_cache_headers(response, etag, PUBLIC_CACHE_CONTROL)
+
+# Batch analytics over stored plans, streamed as CSV or Parquet while plans are still being analysed
+ANALYTICS_BATCH_SIZE = int(os.environ.get('ANALYTICS_BATCH_SIZE', 64))
+
+def analytics_job(plan_id, document):
+    """Plan row and room rows of one stored document; runs in the worker pool"""
+    if document is None:
+        return {'plan_id': plan_id, 'error': 'Plan not found'}, []
+    converter = RoomPlanWallExtractor()
+    if not converter.parse_room_plan_api(document):
+        return {'plan_id': plan_id, 'error': str(converter.parse_error)}, []
+    result = plan_analytics(converter)
+    return dict(result['totals'], plan_id=plan_id, error=None), [dict(room, plan_id=plan_id) for room in result['rooms']]
+
+def iter_analytics(plan_ids, level):
+    """Plan or room rows for stored plans, loaded and analysed one batch at a time"""
+    pool = get_render_pool()
+    for start in range(0, len(plan_ids), ANALYTICS_BATCH_SIZE):
+        batch = plan_ids[start:start + ANALYTICS_BATCH_SIZE]
+        documents = plan_store.documents(batch)
+        jobs = (batch, [documents.get(plan_id) for plan_id in batch])
+        results = pool.map(analytics_job, *jobs) if pool is not None and len(batch) > 1 else map(analytics_job, *jobs)
+        for plan_row, room_rows in results:
+            if level == 'rooms':
+                yield from room_rows
+            else:
+                yield plan_row
+
+def csv_stream(rows, fields):
+    """CSV text: the header, then a chunk every ANALYTICS_BATCH_SIZE rows"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=[name for name, _ in fields], extrasaction='ignore')
+    writer.writeheader()
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % ANALYTICS_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+class ParquetSink(io.RawIOBase):
+    """Write-only file for ParquetWriter that hands written bytes on; tell() keeps counting for the footer offsets"""
+    
+    def __init__(self):
+        super().__init__()
+        self.position = 0
+        self._chunks = []
+    
+    def writable(self):
+        return True
+    
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+    
+    def tell(self):
+        return self.position
+    
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def parquet_stream(rows, fields):
+    """Parquet file bytes: one row group per ANALYTICS_BATCH_SIZE rows, sent as soon as it is written"""
+    schema = pyarrow.schema([(name, getattr(pyarrow, type_name)()) for name, type_name in fields])
+    sink = ParquetSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == ANALYTICS_BATCH_SIZE:
+            writer.write_table(pyarrow.Table.from_pylist(batch, schema=schema))
+            batch = []
+            yield sink.drain()
+    if batch:
+        writer.write_table(pyarrow.Table.from_pylist(batch, schema=schema))
+    writer.close()
+    yield sink.drain()
+
+@app.route('/analytics', methods=['POST'])
+def analytics_batch():
+    """Analytics rows for stored plans (plan_ids, or all stored plans) streamed as CSV or Parquet"""
+    try:
+        data = request.json or {}
+        level = data.get('level', 'plans')
+        export_format = data.get('format', 'csv')
+        if level not in ('plans', 'rooms') or export_format not in ('csv', 'parquet'):
+            return jsonify({'success': False, 'error': 'level must be plans or rooms, format csv or parquet'}), 400
+        if export_format == 'parquet' and pyarrow is None:
+            return jsonify({'success': False, 'error': 'Parquet export needs pyarrow installed'}), 400
+        
+        plan_ids = list(data.get('plan_ids') or plan_store.ids())
+        fields = ANALYTICS_ROOM_FIELDS if level == 'rooms' else ANALYTICS_PLAN_FIELDS
+        rows = iter_analytics(plan_ids, level)
+        if export_format == 'parquet':
+            response = Response(parquet_stream(rows, fields), mimetype='application/vnd.apache.parquet')
+        else:
+            response = Response(csv_stream(rows, fields), mimetype='text/csv')
+        response.headers['Content-Disposition'] = f'attachment; filename=analytics_{level}.{export_format}'
+        return response
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        })
+
+# Async serving mode: the event loop reads uploads and writes responses, so slow clients don't hold a thread;
+# the Flask app (parse, geometry, rendering) runs in a thread pool once the whole body has arrived
+ASYNC_WORKER_THREADS = int(os.environ.get('ASYNC_WORKER_THREADS', 8))
+_async_executor = None
+_async_executor_lock = threading.Lock()
+
+def get_async_executor():
+    """Thread pool for Flask request handling under ASGI, created on first use"""
+    global _async_executor
+    with _async_executor_lock:
+        if _async_executor is None:
+            _async_executor = ThreadPoolExecutor(max_workers=ASYNC_WORKER_THREADS, thread_name_prefix='asgi')
+        return _async_executor
+
+def asgi_environ(scope, body):
+    """WSGI environ for a buffered ASGI HTTP request"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = 'HTTP_' + name
+            environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+def run_wsgi_request(environ):
+    """Call the Flask app in a worker thread, returns (status, headers, body iterator)"""
+    started = {}
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+    result = app(environ, start_response)
+    return started['status'], started['headers'], result
+
+async def asgi_app(scope, receive, send):
+    """ASGI entry point (uvicorn) with the same routes and contract as the WSGI app"""
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                if WORKER_WARMUP:
+                    await asyncio.get_running_loop().run_in_executor(get_async_executor(), warm_up)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if _async_executor is not None:
+                    _async_executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+    
+    # Buffer the upload without blocking: a slow mobile client only costs an idle coroutine
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+        body.extend(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    
+    loop = asyncio.get_running_loop()
+    executor = get_async_executor()
+    status, headers, result = await loop.run_in_executor(executor, run_wsgi_request, asgi_environ(scope, bytes(body)))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    # Body chunks are pulled in the pool too, so streamed responses keep their CPU work off the loop
+    chunks = iter(result)
+    try:
+        while True:
+            chunk = await loop.run_in_executor(executor, next, chunks, None)
+            if chunk is None:
+                break
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    finally:
+        if hasattr(result, 'close'):
+            await loop.run_in_executor(executor, result.close)
+    await send({'type': 'http.response.body', 'body': b''})
+
+# Golden renders: sample Room Plan files with the sha256 of each rendered variant, checked with
+# `python app.py --check-golden` after renderer or dependency changes
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'samples')
+GOLDEN_PATH = os.path.join(SAMPLES_DIR, 'golden.json')
+GOLDEN_VARIANTS = {
+    'default': {},
+    'stroke': {'wall_style': 'stroke', 'door_style': 'line', 'window_style': 'line', 'show_objects': False},
+    'figure': {'layered': False, 'label_language': 'en'},
+    'per_floor': {'floor_mode': 'per_floor', 'color_mode': 'gray'},
+    'webp': {'image_format': 'webp', 'color_mode': 'rgb'},
+}
+
+def golden_environment():
+    """Versions that golden hashes depend on besides the code itself"""
+    return {'render_version': RENDER_VERSION, 'deterministic': DETERMINISTIC_RENDER,
+            'matplotlib': matplotlib.__version__, 'pillow': Image.__version__, 'numpy': np.__version__}
+
+def render_golden(document, data):
+    """sha256 over every image rendered for a document with request options data"""
+    # Cold caches, so every call really draws
+    _layer_cache.clear()
+    _label_cache.clear()
+    converter = RoomPlanWallExtractor()
+    if not converter.parse_room_plan_api(document):
+        raise ValueError(f'sample rejected: {converter.parse_error}')
+    image, floors = render_plan_image(converter, parse_render_options(data), LAYER_CANVAS, parse_encode_options(data),
+                                      data.get('floor_mode', 'combined'), data.get('layered', True))
+    digest = hashlib.sha256()
+    for encoded in [image] + [floor.get('image') for floor in floors or []]:
+        if encoded:
+            digest.update(base64.b64decode(encoded))
+    return digest.hexdigest()
+
+def reversed_plan_arrays(document):
+    """Copy of a Room Plan document with every element array reversed; must render identically"""
+    return {key: value[::-1] if key in SORTED_PLAN_ARRAYS else value for key, value in document.items()}
+
+def check_golden(update=False):
+    """Render every sample variant twice and compare with samples/golden.json; update rewrites it. Returns an exit code"""
+    if not DETERMINISTIC_RENDER:
+        print("❌ Golden hashes need DETERMINISTIC_RENDER=true")
+        return 1
+    names = sorted(name for name in os.listdir(SAMPLES_DIR) if name.endswith('.json') and name != 'golden.json')
+    expected = {}
+    if os.path.exists(GOLDEN_PATH):
+        with open(GOLDEN_PATH) as f:
+            expected = json.load(f)
+    if not update and expected.get('environment') != golden_environment():
+        print(f"⚠️ Golden hashes were recorded with {expected.get('environment')}, running {golden_environment()}")
+    
+    renders, failures = {}, 0
+    for name in names:
+        with open(os.path.join(SAMPLES_DIR, name)) as f:
+            document = json.load(f)
+        renders[name] = {}
+        for variant, data in GOLDEN_VARIANTS.items():
+            # A second render with every element array reversed must already agree, independent of the stored hashes
+            digest = render_golden(document, data)
+            repeat = render_golden(reversed_plan_arrays(document), data)
+            renders[name][variant] = digest
+            wanted = expected.get('renders', {}).get(name, {}).get(variant)
+            if digest != repeat:
+                status = 'NOT REPRODUCIBLE'
+            elif update or digest == wanted:
+                status = 'ok'
+            else:
+                status = f'MISMATCH (expected {wanted})'
+            failures += status not in ('ok',)
+            print(f"{name} [{variant}]: {digest[:16]} {status}")
+    
+    if update and not failures:
+        with open(GOLDEN_PATH, 'w') as f:
+            json.dump({'environment': golden_environment(), 'renders': renders}, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"✅ Wrote {GOLDEN_PATH}")
+    return 1 if failures else 0
+
 if __name__ == '__main__':
     import os
+    if '--check-golden' in sys.argv or '--update-golden' in sys.argv:
+        sys.exit(check_golden(update='--update-golden' in sys.argv))
     port = int(os.environ.get('PORT', 5000))
     host = os.environ.get('HOST', '0.0.0.0')
     debug = os.environ.get('FLASK_DEBUG', 'False').lower() == 'true'
+    if WORKER_WARMUP:
+        warm_up()
     print(f"🚀 Server starting on http://{host}:{port}")
-    app.run(debug=debug, host=host, port=port)
+    if os.environ.get('SERVE_MODE', 'wsgi') == 'asgi':
+        import uvicorn
+        uvicorn.run(asgi_app, host=host, port=port)
+    else:
+        app.run(debug=debug, host=host, port=port)
@@ -0,0 +1,26 @@
+# Loaded by gunicorn from the working directory; hooks hand worker lifecycle decisions to app.py
+import os
+
+# Threaded workers: admission control in app.py budgets render cost between requests in flight in one
+# process, so a worker needs several threads; more threads than the per-client limit lets that limit trigger
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS',
+                             max(4, int(os.environ.get('ADMISSION_CLIENT_CONCURRENCY', 2)) + 2)))
+
+
+def post_worker_init(worker):
+    """Warm up fonts, label rasters and canvases before the worker accepts traffic"""
+    from app import WORKER_WARMUP, admission, warm_up
+    if worker.cfg.threads <= admission.client_concurrency:
+        worker.log.warning("threads=%s cannot exceed the per-client limit of %s; 429s will not trigger",
+                           worker.cfg.threads, admission.client_concurrency)
+    if WORKER_WARMUP:
+        warm_up()
+
+
+def post_request(worker, req, environ, resp):
+    """Finish the current request, then let the arbiter replace a worker past its request or RSS budget"""
+    from app import worker_lifecycle
+    if worker_lifecycle.recycle_reason is not None and worker.alive:
+        worker.log.info("Recycling worker %s: %s", worker.pid, worker_lifecycle.recycle_reason)
+        worker.alive = False
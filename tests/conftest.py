@@ -0,0 +1,8 @@
+"""Import app.py from the repository root with deterministic rendering"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ['DETERMINISTIC_RENDER'] = 'true'
+os.environ.setdefault('PLAN_STORE_PATH', os.path.join(ROOT, 'plans.sqlite3'))
@@ -0,0 +1,46 @@
+"""Golden render hashes from samples/golden.json, the pytest form of `python app.py --check-golden`"""
+import json
+import os
+
+import pytest
+
+import app
+
+with open(app.GOLDEN_PATH) as f:
+    GOLDEN = json.load(f)
+
+# Hashes are only comparable under the dependency versions they were recorded with (requirements.txt pins)
+DEPENDENCIES = ('matplotlib', 'pillow', 'numpy')
+RECORDED = {name: GOLDEN['environment'].get(name) for name in DEPENDENCIES}
+RUNNING = {name: app.golden_environment()[name] for name in DEPENDENCIES}
+SAMPLES = sorted(name for name in os.listdir(app.SAMPLES_DIR) if name.endswith('.json') and name != 'golden.json')
+
+
+def load_sample(name):
+    with open(os.path.join(app.SAMPLES_DIR, name)) as f:
+        return json.load(f)
+
+
+def test_golden_covers_every_sample():
+    assert GOLDEN['environment']['render_version'] == app.RENDER_VERSION, 'RENDER_VERSION changed, run --update-golden'
+    assert sorted(GOLDEN['renders']) == SAMPLES
+    for name in SAMPLES:
+        assert sorted(GOLDEN['renders'][name]) == sorted(app.GOLDEN_VARIANTS)
+
+
+@pytest.mark.skipif(RECORDED != RUNNING, reason=f'golden.json recorded with {RECORDED}, running {RUNNING}')
+@pytest.mark.parametrize('name', SAMPLES)
+@pytest.mark.parametrize('variant', sorted(app.GOLDEN_VARIANTS))
+def test_golden_render(name, variant):
+    document = load_sample(name)
+    data = app.GOLDEN_VARIANTS[variant]
+    assert app.render_golden(document, data) == GOLDEN['renders'][name][variant]
+
+
+# Element order must not change the image under any dependency versions
+@pytest.mark.parametrize('name', SAMPLES)
+@pytest.mark.parametrize('variant', sorted(app.GOLDEN_VARIANTS))
+def test_render_ignores_element_order(name, variant):
+    document = load_sample(name)
+    data = app.GOLDEN_VARIANTS[variant]
+    assert app.render_golden(app.reversed_plan_arrays(document), data) == app.render_golden(document, data)
@@ -0,0 +1,129 @@
+"""Single-pass plan validation: load_plan_document, error path/kind and rejection metrics"""
+import json
+
+import pytest
+
+import app
+
+IDENTITY = [1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 1.0]
+
+
+def wall(**fields):
+    return dict({'identifier': 'w', 'transform': list(IDENTITY), 'dimensions': [4.0, 2.5, 0.0]}, **fields)
+
+
+def document(**arrays):
+    return dict({'walls': [wall(), wall()], 'floors': [{'transform': list(IDENTITY)}]}, **arrays)
+
+
+def rejection(data):
+    with pytest.raises(app.PlanValidationError) as info:
+        app.load_plan_document(data)
+    return info.value
+
+
+def test_valid_document_and_string_payload():
+    data = document(doors=[wall(parentIdentifier='w')], sections=[{'center': [1.0, 0.0, 2.0], 'label': 'kitchen'}])
+    assert app.load_plan_document(data) is data
+    assert app.load_plan_document(json.dumps(data)) == data
+
+
+@pytest.mark.parametrize('transform, path', [
+    (IDENTITY[:15], 'walls[1].transform'),
+    (IDENTITY + [0.0], 'walls[1].transform'),
+    ('identity', 'walls[1].transform'),
+])
+def test_transform_length(transform, path):
+    error = rejection(document(walls=[wall(), wall(transform=transform)]))
+    assert (error.path, error.kind) == (path, 'structure')
+
+
+@pytest.mark.parametrize('value', [float('nan'), float('inf'), -float('inf'), True, '1.0'])
+def test_transform_numbers(value):
+    transform = list(IDENTITY)
+    transform[5] = value
+    error = rejection(document(walls=[wall(transform=transform)]))
+    assert (error.path, error.kind) == ('walls[0].transform[5]', 'numeric')
+
+
+def test_nan_in_json_text():
+    payload = json.dumps(document()).replace('[4.0, 2.5, 0.0]', '[NaN, 2.5, 0.0]', 1)
+    error = rejection(payload)
+    assert (error.path, error.kind) == ('walls[0].dimensions[0]', 'numeric')
+
+
+def test_bool_is_not_a_number_or_story():
+    error = rejection(document(walls=[wall(dimensions=[4.0, False, 0.0])]))
+    assert (error.path, error.kind) == ('walls[0].dimensions[1]', 'numeric')
+    error = rejection(document(walls=[wall(story=True)]))
+    assert (error.path, error.kind) == ('walls[0].story', 'structure')
+
+
+def test_coordinate_and_size_limits():
+    transform = list(IDENTITY)
+    transform[13] = app.MAX_COORDINATE_M + 1
+    error = rejection(document(walls=[wall(transform=transform)]))
+    assert (error.path, error.kind) == ('walls[0].transform[13]', 'limit')
+    error = rejection(document(walls=[wall(dimensions=[app.MAX_ELEMENT_SIZE_M + 1, 2.5, 0.0])]))
+    assert (error.path, error.kind) == ('walls[0].dimensions[0]', 'limit')
+
+
+@pytest.mark.parametrize('data, path', [
+    ([], '$'),
+    ({'walls': {}}, 'walls'),
+    ({'walls': [1]}, 'walls[0]'),
+    ({'walls': [{'identifier': 'w'}]}, 'walls[0].transform'),
+    ({'sections': [{'label': 3}]}, 'sections[0].label'),
+])
+def test_structure_paths(data, path):
+    error = rejection(data)
+    assert (error.path, error.kind) == (path, 'structure')
+
+
+def test_element_limit_in_one_array(monkeypatch):
+    monkeypatch.setattr(app, 'MAX_PLAN_ELEMENTS', 3)
+    assert app.load_plan_document(document(walls=[wall()] * 2))
+    error = rejection(document(walls=[wall()] * 4))
+    assert (error.path, error.kind) == ('walls', 'limit')
+
+
+def test_element_limit_across_arrays(monkeypatch):
+    monkeypatch.setattr(app, 'MAX_PLAN_ELEMENTS', 3)
+    # Two walls and one floor fit; two doors on top cross the total while doors are counted
+    assert app.load_plan_document(document())
+    error = rejection(document(doors=[wall()] * 2))
+    assert (error.path, error.kind) == ('doors', 'limit')
+
+
+def test_payload_limit_counts_utf8_bytes(monkeypatch):
+    payload = json.dumps(document(sections=[{'label': 'кухня' * 20}]), ensure_ascii=False)
+    monkeypatch.setattr(app, 'MAX_PLAN_BYTES', len(payload) + 10)
+    error = rejection(payload)
+    assert (error.path, error.kind) == ('$', 'limit')
+    monkeypatch.setattr(app, 'MAX_PLAN_BYTES', len(payload.encode('utf-8')))
+    assert app.load_plan_document(payload)
+
+
+def test_invalid_json():
+    error = rejection('{"walls": [')
+    assert (error.path, error.kind) == ('$', 'json')
+
+
+def test_rejection_response_and_metrics():
+    client = app.app.test_client()
+    with app._metrics_lock:
+        before = dict(app._metrics)
+    body = {'json_data': json.dumps(document(walls=[wall(transform=IDENTITY[:3])]))}
+    response = client.post('/convert', json=body)
+    assert response.status_code == 400
+    assert response.get_json() == {'success': False, 'path': 'walls[0].transform',
+                                   'error': 'walls[0].transform: must be a list of 16 numbers (column-major 4x4 matrix)'}
+    response = client.post('/geometry', json={'json_data': '{"walls": ['})
+    assert response.status_code == 400
+    assert response.get_json()['path'] == '$'
+    with app._metrics_lock:
+        after = dict(app._metrics)
+    delta = {name: after.get(name, 0) - before.get(name, 0) for name in after}
+    assert delta['plan_rejected'] == 2
+    assert delta['plan_rejected_structure'] == 1
+    assert delta['plan_rejected_json'] == 1